@@ -7,24 +7,40 @@
 
 from __future__ import division
 
-from flask import Flask, make_response, request, current_app, jsonify, render_template
+from flask import Flask, make_response, request, current_app, jsonify, render_template, abort, g, stream_with_context, has_app_context, has_request_context, send_from_directory
 from datetime import datetime, timedelta, date
-from functools import update_wrapper
-import json, os, requests, time
+from functools import update_wrapper, partial
+import json, os, requests, time, logging
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from flask.ext.heroku import Heroku
-from flask.ext.sqlalchemy import SQLAlchemy
-from sqlalchemy.ext.mutable import Mutable
-from sqlalchemy import types, desc
-from sqlalchemy.sql.expression import func
+from flask.json import JSONEncoder
+from flask.ext.sqlalchemy import SQLAlchemy, _SignallingSession
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy import types, desc, and_, or_, inspect
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm import scoped_session, load_only
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.expression import func, select, union_all, literal, literal_column, table, column, false, cast, distinct, ColumnElement, FromClause
+from sqlalchemy.sql import operators
 from dictalchemy import make_class_dictable
 from dateutil.tz import tzoffset
-from mimetypes import guess_type
+from dateutil.parser import parse as parse_date
 from copy import deepcopy
-from os.path import join
+from hashlib import md5
+from random import random
+from threading import Lock
+from collections import OrderedDict, defaultdict, Mapping, Sequence
 from math import ceil
-from urllib import urlencode
+from itertools import islice, chain
+from calendar import timegm
+from urllib import urlencode, quote, unquote
 from flask.ext.script import Manager
 from flask.ext.migrate import Migrate, MigrateCommand
+from werkzeug.test import EnvironBuilder
+from werkzeug.exceptions import HTTPException
+from geo import parse_bbox, radius_bbox, distance_km, GridIndex, ClusterIndex
+from querystats import QueryStats
 
 # -------------------
 # Init
@@ -32,8 +48,44 @@ from flask.ext.migrate import Migrate, MigrateCommand
 
 app = Flask(__name__)
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///sand.db"
+app.config["RESPONSE_CACHE_SIZE"] = int(os.environ.get('RESPONSE_CACHE_SIZE', 256))
+app.config["ACCEPTED_KEYS_SIZE"] = int(os.environ.get('ACCEPTED_KEYS_SIZE', 4096))
+app.config["STREAM_PAGE_SIZE"] = int(os.environ.get('STREAM_PAGE_SIZE', 100))
+app.config["EMBEDDED_ISSUES"] = int(os.environ.get('EMBEDDED_ISSUES', 10))
+app.config["SURROGATE_MAX_AGE"] = int(os.environ.get('SURROGATE_MAX_AGE', 0))
+app.config["PURGE_URL"] = os.environ.get('PURGE_URL')
+app.config["PURGE_HOOK"] = None
+app.config["QUERY_STATS"] = bool(int(os.environ.get('QUERY_STATS', 0)))
+app.config["SLOW_REQUEST_MS"] = int(os.environ.get('SLOW_REQUEST_MS', 500))
+app.config["REPLICA_MAX_LAG"] = int(os.environ.get('REPLICA_MAX_LAG', 60))
+if os.environ.get('REPLICA_DATABASE_URL'):
+    app.config["SQLALCHEMY_BINDS"] = {'replica': os.environ['REPLICA_DATABASE_URL']}
 heroku = Heroku(app)
-db = SQLAlchemy(app)
+
+class RoutingSession(_SignallingSession):
+    ''' Session that reads from the "replica" bind during GET requests, if one is set.
+
+        Everything else, including run_update.py and any flush, uses the primary.
+        So does the rest of a transaction once it has flushed, to read its own writes.
+    '''
+    def __init__(self, db, **options):
+        self.db = db
+        _SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and not self.info.get('flushed') and use_replica(self.app):
+            return self.db.get_engine(self.app, 'replica')
+        return _SignallingSession.get_bind(self, mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    ''' Flask-SQLAlchemy with a RoutingSession.
+    '''
+    def create_scoped_session(self, options=None):
+        options = dict(options or {})
+        scopefunc = options.pop('scopefunc', None)
+        return scoped_session(partial(RoutingSession, self, **options), scopefunc=scopefunc)
+
+db = RoutingSQLAlchemy(app)
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -54,40 +106,288 @@ def add_cors_header(response):
 app.after_request(add_cors_header)
 
 
+# -------------------
+# Instrumentation
+# -------------------
+
+logger = logging.getLogger(__name__)
+
+def start_query_stats():
+    ''' Count SQL statements for this request, if QUERY_STATS is on.
+
+        Paths in a batch request count toward the batch.
+    '''
+    if current_app.config['QUERY_STATS'] and not hasattr(g, 'query_stats'):
+        g.query_stats = QueryStats()
+        g.query_stats_environ = request.environ
+        g.query_stats_started = time.time()
+
+def before_statement(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and has_app_context() and hasattr(g, 'query_stats'):
+        context.query_stats_started = time.time()
+
+def after_statement(conn, cursor, statement, parameters, context, executemany):
+    if hasattr(context, 'query_stats_started') and has_app_context() and hasattr(g, 'query_stats'):
+        g.query_stats.add(statement, time.time() - context.query_stats_started)
+
+def add_query_stats(response):
+    ''' Add X-Query-Count and Server-Timing headers, and log slow requests.
+
+        Requests slower than SLOW_REQUEST_MS, or running one statement shape
+        over and over, are logged as JSON with their statement fingerprints.
+        Streamed pages are only counted up to their first batch.
+    '''
+    if not hasattr(g, 'query_stats') or g.query_stats_environ is not request.environ:
+        return response
+
+    stats, seconds = g.query_stats, time.time() - g.query_stats_started
+    response.headers['X-Query-Count'] = str(stats.count)
+    response.headers['Server-Timing'] = stats.server_timing(seconds)
+
+    # Statements are only reduced to shapes for requests that get logged.
+    if seconds * 1000 >= current_app.config['SLOW_REQUEST_MS'] or stats.has_repeats():
+        shapes = stats.shapes()
+        logger.warning(json.dumps(dict(
+            method=request.method, path=request.full_path.rstrip('?'), status=response.status_code,
+            ms=round(seconds * 1000, 1), db_ms=round(stats.seconds * 1000, 1), queries=stats.count,
+            repeated=[shape['fingerprint'] for shape in stats.repeated(shapes)], statements=shapes[:10]),
+            sort_keys=True))
+
+    return response
+
+app.before_request(start_query_stats)
+app.after_request(add_query_stats)
+db.event.listen(Engine, 'before_cursor_execute', before_statement)
+db.event.listen(Engine, 'after_cursor_execute', after_statement)
+
+
 # -------------------
 # Types
 # -------------------
 
-class JsonType(Mutable, types.TypeDecorator):
-    ''' JSON wrapper type for TEXT database storage.
+class JSONB(types.UserDefinedType):
+    ''' Postgres binary JSON storage.
+    '''
+    def get_col_spec(self):
+        return 'JSONB'
+
+class JsonText(ColumnElement):
+    ''' A JSON column selected as text, so psycopg2 leaves decoding to JsonType.
+    '''
+    def __init__(self, column):
+        self.column = column
+        self.type = column.type
+
+    @property
+    def _from_objects(self):
+        return self.column._from_objects
+
+@compiles(JsonText)
+def compile_json_text(element, compiler, **kw):
+    return compiler.process(element.column, **kw)
+
+@compiles(JsonText, 'postgresql')
+def compile_json_text_postgresql(element, compiler, **kw):
+    return 'CAST(%s AS TEXT)' % compiler.process(element.column, **kw)
+
+class JsonPath(ColumnElement):
+    ''' The text at a path of keys in a JSON column, extracted in SQL.
+    '''
+    type = types.Unicode()
+
+    def __init__(self, column, keys):
+        self.column = column
+        self.keys = keys
+
+    @property
+    def _from_objects(self):
+        return self.column._from_objects
+
+@compiles(JsonPath)
+def compile_json_path(element, compiler, **kw):
+    # json_extract() keeps JSON types, but Postgres's #>> always gives text.
+    path = '$' + ''.join('[%d]' % key if isinstance(key, int) else '."%s"' % key for key in element.keys)
+    return 'CAST(json_extract(%s, %s) AS TEXT)' % (compiler.process(element.column, **kw), compiler.process(literal(path), **kw))
+
+@compiles(JsonPath, 'postgresql')
+def compile_json_path_postgresql(element, compiler, **kw):
+    path = '{%s}' % ','.join(unicode(key) for key in element.keys)
+    return '(%s #>> %s)' % (compiler.process(element.column, **kw), compiler.process(literal(path), **kw))
+
+class JsonArray(FromClause):
+    ''' A table of the integers in each row's JSON array column, as value.
+
+        Select value, and the column's own table comes before it in FROM.
+    '''
+    named_with_column = True
+
+    def __init__(self, column, name):
+        self.column = column
+        self.name = name
+        self.value = JsonArrayValue(self)
+
+    @property
+    def _from_objects(self):
+        return self.column._from_objects + [self]
+
+class JsonArrayValue(ColumnElement):
+    ''' One integer from a JsonArray.
+    '''
+    type = types.Integer()
+
+    def __init__(self, array):
+        self.array = array
+
+    @property
+    def _from_objects(self):
+        return self.array._from_objects
+
+@compiles(JsonArray)
+def compile_json_array(element, compiler, **kw):
+    return 'json_each(%s) AS %s' % (compiler.process(element.column, **kw), element.name)
+
+@compiles(JsonArray, 'postgresql')
+def compile_json_array_postgresql(element, compiler, **kw):
+    return 'jsonb_array_elements_text(%s) AS %s (value)' % (compiler.process(element.column, **kw), element.name)
+
+@compiles(JsonArrayValue)
+def compile_json_array_value(element, compiler, **kw):
+    return '%s.value' % element.array.name
+
+@compiles(JsonArrayValue, 'postgresql')
+def compile_json_array_value_postgresql(element, compiler, **kw):
+    return 'CAST(%s.value AS INTEGER)' % element.array.name
+
+class LazyJson(object):
+    ''' JSON text from the database, decoded the first time its value is used.
+    '''
+    def __init__(self, text):
+        self.text = text
+
+    @property
+    def value(self):
+        if not hasattr(self, '_value'):
+            self._value = json.loads(self.text)
+        return self._value
+
+    def __eq__(self, other):
+        if isinstance(other, LazyJson):
+            if self.text == other.text:
+                return True
+            other = other.value
+        return self.value == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'LazyJson(%r)' % self.text
+
+class LazyJsonObject(LazyJson, Mapping):
+    ''' A JSON object from the database, usable as a read-only dict once decoded.
+    '''
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+class LazyJsonArray(LazyJson, Sequence):
+    ''' A JSON array from the database, usable as a read-only list once decoded.
+    '''
+    def __getitem__(self, index):
+        return self.value[index]
+
+    def __len__(self):
+        return len(self.value)
+
+class JsonType(types.TypeDecorator):
+    ''' JSON wrapper type, stored as JSONB on Postgres and TEXT elsewhere.
+
+        With lazy=True, objects and arrays come back as LazyJson, decoded only
+        when used, so rows loaded for other columns don't pay for them. They
+        are read-only Mappings and Sequences, so indexing them just works.
+        Use column.path(key, ...) to pick out values in SQL, as text on every
+        database. like() and ilike() match the JSON text.
 
         References:
         http://stackoverflow.com/questions/4038314/sqlalchemy-json-as-blob-text
-        http://docs.sqlalchemy.org/en/rel_0_9/orm/extensions/mutable.html
+        http://www.postgresql.org/docs/9.4/static/functions-json.html
     '''
     impl = types.Unicode
 
+    class comparator_factory(types.Unicode.Comparator):
+        def path(self, *keys):
+            return JsonPath(self.expr, keys)
+
+        def operate(self, op, *other, **kwargs):
+            # JSONB has no LIKE, so attribute filters match its text.
+            if op in (operators.like_op, operators.ilike_op, operators.notlike_op, operators.notilike_op):
+                return op(cast(self.expr, types.UnicodeText), *other, **kwargs)
+            return types.Unicode.Comparator.operate(self, op, *other, **kwargs)
+
+    def __init__(self, lazy=False):
+        types.TypeDecorator.__init__(self)
+        self.lazy = lazy
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(JSONB())
+        return dialect.type_descriptor(types.Unicode())
+
+    def column_expression(self, column):
+        return JsonText(column)
+
     def process_bind_param(self, value, engine):
+        if isinstance(value, LazyJson):
+            return unicode(value.text)
         return unicode(json.dumps(value))
 
     def process_result_value(self, value, engine):
-        if value:
-            return json.loads(value)
-        else:
+        if not value:
             # default can also be a list
             return {}
+        elif self.lazy and value[:1] == '{':
+            # Only objects and arrays are worth putting off.
+            return LazyJsonObject(value)
+        elif self.lazy and value[:1] == '[':
+            return LazyJsonArray(value)
+        else:
+            return json.loads(value)
+
+class ApiJSONEncoder(JSONEncoder):
+    ''' Flask's JSON encoder, plus LazyJson values.
+    '''
+    def default(self, o):
+        if isinstance(o, LazyJson):
+            return o.value
+        return JSONEncoder.default(self, o)
+
+app.json_encoder = ApiJSONEncoder
 
 
 # -------------------
 # Models
 # -------------------
 
+def deferred_columns(obj):
+    ''' Return the keys of columns left unloaded with load_only(), not expired.
+    '''
+    state = inspect(obj)
+    if not state.has_identity:
+        return []
+    return list(state.unloaded - state.expired_attributes)
+
 class Organization(db.Model):
     '''
         Brigades and other civic tech organizations
     '''
     #Columns
     name = db.Column(db.Unicode(), primary_key=True)
+    slug = db.Column(db.Unicode(), unique=True, index=True)
     website = db.Column(db.Unicode())
     events_url = db.Column(db.Unicode())
     rss = db.Column(db.Unicode())
@@ -105,9 +405,18 @@ class Organization(db.Model):
     stories = db.relationship('Story', cascade='save-update, delete')
     projects = db.relationship('Project', cascade='save-update, delete')
 
+    # Link fields in asdict(), with their paths under api_url
+    links = (('all_events', '/events'), ('all_projects', '/projects'), ('all_stories', '/stories'),
+             ('all_issues', '/issues'), ('upcoming_events', '/upcoming_events'),
+             ('past_events', '/past_events'), ('api_url', ''))
+
+    # Extra fields in asdict(True), each from a method of the same name
+    extras = ('current_events', 'current_projects', 'current_stories')
+
     def __init__(self, name, website=None, events_url=None,
                  rss=None, projects_list_url=None, type=None, city=None, latitude=None, longitude=None):
         self.name = name
+        self.slug = safe_name(name)
         self.website = website
         self.events_url = events_url
         self.rss = rss
@@ -134,7 +443,8 @@ class Organization(db.Model):
         '''
             Return the three most current projects
         '''
-        current_projects = Project.query.filter_by(organization_name=self.name).order_by(desc(Project.last_updated)).limit(3)
+        current_projects = Project.query.filter_by(organization_name=self.name).order_by(desc(Project.last_updated)).limit(3).all()
+        load_children(current_projects, 'issues', Issue, Issue.project_id, current_app.config['EMBEDDED_ISSUES'])
         current_projects_json = [project.asdict() for project in current_projects]
 
         return current_projects_json
@@ -150,71 +460,62 @@ class Organization(db.Model):
     def all_events(self):
         ''' API link to all an orgs events
         '''
-        # Make a nice org name
-        organization_name = safe_name(self.name)
-        return '%s://%s/api/organizations/%s/events' % (request.scheme, request.host, organization_name)
+        return self.api_url() + '/events'
 
     def upcoming_events(self):
         ''' API link to an orgs upcoming events
         '''
-        # Make a nice org name
-        organization_name = safe_name(self.name)
-        return '%s://%s/api/organizations/%s/upcoming_events' % (request.scheme, request.host, organization_name)
+        return self.api_url() + '/upcoming_events'
 
     def past_events(self):
         ''' API link to an orgs past events
         '''
-        # Make a nice org name
-        organization_name = safe_name(self.name)
-        return '%s://%s/api/organizations/%s/past_events' % (request.scheme, request.host, organization_name)
+        return self.api_url() + '/past_events'
 
     def all_projects(self):
         ''' API link to all an orgs projects
         '''
-        # Make a nice org name
-        organization_name = safe_name(self.name)
-        return '%s://%s/api/organizations/%s/projects' % (request.scheme, request.host, organization_name)
+        return self.api_url() + '/projects'
 
     def all_issues(self):
         '''API link to all an orgs issues
         '''
-        # Make a nice org name
-        organization_name = safe_name(self.name)
-        return '%s://%s/api/organizations/%s/issues' % (request.scheme, request.host, organization_name)
+        return self.api_url() + '/issues'
 
     def all_stories(self):
         ''' API link to all an orgs stories
         '''
-        # Make a nice org name
-        organization_name = safe_name(self.name)
-        return '%s://%s/api/organizations/%s/stories' % (request.scheme, request.host, organization_name)
+        return self.api_url() + '/stories'
 
     def api_id(self):
         ''' Return organization name made safe for use in a URL.
         '''
-        return safe_name(self.name)
+        return self.slug
 
     def api_url(self):
         ''' API link to itself
         '''
-        return '%s://%s/api/organizations/%s' % (request.scheme, request.host, self.api_id())
+        return '%s/api/organizations/%s' % (base_url(), self.slug)
 
     def asdict(self, include_extras=False):
         ''' Return Organization as a dictionary, with some properties tweaked.
 
-            Optionally include linked projects, events, and stories.
+            Optionally include linked projects, events, and stories, or
+            just the extras named in a list. Columns left unloaded are skipped.
         '''
-        organization_dict = db.Model.asdict(self)
+        organization_dict = db.Model.asdict(self, exclude=deferred_columns(self))
 
-        del organization_dict['keep']
+        organization_dict.pop('keep', None)
 
-        for key in ('all_events', 'all_projects', 'all_stories', 'all_issues',
-                    'upcoming_events', 'past_events', 'api_url'):
-            organization_dict[key] = getattr(self, key)()
+        api_url = self.api_url()
+        for (key, path) in Organization.links:
+            organization_dict[key] = api_url + path
 
         if include_extras:
-            for key in ('current_events', 'current_projects', 'current_stories'):
-                organization_dict[key] = getattr(self, key)()
+            # Extras may have been batch-loaded for a whole page by load_extras()
+            extras = getattr(self, 'loaded_extras', None) or dict()
+            for key in (Organization.extras if include_extras is True else include_extras):
+                organization_dict[key] = extras[key] if key in extras else getattr(self, key)()
 
         return organization_dict
 
@@ -233,6 +534,11 @@ class Story(db.Model):
     organization = db.relationship('Organization', single_parent=True, cascade='all, delete-orphan')
     organization_name = db.Column(db.Unicode(), db.ForeignKey('organization.name', ondelete='CASCADE'))
 
+    # Indexes for organization lists and run_update.py's lookups by link
+    __table_args__ = (
+        db.Index('ix_story_organization_name_link', 'organization_name', 'link'),
+        )
+
     def __init__(self, title=None, link=None, type=None, organization_name=None):
         self.title = title
         self.link = link
@@ -243,20 +549,20 @@ class Story(db.Model):
     def api_url(self):
         ''' API link to itself
         '''
-        return '%s://%s/api/stories/%s' % (request.scheme, request.host, str(self.id))
+        return '%s/api/stories/%s' % (base_url(), self.id)
 
     def asdict(self, include_organization=False):
         ''' Return Story as a dictionary, with some properties tweaked.
 
-            Optionally include linked organization.
+            Optionally include linked organization. Columns left unloaded are skipped.
         '''
-        story_dict = db.Model.asdict(self)
+        story_dict = db.Model.asdict(self, exclude=deferred_columns(self))
 
-        del story_dict['keep']
+        story_dict.pop('keep', None)
         story_dict['api_url'] = self.api_url()
 
         if include_organization:
-            story_dict['organization'] = self.organization.asdict()
+            story_dict['organization'] = asdict_memo.asdict(self.organization)
 
         return story_dict
 
@@ -272,17 +578,28 @@ class Project(db.Model):
     description = db.Column(db.Unicode())
     type = db.Column(db.Unicode())
     categories = db.Column(db.Unicode())
-    github_details = db.Column(JsonType())
+    github_details = db.Column(JsonType(lazy=True))
     last_updated = db.Column(db.DateTime())
     last_updated_issues = db.Column(db.Unicode())
     keep = db.Column(db.Boolean())
 
+    # Number of issues, kept up to date by count_issues()
+    issues_count = db.Column(db.Integer(), default=0)
+
     # Relationships
     organization = db.relationship('Organization', single_parent=True, cascade='all, delete-orphan')
     organization_name = db.Column(db.Unicode(), db.ForeignKey('organization.name', ondelete='CASCADE'))
 
+    # Indexes for lists newest first, and run_update.py's lookups by name and code_url
+    __table_args__ = (
+        db.Index('ix_project_organization_name_last_updated', 'organization_name', 'last_updated'),
+        db.Index('ix_project_last_updated', 'last_updated'),
+        db.Index('ix_project_name_organization_name', 'name', 'organization_name'),
+        db.Index('ix_project_code_url', 'code_url')
+        )
+
     # Issue has cascade so issues are deleted with their parent projects
-    issues = db.relationship('Issue', cascade='save-update, delete')
+    issues = db.relationship('Issue', cascade='save-update, delete', order_by='Issue.id')
 
     def __init__(self, name, code_url=None, link_url=None,
                  description=None, type=None, categories=None,
@@ -303,22 +620,31 @@ class Project(db.Model):
     def api_url(self):
         ''' API link to itself
         '''
-        return '%s://%s/api/projects/%s' % (request.scheme, request.host, str(self.id))
+        return '%s/api/projects/%s' % (base_url(), self.id)
 
-    def asdict(self, include_organization=False):
+    def asdict(self, include_organization=False, include_issues=True):
         ''' Return Project as a dictionary, with some properties tweaked.
 
-            Optionally include linked organization.
+            Optionally include linked organization and the first
+            EMBEDDED_ISSUES issues, the rest being at issues_url.
         '''
         project_dict = db.Model.asdict(self)
 
         del project_dict['keep']
         project_dict['api_url'] = self.api_url()
+        project_dict['issues_url'] = self.api_url() + '/issues'
 
         if include_organization:
-            project_dict['organization'] = self.organization.asdict()
+            project_dict['organization'] = asdict_memo.asdict(self.organization)
 
-        project_dict['issues'] = [o.asdict() for o in db.session.query(Issue).filter(Issue.project_id == project_dict['id']).all()]
+        if include_issues:
+            limit = current_app.config['EMBEDDED_ISSUES']
+            if 'issues' in inspect(self).unloaded:
+                # Don't lazy load every issue to embed the first few.
+                issues = Issue.query.filter(Issue.project_id == self.id).order_by(Issue.id).limit(limit).all()
+            else:
+                issues = self.issues[:limit]
+            project_dict['issues'] = [o.asdict() for o in issues]
 
         return project_dict
 
@@ -334,11 +660,21 @@ class Issue(db.Model):
     body = db.Column(db.Unicode())
     keep = db.Column(db.Boolean())
 
+    # Random sort key for seeded shuffles, refreshed by run_update.py
+    shuffle_key = db.Column(db.Float(), default=random)
+
     # Relationships
     project = db.relationship('Project', single_parent=True, cascade='all, delete-orphan')
     project_id = db.Column(db.Integer(), db.ForeignKey('project.id', ondelete='CASCADE'))
 
-    labels = db.relationship('Label', cascade='save-update, delete')
+    # Index for a project's issues, and run_update.py's lookups by title,
+    # and one to read seeded shuffles in order
+    __table_args__ = (
+        db.Index('ix_issue_project_id_title', 'project_id', 'title'),
+        db.Index('ix_issue_shuffle_key_id', 'shuffle_key', 'id'),
+        )
+
+    labels = db.relationship('Label', cascade='save-update, delete', order_by='Label.id')
 
     def __init__(self, title, project_id=None, html_url=None, labels=None, body=None):
         self.title = title
@@ -350,23 +686,23 @@ class Issue(db.Model):
     def api_url(self):
         ''' API link to itself
         '''
-        return '%s://%s/api/issues/%s' % (request.scheme, request.host, str(self.id))
+        return '%s/api/issues/%s' % (base_url(), self.id)
 
-    def asdict(self, include_project=False):
+    def asdict(self, include_project=False, include_labels=True):
         '''
             Return issue as a dictionary with some properties tweaked
         '''
         issue_dict = db.Model.asdict(self)
 
-        # TODO: Also paged_results assumes asdict takes this argument, should be checked and fixed later
         if include_project:
-            issue_dict['project'] = db.session.query(Project).filter(Project.id == self.project_id).first().asdict()
-            del issue_dict['project']['issues']
+            issue_dict['project'] = asdict_memo.asdict(self.project, include_issues=False)
             del issue_dict['project_id']
 
         del issue_dict['keep']
+        del issue_dict['shuffle_key']
         issue_dict['api_url'] = self.api_url()
-        issue_dict['labels'] = [l.asdict() for l in self.labels]
+        if include_labels:
+            issue_dict['labels'] = [l.asdict() for l in self.labels]
 
         return issue_dict
 
@@ -383,6 +719,11 @@ class Label(db.Model):
     issue = db.relationship('Issue', single_parent=True, cascade='all, delete-orphan')
     issue_id = db.Column(db.Integer, db.ForeignKey('issue.id', ondelete='CASCADE'))
 
+    # Index for an issue's labels
+    __table_args__ = (
+        db.Index('ix_label_issue_id_name', 'issue_id', 'name'),
+        )
+
     def __init__(self, name, color, url, issue_id=None):
         self.name = name
         self.color = color
@@ -400,6 +741,44 @@ class Label(db.Model):
 
         return label_dict
 
+class LabelIndex(db.Model):
+    '''
+        Sorted ids of the issues with each label, per organization.
+
+        Names are lowercased. run_update.py rebuilds it with index_labels().
+    '''
+    # Columns
+    organization_name = db.Column(db.Unicode(), db.ForeignKey('organization.name', ondelete='CASCADE'), primary_key=True)
+    name = db.Column(db.Unicode(), primary_key=True)
+    issue_ids = db.Column(JsonType())
+
+def index_labels(session, organization_name):
+    ''' Rebuild one organization's label index from its issues' labels.
+    '''
+    # Sessions don't autoflush, and pending labels need to be counted.
+    session.flush()
+
+    labels = session.query(Label.name, Label.issue_id).join(Label.issue).join(Issue.project)
+    labels = labels.filter(Project.organization_name == organization_name, Label.name != None)
+
+    issue_ids = defaultdict(set)
+    for (name, issue_id) in labels:
+        issue_ids[name.lower()].add(issue_id)
+
+    session.query(LabelIndex).filter(LabelIndex.organization_name == organization_name).delete()
+
+    for (name, ids) in issue_ids.items():
+        session.add(LabelIndex(organization_name=organization_name, name=name, issue_ids=sorted(ids)))
+
+def count_issues(session, organization_name):
+    ''' Store the number of issues of each of one organization's projects.
+    '''
+    # Sessions don't autoflush, and pending issues need to be counted.
+    session.flush()
+
+    count = select([func.count(Issue.id)]).where(Issue.project_id == Project.id).as_scalar()
+    session.execute(db.update(Project, values={'issues_count': count}).where(Project.organization_name == organization_name))
+
 class Event(db.Model):
     '''
         Organizations events from Meetup
@@ -420,6 +799,12 @@ class Event(db.Model):
     organization = db.relationship('Organization', single_parent=True, cascade='all, delete-orphan')
     organization_name = db.Column(db.Unicode(), db.ForeignKey('organization.name', ondelete='CASCADE'))
 
+    # Indexes for upcoming and past events, of one organization or all of them
+    __table_args__ = (
+        db.Index('ix_event_organization_name_start_time_notz', 'organization_name', 'start_time_notz'),
+        db.Index('ix_event_start_time_notz', 'start_time_notz')
+        )
+
     def __init__(self, name, event_url, start_time_notz, created_at, utc_offset,
                  organization_name, location=None, end_time_notz=None, description=None):
         self.name = name
@@ -433,30 +818,31 @@ class Event(db.Model):
         self.created_at = created_at
         self.keep = True
 
-    def start_time(self):
-        ''' Get a string representation of the start time with UTC offset.
+    @staticmethod
+    def format_time(time_notz, utc_offset):
+        ''' Get a string representation of a time with UTC offset.
         '''
-        if self.start_time_notz is None:
+        if time_notz is None:
             return None
-        tz = tzoffset(None, self.utc_offset)
-        st = self.start_time_notz
-        dt = datetime(st.year, st.month, st.day, st.hour, st.minute, st.second, tzinfo=tz)
+        tz = tzoffset(None, utc_offset)
+        t = time_notz
+        dt = datetime(t.year, t.month, t.day, t.hour, t.minute, t.second, tzinfo=tz)
         return dt.strftime('%Y-%m-%d %H:%M:%S %z')
 
+    def start_time(self):
+        ''' Get a string representation of the start time with UTC offset.
+        '''
+        return Event.format_time(self.start_time_notz, self.utc_offset)
+
     def end_time(self):
         ''' Get a string representation of the end time with UTC offset.
         '''
-        if self.end_time_notz is None:
-            return None
-        tz = tzoffset(None, self.utc_offset)
-        et = self.end_time_notz
-        dt = datetime(et.year, et.month, et.day, et.hour, et.minute, et.second, tzinfo=tz)
-        return dt.strftime('%Y-%m-%d %H:%M:%S %z')
+        return Event.format_time(self.end_time_notz, self.utc_offset)
 
     def api_url(self):
         ''' API link to itself
         '''
-        return '%s://%s/api/events/%s' % (request.scheme, request.host, str(self.id))
+        return '%s/api/events/%s' % (base_url(), self.id)
 
     def asdict(self, include_organization=False):
         ''' Return Event as a dictionary, with some properties tweaked.
@@ -472,7 +858,7 @@ class Event(db.Model):
             event_dict[key] = getattr(self, key)()
 
         if include_organization:
-            event_dict['organization'] = self.organization.asdict()
+            event_dict['organization'] = asdict_memo.asdict(self.organization)
 
         return event_dict
 
@@ -485,247 +871,1753 @@ class Error(db.Model):
     error = db.Column(db.Unicode())
     time = db.Column(db.DateTime(False))
 
+class Generation(db.Model):
+    '''
+        Counts updates from run_update.py, per organization slug and overall.
+
+        The overall counter has a blank name.
+    '''
+    # Columns
+    name = db.Column(db.Unicode(), primary_key=True)
+    counter = db.Column(db.Integer(), default=0, nullable=False)
+    updated = db.Column(db.Integer())
+
+def bump_generations(session, *organization_names):
+    ''' Count an update to the named organizations, and to the overall counter.
+    '''
+    updated = int(time.time())
+
+    for name in set([u''] + [safe_name(name) for name in organization_names]):
+        query = session.query(Generation).filter(Generation.name == name)
+        values = {Generation.counter: Generation.counter + 1, Generation.updated: updated}
+        if not query.update(values, synchronize_session=False):
+            session.add(Generation(name=name, counter=1, updated=updated))
+
+class ReplicaLag(object):
+    ''' Seconds of updates the read replica is missing, measured every few seconds.
+
+        Compares the overall Generation update time on the primary and the
+        replica, so a replica that can't be reached counts as infinitely behind.
+    '''
+    interval = 5
+
+    def __init__(self):
+        self.lock = Lock()
+        self.checked, self.lag = None, None
+
+    def seconds(self, primary, replica):
+        with self.lock:
+            if self.checked is None or time.time() - self.checked >= self.interval:
+                self.lag, self.checked = self.measure(primary, replica), time.time()
+            return self.lag
+
+    @staticmethod
+    def measure(primary, replica):
+        query = select([Generation.updated]).where(Generation.name == u'')
+        try:
+            newest, seen = primary.execute(query).scalar(), replica.execute(query).scalar()
+        except SQLAlchemyError:
+            return float('inf')
+
+        if newest is None:
+            return 0
+        if seen is None:
+            return float('inf')
+        return max(0, newest - seen)
+
+    def clear(self):
+        with self.lock:
+            self.checked, self.lag = None, None
+
+replica_lag = ReplicaLag()
+
+def use_replica(app):
+    ''' Return True if reads for this request should go to the read replica.
+
+        Only GET and HEAD requests read from it, and only while it is within
+        REPLICA_MAX_LAG seconds of the primary. Decided once per request.
+    '''
+    if not has_request_context() or request.method not in ('GET', 'HEAD'):
+        return False
+    if 'replica' not in (app.config.get('SQLALCHEMY_BINDS') or {}):
+        return False
+    if not hasattr(g, 'use_replica'):
+        lag = replica_lag.seconds(db.get_engine(app), db.get_engine(app, 'replica'))
+        g.use_replica = lag <= app.config['REPLICA_MAX_LAG']
+    return g.use_replica
+
+def note_flush(session, flush_context):
+    session.info['flushed'] = True
+
+def note_bulk_write(update_context):
+    note_flush(update_context.session, None)
+
+def forget_flush(session, transaction):
+    if session.transaction is None:
+        session.info.pop('flushed', None)
+
+db.event.listen(RoutingSession, 'after_flush', note_flush)
+db.event.listen(RoutingSession, 'after_bulk_update', note_bulk_write)
+db.event.listen(RoutingSession, 'after_bulk_delete', note_bulk_write)
+db.event.listen(RoutingSession, 'after_transaction_end', forget_flush)
+
 # -------------------
-# API
+# Search
 # -------------------
 
-def page_info(query, page, limit):
-    ''' Return last page and offset for a query.
-    '''
-    # Get a bunch of projects.
-    total = query.count()
-    last = int(ceil(total / limit))
-    offset = (page - 1) * limit
+# Searchable models, with the text columns each one is searched by.
+SEARCHABLE = (
+    ('project', Project, ('name', 'description', 'categories')),
+    ('issue', Issue, ('title', 'body')),
+    ('story', Story, ('title', ))
+    )
 
-    return last, offset
+def search_vector_sql(columns):
+    ''' Return SQL for a Postgres text search vector over some columns.
 
-def pages_dict(page, last, querystring):
-    ''' Return a dictionary of pages to return in API responses.
+        The GIN index and search queries share it, so the planner can match them.
     '''
-    url = '%s://%s%s' % (request.scheme, request.host, request.path)
+    document = " || ' ' || ".join("coalesce(%s, '')" % name for name in columns)
+    return "to_tsvector('english', %s)" % document
 
-    pages = dict()
+def search_index_ddl(dialect_name, name, columns):
+    ''' Return statements that create the full-text index for a table.
 
-    if page > 1:
-        pages['first'] = dict()
-        pages['prev'] = dict()
-        if 'per_page' in request.args:
-            pages['first']['per_page'] = request.args['per_page']
-            pages['prev']['per_page'] = request.args['per_page']
+        Postgres uses a GIN expression index. SQLite uses an FTS5 table over
+        the same rows, kept current by triggers.
+    '''
+    if dialect_name == 'postgresql':
+        return ['CREATE INDEX ix_%s_search ON %s USING gin (%s)' % (name, name, search_vector_sql(columns))]
 
-    if page > 2:
-        pages['prev']['page'] = page - 1
+    if dialect_name != 'sqlite':
+        return []
 
-    if page < last:
-        pages['next'] = {'page': page + 1}
-        pages['last'] = {'page': last}
-        if 'per_page' in request.args:
-            pages['next']['per_page'] = request.args['per_page']
-            pages['last']['per_page'] = request.args['per_page']
+    fts = '%s_search' % name
+    names = ', '.join(columns)
+    new_values = ', '.join('new.%s' % c for c in columns)
+    old_values = ', '.join('old.%s' % c for c in columns)
 
-    for key in pages:
-        if querystring != '':
-            pages[key] = '%s?%s&%s' % (url, urlencode(pages[key]), querystring) if pages[key] else url
-        else:
-            pages[key] = '%s?%s' % (url, urlencode(pages[key])) if pages[key] else url
+    insert = "INSERT INTO %s (rowid, %s) VALUES (new.id, %s);" % (fts, names, new_values)
+    delete = "INSERT INTO %s (%s, rowid, %s) VALUES ('delete', old.id, %s);" % (fts, fts, names, old_values)
 
-    return pages
+    return [
+        "CREATE VIRTUAL TABLE %s USING fts5(%s, content='%s', content_rowid='id', tokenize='porter unicode61')" % (fts, names, name),
+        'CREATE TRIGGER %s_insert AFTER INSERT ON %s BEGIN %s END' % (fts, name, insert),
+        'CREATE TRIGGER %s_delete AFTER DELETE ON %s BEGIN %s END' % (fts, name, delete),
+        'CREATE TRIGGER %s_update AFTER UPDATE OF %s ON %s BEGIN %s %s END' % (fts, names, name, delete, insert)
+        ]
 
-def paged_results(query, page, per_page, querystring=''):
+def create_search_index(target, connection, **kw):
+    ''' Create the full-text index along with its table.
     '''
+    for (name, model, columns) in SEARCHABLE:
+        if model.__table__ is target:
+            for statement in search_index_ddl(connection.dialect.name, name, columns):
+                connection.execute(statement)
+
+def drop_search_index(target, connection, **kw):
+    ''' Drop SQLite's separate full-text table along with its table.
     '''
-    total = query.count()
-    last, offset = page_info(query, page, per_page)
-    model_dicts = [o.asdict(True) for o in query.limit(per_page).offset(offset)]
+    if connection.dialect.name == 'sqlite':
+        connection.execute('DROP TABLE IF EXISTS %s_search' % target.name)
 
-    return dict(total=total, pages=pages_dict(page, last, querystring), objects=model_dicts)
+for (name, model, columns) in SEARCHABLE:
+    db.event.listen(model.__table__, 'after_create', create_search_index)
+    db.event.listen(model.__table__, 'before_drop', drop_search_index)
 
-def is_safe_name(name):
-    ''' Return True if the string is a safe name.
+def has_extension(connection, name):
+    ''' Return True if a Postgres extension is installed.
     '''
-    return raw_name(safe_name(name)) == name
+    return bool(connection.execute('SELECT 1 FROM pg_extension WHERE extname = %s', name).scalar())
 
-def safe_name(name):
-    ''' Return URL-safe organization name with spaces replaced by dashes.
+# Columns that ilike filters hit, with trigram indexes where Postgres has pg_trgm.
+TRIGRAM_INDEXED = (
+    (Organization, ('name', 'type', 'city')),
+    (Project, ('name', 'type', 'categories')),
+    (Issue, ('title', )),
+    (Event, ('name', )),
+    (Story, ('title', ))
+    )
 
-        Slashes will be removed, which is incompatible with raw_name().
+def create_trigram_indexes(target, connection, **kw):
+    ''' Create trigram indexes along with their table, if pg_trgm is installed.
+
+        They let Postgres answer ilike('%value%') filters from an index.
     '''
-    return name.replace(' ', '-').replace('/', '-').replace('?','-').replace('#','-')
+    if connection.dialect.name != 'postgresql' or not has_extension(connection, 'pg_trgm'):
+        return
 
-def raw_name(name):
-    ''' Return raw organization name with dashes replaced by spaces.
+    for (model, columns) in TRIGRAM_INDEXED:
+        if model.__table__ is target:
+            for name in columns:
+                connection.execute('CREATE INDEX ix_%s_%s_trgm ON %s USING gin (%s gin_trgm_ops)' % (target.name, name, target.name, name))
 
-        Also replace old-style underscores with spaces.
+for (model, columns) in TRIGRAM_INDEXED:
+    db.event.listen(model.__table__, 'after_create', create_trigram_indexes)
+
+def location_index_ddl(dialect_name, earthdistance=False):
+    ''' Return statements that create the spatial index over organization locations.
+
+        Postgres indexes earthdistance points with GiST when that extension
+        is installed, and latitude then longitude otherwise. SQLite uses an
+        R*Tree of located organizations, kept current by triggers.
     '''
-    return name.replace('_', ' ').replace('-', ' ')
+    if dialect_name == 'postgresql' and earthdistance:
+        return ['CREATE INDEX ix_organization_location ON organization USING gist (ll_to_earth(latitude, longitude))']
+
+    if dialect_name != 'sqlite':
+        return ['CREATE INDEX ix_organization_location ON organization (latitude, longitude)']
+
+    insert = ('INSERT INTO organization_location (minlon, maxlon, minlat, maxlat, name) '
+              'SELECT new.longitude, new.longitude, new.latitude, new.latitude, new.name '
+              'WHERE new.latitude IS NOT NULL AND new.longitude IS NOT NULL;')
+    delete = 'DELETE FROM organization_location WHERE name = old.name;'
+
+    return [
+        'CREATE VIRTUAL TABLE organization_location USING rtree(id, minlon, maxlon, minlat, maxlat, +name)',
+        'CREATE TRIGGER organization_location_insert AFTER INSERT ON organization BEGIN %s END' % insert,
+        'CREATE TRIGGER organization_location_delete AFTER DELETE ON organization BEGIN %s END' % delete,
+        'CREATE TRIGGER organization_location_update AFTER UPDATE OF name, latitude, longitude ON organization BEGIN %s %s END' % (delete, insert)
+        ]
+
+def create_location_index(target, connection, **kw):
+    ''' Create the spatial index along with the organization table.
+    '''
+    dialect_name = connection.dialect.name
+    earthdistance = dialect_name == 'postgresql' and has_extension(connection, 'earthdistance')
 
-def get_query_params(args):
-    filters = {}
-    for key,value in args.iteritems():
-        if 'page' not in key:
-            filters[key] = value
-    return filters, urlencode(filters)
+    for statement in location_index_ddl(dialect_name, earthdistance):
+        connection.execute(statement)
 
-@app.route('/api/organizations')
-@app.route('/api/organizations/<name>')
-def get_organizations(name=None):
-    ''' Regular response option for organizations.
+def drop_location_index(target, connection, **kw):
+    ''' Drop SQLite's separate R*Tree table along with the organization table.
     '''
+    if connection.dialect.name == 'sqlite':
+        connection.execute('DROP TABLE IF EXISTS organization_location')
 
-    filters = request.args
-    filters, querystring = get_query_params(request.args)
+db.event.listen(Organization.__table__, 'after_create', create_location_index)
+db.event.listen(Organization.__table__, 'before_drop', drop_location_index)
 
-    if name:
-        # Get one named organization.
-        filter = Organization.name == raw_name(name)
-        org = db.session.query(Organization).filter(filter).first()
-        return jsonify(org.asdict(True))
+def fts_query(q):
+    ''' Return an SQLite FTS5 query matching all the words in a search.
+    '''
+    return ' '.join('"%s"' % word.replace('"', '""') for word in q.split())
 
-    # Get a bunch of organizations.
-    query = db.session.query(Organization)
+def search_select(name, model, columns, q):
+    ''' Return a select of type, id and rank for one model's matches.
 
-    for attr, value in filters.iteritems():
-        query = query.filter(getattr(Organization, attr).ilike('%%%s%%' % value))
+        Higher ranks are better matches.
+    '''
+    if db.session.connection().dialect.name == 'postgresql':
+        vector = literal_column(search_vector_sql(columns))
+        query = func.plainto_tsquery('english', q)
+        rank = func.ts_rank(vector, query)
+        return select([literal(name).label('type'), model.id.label('id'), rank.label('rank')]).where(vector.op('@@')(query))
 
-    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 10)), querystring)
+    fts = table('%s_search' % name, column('rowid'))
+    fts_name = literal_column(fts.name)
+    rank = 0 - func.bm25(fts_name)
+    return select([literal(name).label('type'), fts.c.rowid.label('id'), rank.label('rank')]).where(fts_name.op('MATCH')(fts_query(q)))
 
-    return jsonify(response)
+# -------------------
+# Response cache
+# -------------------
 
-@app.route('/api/organizations.geojson')
-def get_organizations_geojson():
-    ''' GeoJSON response option for organizations.
+class ResponseCache(object):
+    ''' Least-recently-used store of API responses, with hit and miss counts.
+
+        Each entry remembers the update generation it was built under,
+        and is a miss once that generation has moved on.
     '''
-    geojson = dict(type='FeatureCollection', features=[])
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits, self.misses = 0, 0
+
+    def get(self, key, generation):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] != generation:
+                self.misses += 1
+                return None
+
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, generation, value, size):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (generation, value)
+            while len(self.entries) > size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits, self.misses = 0, 0
+
+response_cache = ResponseCache()
+
+# Response cache keys the view has answered with a 200, without their bodies
+accepted_keys = ResponseCache()
+
+class AsdictMemo(object):
+    ''' Dictionaries of embedded objects, built once per request, with hit and miss counts.
+
+        Entries live on flask.g under (table name, primary key, options),
+        so a page of 25 events from one organization shares a single
+        organization dictionary. Outside a request nothing is kept.
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.hits, self.misses = 0, 0
 
-    for org in db.session.query(Organization):
-        # The unique identifier of an organization.
-        id = org.api_id()
+    def entries(self):
+        if not has_app_context():
+            return None
+        if not hasattr(g, 'asdict_memo'):
+            g.asdict_memo = dict()
+        return g.asdict_memo
+
+    def get(self, key):
+        entries = self.entries()
+        value = entries.get(key) if entries is not None else None
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
 
-        # Pick out all the properties that aren't part of the location.
-        props = org.asdict()
+    def set(self, key, value):
+        entries = self.entries()
+        if entries is not None:
+            entries[key] = value
 
-        # GeoJSON Point geometry, http://geojson.org/geojson-spec.html#point
-        geom = dict(type='Point', coordinates=[org.longitude, org.latitude])
+    @staticmethod
+    def key(tablename, identity, **options):
+        return tablename, tuple(identity), tuple(sorted(options.items()))
 
-        feature = dict(type='Feature', id=id, properties=props, geometry=geom)
-        geojson['features'].append(feature)
+    def asdict(self, obj, **options):
+        ''' Return obj.asdict(**options), shared with earlier calls in this request.
+        '''
+        identity = inspect(obj).identity
+        if identity is None:
+            return obj.asdict(**options)
 
-    return jsonify(geojson)
+        key = self.key(obj.__tablename__, identity, **options)
+        value = self.get(key)
+        if value is None:
+            value = obj.asdict(**options)
+            self.set(key, value)
+        return value
 
-@app.route("/api/organizations/<organization_name>/events")
-def get_orgs_events(organization_name):
-    '''
-        A cleaner url for getting an organizations events
-        Better than /api/events?q={"filters":[{"name":"organization_name","op":"eq","val":"Code for San Francisco"}]}
-    '''
-    # Check org name
-    organization = Organization.query.filter_by(name=raw_name(organization_name)).first()
-    if not organization:
-        return "Organization not found", 404
+    def clear(self):
+        with self.lock:
+            self.hits, self.misses = 0, 0
 
-    # Get event objects
-    query = Event.query.filter_by(organization_name=organization.name)
-    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 25)))
-    return jsonify(response)
+asdict_memo = AsdictMemo()
 
-@app.route("/api/organizations/<organization_name>/upcoming_events")
-def get_upcoming_events(organization_name):
-    '''
-        Get events that occur in the future. Order asc.
-    '''
-    # Check org name
-    organization = Organization.query.filter_by(name=raw_name(organization_name)).first()
-    if not organization:
-        return "Organization not found", 404
-    # Get upcoming event objects
-    query = Event.query.filter(Event.organization_name == organization.name, Event.start_time_notz >= datetime.utcnow())
-    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 25)))
-    return jsonify(response)
+def current_generation(organization_name=None):
+    ''' Return the update counter and time for one organization, or for everything.
 
-@app.route("/api/organizations/<organization_name>/past_events")
-def get_past_events(organization_name):
+        The time falls back to Organization.last_updated before any counted
+        update. Both are looked up once per request.
     '''
-        Get events that occur in the past. Order desc.
+    slug = organization_slug(organization_name) if organization_name else u''
+    if not hasattr(g, 'generations'):
+        g.generations = dict()
+    if slug not in g.generations:
+        g.generations[slug] = select_generation(slug)
+    return g.generations[slug]
+
+def select_generation(slug):
+    ''' Return the update counter and time for an organization slug, or u'' for everything.
     '''
-    # Check org name
-    organization = Organization.query.filter_by(name=raw_name(organization_name)).first()
-    if not organization:
-        return "Organization not found", 404
-    # Get past event objects
-    query = Event.query.filter(Event.organization_name == organization.name, Event.start_time_notz < datetime.utcnow()).\
-            order_by(desc(Event.start_time_notz))
-    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 25)))
-    return jsonify(response)
+    generation = db.session.query(Generation).filter(Generation.name == slug)
+    last_updated = db.session.query(func.max(Organization.last_updated))
+    if slug:
+        last_updated = last_updated.filter(Organization.slug == slug)
 
-@app.route("/api/organizations/<organization_name>/stories")
-def get_orgs_stories(organization_name):
-    '''
-        A cleaner url for getting an organizations stories
+    # One round trip for all three.
+    counter, updated, last_updated = db.session.query(
+        generation.with_entities(Generation.counter).as_scalar().label('counter'),
+        generation.with_entities(Generation.updated).as_scalar().label('updated'),
+        last_updated.as_scalar().label('last_updated')).one()
+
+    return counter or 0, max(updated, last_updated)
+
+def unseeded_shuffle(id=None, **kwargs):
+    ''' Return True for issue lists in a fresh random order.
     '''
-    # Check org name
-    organization = Organization.query.filter_by(name=raw_name(organization_name)).first()
-    if not organization:
-        return "Organization not found", 404
+    return id is None and 'seed' not in request.args
 
-    # Get story objects
-    query = Story.query.filter_by(organization_name=organization.name)
-    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 25)))
-    return jsonify(response)
+def is_not_modified(etag, updated):
+    ''' Return True if the request's validators match the current response.
 
-@app.route("/api/organizations/<organization_name>/projects")
-def get_orgs_projects(organization_name):
+        If-None-Match wins over If-Modified-Since when both are sent.
     '''
-        A cleaner url for getting an organizations projects
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+
+    if request.if_modified_since and updated is not None:
+        return timegm(request.if_modified_since.utctimetuple()) >= updated
+
+    return False
+
+def organization_key(name):
+    ''' Return the surrogate key for everything about one organization.
     '''
-    # Check org name
-    organization = Organization.query.filter_by(name=raw_name(organization_name)).first()
-    if not organization:
-        return "Organization not found", 404
+    return 'organization/%s' % quote(safe_name(name).encode('utf8'))
 
-    # Get project objects
-    query = Project.query.filter_by(organization_name=organization.name).order_by(desc(Project.last_updated))
-    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 10)))
-    return jsonify(response)
+def tag_response(objects):
+    ''' Add surrogate keys for serialized model instances to this response.
 
-@app.route("/api/organizations/<organization_name>/issues")
-@app.route("/api/organizations/<organization_name>/issues/labels/<labels>")
-def get_orgs_issues(organization_name, labels=None):
-    ''' A clean url to get an organizations issues
+        Each instance adds its type, its own key, and its organization's key.
     '''
+    if not hasattr(g, 'surrogate_keys'):
+        g.surrogate_keys = set()
 
-    # Get one named organization.
-    organization = Organization.query.filter_by(name=raw_name(organization_name)).first()
-    if not organization:
-        return "Organization not found", 404
+    for obj in objects:
+        if obj is None:
+            continue
 
-    # Get that organization's projects
-    projects = Project.query.filter_by(organization_name=organization.name).all()
-    project_ids = [project.id for project in projects]
+        g.surrogate_keys.add(obj.__tablename__)
 
-    # Get all issues belonging to these projects
-    query = Issue.query.filter(Issue.project_id.in_(project_ids))
+        if isinstance(obj, Organization):
+            g.surrogate_keys.add(organization_key(obj.name))
+            continue
 
-    if labels:
-        # Create a labels list by comma separating the argument
-        labels = labels.split(',')
+        g.surrogate_keys.add('%s/%d' % (obj.__tablename__, obj.id))
 
-        # Create the filter for each label
-        labels = [Label.name.ilike('%%%s%%' % label) for label in labels]
+        if isinstance(obj, Issue):
+            organization_name = obj.project.organization_name if obj.project else None
+        else:
+            organization_name = obj.organization_name
 
-        # Create the base query object by joining on Issue.labels
-        query = query.join(Issue.labels)
+        if organization_name:
+            g.surrogate_keys.add(organization_key(organization_name))
 
-        # Filter for issues with each individual label
-        label_queries = [query.filter(L) for L in labels]
+def surrogate_key_header(organization_name=None, is_list=False):
+    ''' Return a Surrogate-Key header value for the keys tagged on this response.
 
-        # Intersect filters to find issues with all labels
-        query = query.intersect(*label_queries)
+        Organization views also get that organization's key. Lists outside
+        of one organization get a shared "lists" key, since an update to
+        any organization can change what they show.
+    '''
+    keys = set(getattr(g, 'surrogate_keys', ()))
 
-    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 10)))
-    return jsonify(response)
+    if organization_name:
+        keys.add(organization_key(organization_slug(organization_name)))
+    elif is_list:
+        keys.add('lists')
+
+    return ' '.join(sorted(keys))
+
+class HttpPurge(object):
+    ''' Purge hook that sends one HTTP PURGE request to a caching proxy.
+
+        Keys to purge go in its Surrogate-Key header.
+    '''
+    def __init__(self, url):
+        self.url = url
+
+    def __call__(self, keys):
+        response = requests.request('PURGE', self.url, headers={'Surrogate-Key': ' '.join(keys)})
+        response.raise_for_status()
+
+def purge_surrogate_keys(keys):
+    ''' Ask the caching proxy to drop responses tagged with any of these keys.
+
+        Uses the PURGE_HOOK callable if one is set, or HttpPurge with PURGE_URL.
+    '''
+    purge = app.config['PURGE_HOOK']
+
+    if purge is None and app.config['PURGE_URL']:
+        purge = HttpPurge(app.config['PURGE_URL'])
+
+    if purge is not None:
+        purge(sorted(keys))
+
+def cached_response(organization_arg=None, unless=None):
+    ''' Cache a view's successful responses until its data is updated.
+
+        Responses are keyed on URL and sorted query string. Views of one
+        organization name it in organization_arg, and are only invalidated
+        by updates to that organization. Pass an unless function of the
+        view arguments to skip caching for some requests.
+
+        Responses carry an ETag and Last-Modified from the same update
+        generation, and matching conditional requests get a 304. The view
+        runs first only until it has accepted the same arguments in that
+        generation, so requests it rejects get its error instead.
+        Cache-Control and Surrogate-Key headers let a caching proxy keep
+        them until purge_surrogate_keys() is called.
+    '''
+    def decorator(view):
+        def wrapped_view(**kwargs):
+            if unless and unless(**kwargs):
+                response = make_response(view(**kwargs))
+                response.cache_control.no_cache = True
+                return response
+
+            args = sorted((k.encode('utf8'), v.encode('utf8')) for (k, v) in request.args.items(multi=True))
+            key = '%s?%s' % (request.base_url.encode('utf8'), urlencode(args))
+            generation, updated = current_generation(kwargs.get(organization_arg))
+            etag = md5('%s %d' % (key, generation)).hexdigest()
+            size = current_app.config['RESPONSE_CACHE_SIZE']
+
+            not_modified = is_not_modified(etag, updated)
+
+            if not_modified and accepted_keys.get(key, generation):
+                # The view accepted these arguments in this generation, so it needn't run.
+                response = current_app.response_class(status=304)
+
+            else:
+                cached = response_cache.get(key, generation) if size > 0 else None
+                response = None
+
+                if cached is None:
+                    response = make_response(view(**kwargs))
+                    if response.status_code != 200:
+                        return response
+
+                    surrogate_key = surrogate_key_header(kwargs.get(organization_arg), 'id' not in kwargs)
+                    accepted_keys.set(key, generation, True, current_app.config['ACCEPTED_KEYS_SIZE'])
+
+                    # Streamed responses are never held in memory, so aren't cached.
+                    if size > 0 and not response.is_streamed:
+                        response_cache.set(key, generation, (response.get_data(), response.mimetype, surrogate_key), size)
+
+                else:
+                    data, mimetype, surrogate_key = cached
+
+                if not_modified:
+                    if response is not None:
+                        response.close()
+                    response = current_app.response_class(status=304)
+
+                else:
+                    if response is None:
+                        response = current_app.response_class(data, mimetype=mimetype)
+                    response.headers['Surrogate-Key'] = surrogate_key
+
+            response.set_etag(etag)
+            if updated is not None:
+                response.last_modified = datetime.utcfromtimestamp(updated)
+
+            max_age = current_app.config['SURROGATE_MAX_AGE']
+            response.headers['Cache-Control'] = 'public, max-age=0, s-maxage=%d' % max_age
+
+            return response
+
+        wrapped_view = update_wrapper(wrapped_view, view)
+        wrapped_view.cached_response = True
+        return wrapped_view
+    return decorator
+
+snapshots = ResponseCache()
+
+def current_snapshot(name, build):
+    ''' Return the value of build(), reused until the next update of anything.
+
+        Snapshots are kept per host, because API links include it, and
+        are rebuilt every time when RESPONSE_CACHE_SIZE is zero.
+    '''
+    key = (name, request.host_url)
+    generation, _ = current_generation()
+    snapshot = snapshots.get(key, generation) if current_app.config['RESPONSE_CACHE_SIZE'] > 0 else None
+
+    if snapshot is None:
+        snapshot = build()
+        snapshots.set(key, generation, snapshot, 16)
+
+    return snapshot
+
+class OrganizationFeatures(object):
+    ''' Serialized GeoJSON features for every organization, with a grid index.
+    '''
+    def __init__(self, organizations):
+        self.features, self.points = [], []
+        self.grid = GridIndex()
+
+        for org in organizations:
+            # GeoJSON Point geometry, http://geojson.org/geojson-spec.html#point
+            geom = dict(type='Point', coordinates=[org.longitude, org.latitude])
+            feature = dict(type='Feature', id=org.api_id(), properties=org.asdict(), geometry=geom)
+            data = json.dumps(feature, cls=current_app.json_encoder)
+
+            self.features.append(data)
+            if org.longitude is not None and org.latitude is not None:
+                self.points.append((org.longitude, org.latitude, data))
+                self.grid.add(org.longitude, org.latitude, data)
+
+        self.data = self.collection(self.features)
+
+    @staticmethod
+    def build():
+        return OrganizationFeatures(db.session.query(Organization).order_by(Organization.name).all())
+
+    @staticmethod
+    def collection(features):
+        return '{"type": "FeatureCollection", "features": [%s]}' % ', '.join(features)
+
+    def within(self, bbox):
+        ''' Return a serialized FeatureCollection of organizations inside bbox.
+        '''
+        return self.collection(self.grid.search(bbox))
+
+class OrganizationClusters(object):
+    ''' Clustered organization features for each map zoom level.
+    '''
+    def __init__(self, features):
+        self.index = ClusterIndex(features.points)
+
+    @staticmethod
+    def build():
+        return OrganizationClusters(current_snapshot('organization features', OrganizationFeatures.build))
+
+    def tile(self, zoom, x, y):
+        ''' Return a serialized FeatureCollection of clusters and single
+            organizations in one map tile.
+        '''
+        features = []
+
+        for cluster in self.index.tile(zoom, x, y):
+            if cluster.count == 1:
+                features.append(cluster.item)
+                continue
+
+            geom = dict(type='Point', coordinates=list(cluster.lonlat()))
+            props = dict(cluster=True, point_count=cluster.count, expansion_zoom=cluster.zoom + 1)
+            features.append(json.dumps(dict(type='Feature', properties=props, geometry=geom)))
+
+        return OrganizationFeatures.collection(features)
+
+# -------------------
+# API
+# -------------------
+
+def page_info(total, page, limit):
+    ''' Return last page and offset for a total number of results.
+
+        Last page is None when the total is not known.
+    '''
+    last = int(ceil(total / limit)) if total is not None else None
+    offset = (page - 1) * limit
+
+    return last, offset
+
+def pages_dict(page, last, querystring, has_next=None, next_cursor=None):
+    ''' Return a dictionary of pages to return in API responses.
+
+        When the last page is unknown, has_next says whether to link the next one.
+        A next_cursor adds a link to the following rows by keyset.
+    '''
+    url = base_url() + request.path
+
+    pages = dict()
+
+    if page > 1:
+        pages['first'] = dict()
+        pages['prev'] = dict()
+        if 'per_page' in request.args:
+            pages['first']['per_page'] = request.args['per_page']
+            pages['prev']['per_page'] = request.args['per_page']
+
+    if page > 2:
+        pages['prev']['page'] = page - 1
+
+    if last is not None:
+        has_next = page < last
+
+    if has_next:
+        pages['next'] = {'page': page + 1}
+        if 'per_page' in request.args:
+            pages['next']['per_page'] = request.args['per_page']
+
+    if has_next and last is not None:
+        pages['last'] = {'page': last}
+        if 'per_page' in request.args:
+            pages['last']['per_page'] = request.args['per_page']
+
+    if next_cursor:
+        pages['next_cursor'] = {'cursor': next_cursor}
+        if 'per_page' in request.args:
+            pages['next_cursor']['per_page'] = request.args['per_page']
+
+    for key in pages:
+        if querystring != '':
+            pages[key] = '%s?%s&%s' % (url, urlencode(pages[key]), querystring) if pages[key] else url
+        else:
+            pages[key] = '%s?%s' % (url, urlencode(pages[key])) if pages[key] else url
+
+    return pages
+
+def encode_cursor(value, id):
+    ''' Return an opaque cursor token for a row's sort key and id.
+    '''
+    if isinstance(value, datetime):
+        value = value.isoformat()
+
+    return urlsafe_b64encode(json.dumps([value, id])).rstrip('=')
+
+def decode_cursor(cursor, column):
+    ''' Return the sort key and id from a cursor token, or abort with a 400.
+    '''
+    try:
+        value, id = json.loads(urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)))
+        if not isinstance(value, (basestring, type(None))) or type(id) not in (int, long):
+            raise ValueError('Bad cursor %r' % cursor)
+        if value is not None and isinstance(column.type, types.DateTime):
+            value = parse_date(value)
+        return value, id
+
+    except (TypeError, ValueError, OverflowError):
+        abort(400)
+
+def keyset_filter(column, id_column, value, last_id, descending):
+    ''' Return a filter for rows after (value, last_id) when ordering by column, then id ascending.
+
+        Postgres sorts NULLs after every other value, SQLite before.
+    '''
+    nulls_high = db.session.connection().dialect.name == 'postgresql'
+    nulls_first = descending == nulls_high
+    after_id = id_column > last_id
+
+    if value is None:
+        following = and_(column == None, after_id)
+        return or_(following, column != None) if nulls_first else following
+
+    beyond = column < value if descending else column > value
+    following = or_(beyond, and_(column == value, after_id))
+    return following if nulls_first else or_(following, column == None)
+
+def estimate_count(query):
+    ''' Return the query planner's estimate of the number of rows in a query.
+
+        Only Postgres keeps the statistics for this, elsewhere return None.
+    '''
+    connection = db.session.connection()
+
+    if connection.dialect.name != 'postgresql':
+        return None
+
+    statement = query.statement.compile(dialect=connection.dialect)
+    plan = connection.execute('EXPLAIN (FORMAT JSON) ' + unicode(statement), statement.params).scalar()
+
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+
+    return int(plan[0]['Plan']['Plan Rows'])
+
+def load_children(parents, attr, model, foreign_key, limit=None):
+    ''' Load a one-to-many relationship for many parents with one IN query.
+
+        Loads just the first few children of each parent with a limit,
+        like load_top_rows(). Return the list of loaded children.
+    '''
+    ids = set([parent.id for parent in parents])
+    children = dict()
+
+    if ids:
+        query = db.session.query(model).filter(foreign_key.in_(ids)).order_by(model.id)
+
+        if limit is not None:
+            row_number = func.row_number().over(partition_by=foreign_key, order_by=model.id)
+            ranked = db.session.query(model.id.label('id'), row_number.label('row_number'))\
+                .filter(foreign_key.in_(ids)).subquery()
+            query = db.session.query(model).join(ranked, model.id == ranked.c.id)\
+                .filter(ranked.c.row_number <= limit).order_by(model.id)
+
+        for child in query:
+            children.setdefault(getattr(child, foreign_key.key), []).append(child)
+
+    for parent in parents:
+        set_committed_value(parent, attr, children.get(parent.id, []))
+
+    return [child for parent_id in ids for child in children.get(parent_id, [])]
+
+def load_parents(children, attr, model, key, foreign_key):
+    ''' Load a many-to-one relationship for many children with one IN query.
+
+        Return the list of loaded parents.
+    '''
+    keys = set([getattr(child, foreign_key) for child in children]) - set([None])
+    parents = dict()
+
+    if keys:
+        query = db.session.query(model).filter(key.in_(keys))
+        parents = dict([(getattr(parent, key.key), parent) for parent in query])
+
+    for child in children:
+        set_committed_value(child, attr, parents.get(getattr(child, foreign_key)))
+
+    return parents.values()
+
+def load_top_rows(model, names, order_by, limit, *filters):
+    ''' Return the first few rows of a model for each organization name.
+
+        Uses one ROW_NUMBER() OVER (PARTITION BY organization_name) query
+        for all organizations, returning a dictionary of lists by name.
+    '''
+    rows = dict()
+
+    if not names:
+        return rows
+
+    row_number = func.row_number().over(partition_by=model.organization_name, order_by=order_by)
+    ranked = db.session.query(model.id.label('id'), row_number.label('row_number'))\
+        .filter(model.organization_name.in_(names), *filters).subquery()
+
+    query = db.session.query(model).join(ranked, model.id == ranked.c.id)\
+        .filter(ranked.c.row_number <= limit).order_by(ranked.c.row_number)
+
+    for row in query:
+        rows.setdefault(row.organization_name, []).append(row)
+
+    return rows
+
+def load_extras(organizations, keys=Organization.extras):
+    ''' Batch-load current events, projects and stories for many organizations.
+
+        Matches current_events(), current_projects() and current_stories()
+        but costs one query per kind, no matter how many organizations.
+        Only the kinds named in keys are loaded.
+    '''
+    names = set([org.name for org in organizations])
+    extras = dict()
+
+    if 'current_events' in keys:
+        filter_old = Event.start_time_notz >= datetime.utcnow()
+        extras['current_events'] = load_top_rows(Event, names, Event.start_time_notz.asc(), 2, filter_old)
+
+    if 'current_projects' in keys:
+        projects = extras['current_projects'] = load_top_rows(Project, names, desc(Project.last_updated), 3)
+
+        # current_projects embed their first issues
+        all_projects = [project for rows in projects.values() for project in rows]
+        issues = load_children(all_projects, 'issues', Issue, Issue.project_id, current_app.config['EMBEDDED_ISSUES'])
+        load_children(issues, 'labels', Label, Label.issue_id)
+
+    if 'current_stories' in keys:
+        extras['current_stories'] = load_top_rows(Story, names, Story.id, 2)
+
+    for org in organizations:
+        org.loaded_extras = dict([(key, [row.asdict() for row in rows.get(org.name, [])])
+                                  for (key, rows) in extras.items()])
+
+def eager_load(objects, fieldset=None):
+    ''' Batch-load everything asdict(True) walks for a list of model instances.
+
+        Uses a fixed number of IN queries per model, instead of lazy loading
+        relationships one instance at a time. With a fieldset, relationships
+        for fields it leaves out aren't loaded.
+    '''
+    fieldset = fieldset or all_fields
+    organizations = [o for o in objects if isinstance(o, Organization)]
+    projects = [o for o in objects if isinstance(o, Project)]
+    issues = [o for o in objects if isinstance(o, Issue)]
+    with_organization = [o for o in objects if isinstance(o, (Project, Event, Story))]
+
+    if organizations:
+        load_extras(organizations, [key for key in Organization.extras if key in fieldset])
+
+    if with_organization and 'organization' in fieldset:
+        load_parents(with_organization, 'organization', Organization, Organization.name, 'organization_name')
+
+    if issues:
+        # Surrogate keys need each issue's project, included or not.
+        load_parents(issues, 'project', Project, Project.id, 'project_id')
+
+    labelled = issues if 'labels' in fieldset else []
+
+    if projects and 'issues' in fieldset:
+        labelled = labelled + load_children(projects, 'issues', Issue, Issue.project_id, current_app.config['EMBEDDED_ISSUES'])
+
+    if labelled:
+        load_children(labelled, 'labels', Label, Label.issue_id)
+
+class Fieldset(object):
+    ''' Top-level fields of API objects, picked with ?fields= and ?exclude=.
+
+        Both take comma-separated field names. Everything is included by default.
+    '''
+    def __init__(self, fields=None, exclude=()):
+        self.fields = frozenset(fields) if fields is not None else None
+        self.exclude = frozenset(exclude)
+
+    @classmethod
+    def from_args(cls, args):
+        fields, exclude = args.get('fields'), args.get('exclude')
+        return cls(fields.split(',') if fields else None, exclude.split(',') if exclude else ())
+
+    def __contains__(self, name):
+        return (self.fields is None or name in self.fields) and name not in self.exclude
+
+    def everything(self):
+        return self.fields is None and not self.exclude
+
+    def pick(self, model_dict):
+        ''' Return a dictionary with only the included fields.
+        '''
+        if self.everything():
+            return model_dict
+        return dict((key, value) for (key, value) in model_dict.items() if key in self)
+
+all_fields = Fieldset()
+
+def requested_fields():
+    ''' Return the Fieldset this request asks for.
+    '''
+    return Fieldset.from_args(request.args)
+
+def select_rows(serializer, column, keys, *order_by):
+    ''' Return Core rows of a serializer's columns where column is one of keys.
+    '''
+    keys = set(key for key in keys if key is not None)
+    if not keys:
+        return []
+
+    statement = select(serializer.columns).where(column.in_(keys)).order_by(*order_by)
+    return db.session.execute(statement).fetchall()
+
+def select_first_rows(serializer, column, keys, limit, order_by):
+    ''' Return up to limit rows of a serializer's columns for each of keys.
+
+        Uses one ROW_NUMBER() OVER (PARTITION BY column) select, like
+        load_top_rows(). Rows are in order of column, then order_by.
+    '''
+    keys = set(key for key in keys if key is not None)
+    if not keys or limit < 1:
+        return []
+
+    row_number = func.row_number().over(partition_by=column, order_by=order_by).label('row_number')
+    ranked = select(serializer.columns + [row_number]).where(column.in_(keys)).alias('ranked')
+
+    statement = select([ranked]).where(ranked.c.row_number <= limit).order_by(ranked.c[column.key], ranked.c[order_by.key])
+    return db.session.execute(statement).fetchall()
+
+def memo_rows(serializer, column, keys, **options):
+    ''' Return serialized rows by primary key, reusing any already built in this request.
+
+        Entries are shared with asdict_memo.asdict(), so an object
+        serialized either way is built once.
+    '''
+    tablename, found, missing = serializer.model.__tablename__, dict(), set()
+
+    for key in set(key for key in keys if key is not None):
+        found[key] = asdict_memo.get(asdict_memo.key(tablename, (key, ), **options))
+        if found[key] is None:
+            missing.add(key)
+
+    for model_dict in serializer.serialize(select_rows(serializer, column, missing)):
+        found[model_dict[column.key]] = model_dict
+        asdict_memo.set(asdict_memo.key(tablename, (model_dict[column.key], ), **options), model_dict)
+
+    return found
+
+class RowSerializer(object):
+    ''' Turns rows of a model's table columns into the dictionaries asdict(True) gives.
+
+        Rows come from Core selects, so no ORM instances are built for them.
+        Published columns are picked once, and subclasses add computed and
+        related values to a whole batch of rows at a time.
+
+        A Fieldset narrows the selected columns to the fields it includes,
+        plus keys and the columns any included computed fields come from.
+        Related rows are only selected for the fields it includes.
+    '''
+    model = None
+    hidden = ()
+
+    # Columns that computed fields are made from, by field name
+    sources = {}
+
+    def __init__(self, fieldset=all_fields, **options):
+        self.fieldset, self.options = fieldset, options
+        columns = list(self.model.__table__.columns)
+
+        needed = set(c.key for c in columns if c.primary_key or c.foreign_keys)
+        needed.update(key for (field, keys) in self.sources.items() if field in fieldset for key in keys)
+        self.published = [c.key for c in columns if c.key not in self.hidden and c.key in fieldset]
+        needed.update(self.published)
+
+        self.columns = [c for c in columns if c.key in needed]
+        self.positions = [i for (i, c) in enumerate(self.columns) if c.key in self.published]
+
+    def select(self, fieldset):
+        ''' Return a serializer like this one for just the fields in a fieldset.
+        '''
+        if fieldset.everything():
+            return self
+        return type(self)(fieldset, **self.options)
+
+    def plain(self, row):
+        return dict(zip(self.published, [row[i] for i in self.positions]))
+
+    def serialize(self, rows):
+        return [self.plain(row) for row in rows]
+
+    def organization_names(self, rows, model_dicts):
+        return [getattr(row, 'organization_name', None) for row in rows]
+
+    def tag(self, rows, model_dicts):
+        ''' Add surrogate keys for serialized rows, like tag_response() does for instances.
+        '''
+        if not hasattr(g, 'surrogate_keys'):
+            g.surrogate_keys = set()
+
+        for (row, organization_name) in zip(rows, self.organization_names(rows, model_dicts)):
+            g.surrogate_keys.add(self.model.__tablename__)
+            g.surrogate_keys.add('%s/%d' % (self.model.__tablename__, row.id))
+
+            if organization_name:
+                g.surrogate_keys.add(organization_key(organization_name))
+
+class OrganizationRows(RowSerializer):
+    model = Organization
+    hidden = ('keep', )
+    sources = dict((key, ('slug', )) for (key, _) in Organization.links)
+
+    def serialize(self, rows):
+        links = [(key, path) for (key, path) in Organization.links if key in self.fieldset]
+        model_dicts = []
+
+        for row in rows:
+            model_dict = self.plain(row)
+            api_url = '%s/api/organizations/%s' % (base_url(), row.slug) if links else None
+            for (key, path) in links:
+                model_dict[key] = api_url + path
+            model_dicts.append(model_dict)
+
+        return model_dicts
+
+class ProjectRows(RowSerializer):
+    model = Project
+    hidden = ('keep', )
+
+    def __init__(self, fieldset=all_fields, include_organization=True, include_issues=True):
+        self.include_organization = include_organization and 'organization' in fieldset
+        self.include_issues = include_issues and 'issues' in fieldset
+        RowSerializer.__init__(self, fieldset, include_organization=include_organization, include_issues=include_issues)
+
+    def serialize(self, rows):
+        organizations, issues = dict(), defaultdict(list)
+
+        if self.include_organization:
+            organizations = memo_rows(organization_rows, Organization.name, [row.organization_name for row in rows])
+
+        if self.include_issues:
+            limit = current_app.config['EMBEDDED_ISSUES']
+            children = select_first_rows(project_issue_rows, Issue.project_id, [row.id for row in rows], limit, Issue.id)
+            for (child, issue_dict) in zip(children, project_issue_rows.serialize(children)):
+                issues[child.project_id].append(issue_dict)
+
+        model_dicts = []
+
+        for row in rows:
+            model_dict = self.plain(row)
+            if 'api_url' in self.fieldset:
+                model_dict['api_url'] = '%s/api/projects/%s' % (base_url(), row.id)
+            if 'issues_url' in self.fieldset:
+                model_dict['issues_url'] = '%s/api/projects/%s/issues' % (base_url(), row.id)
+            if self.include_organization:
+                model_dict['organization'] = organizations.get(row.organization_name)
+            if self.include_issues:
+                model_dict['issues'] = issues[row.id]
+            model_dicts.append(model_dict)
+
+        return model_dicts
+
+class LabelRows(RowSerializer):
+    model = Label
+    hidden = ('id', 'issue_id')
+
+class EventRows(RowSerializer):
+    model = Event
+    hidden = ('keep', 'start_time_notz', 'end_time_notz', 'utc_offset')
+    sources = dict(start_time=('start_time_notz', 'utc_offset'), end_time=('end_time_notz', 'utc_offset'))
+
+    def serialize(self, rows):
+        organizations = dict()
+        if 'organization' in self.fieldset:
+            organizations = memo_rows(organization_rows, Organization.name, [row.organization_name for row in rows])
+
+        model_dicts = []
+
+        for row in rows:
+            model_dict = self.plain(row)
+            if 'start_time' in self.fieldset:
+                model_dict['start_time'] = Event.format_time(row.start_time_notz, row.utc_offset)
+            if 'end_time' in self.fieldset:
+                model_dict['end_time'] = Event.format_time(row.end_time_notz, row.utc_offset)
+            if 'api_url' in self.fieldset:
+                model_dict['api_url'] = '%s/api/events/%s' % (base_url(), row.id)
+            if 'organization' in self.fieldset:
+                model_dict['organization'] = organizations.get(row.organization_name)
+            model_dicts.append(model_dict)
+
+        return model_dicts
+
+class IssueRows(RowSerializer):
+    model = Issue
+
+    def __init__(self, fieldset=all_fields, include_project=True):
+        # Like Issue.asdict(), project_id is only published without the project.
+        self.include_project = include_project and 'project' in fieldset
+        self.hidden = ('keep', 'shuffle_key', 'project_id') if self.include_project else ('keep', 'shuffle_key')
+        RowSerializer.__init__(self, fieldset, include_project=include_project)
+
+    def serialize(self, rows):
+        projects, labels = dict(), defaultdict(list)
+
+        if self.include_project:
+            projects = memo_rows(issue_project_rows, Project.id, [row.project_id for row in rows], include_issues=False)
+
+        if 'labels' in self.fieldset:
+            for label in select_rows(label_rows, Label.issue_id, [row.id for row in rows], Label.id):
+                labels[label.issue_id].append(label_rows.plain(label))
+
+        model_dicts = []
+
+        for row in rows:
+            model_dict = self.plain(row)
+            if self.include_project:
+                model_dict['project'] = projects.get(row.project_id)
+            if 'api_url' in self.fieldset:
+                model_dict['api_url'] = '%s/api/issues/%s' % (base_url(), row.id)
+            if 'labels' in self.fieldset:
+                model_dict['labels'] = labels[row.id]
+            model_dicts.append(model_dict)
+
+        return model_dicts
+
+    def organization_names(self, rows, model_dicts):
+        ''' Return each issue's organization through its project, included or not.
+        '''
+        if self.include_project:
+            return [(model_dict['project'] or {}).get('organization_name') for model_dict in model_dicts]
+
+        project_ids = set(row.project_id for row in rows if row.project_id is not None)
+        if not project_ids:
+            return [None] * len(rows)
+
+        statement = select([Project.id, Project.organization_name]).where(Project.id.in_(project_ids))
+        names = dict(db.session.execute(statement).fetchall())
+        return [names.get(row.project_id) for row in rows]
+
+organization_rows, label_rows = OrganizationRows(), LabelRows()
+event_rows, issue_rows, project_rows = EventRows(), IssueRows(), ProjectRows()
+
+# Issues embedded in projects, and projects embedded in issues
+project_issue_rows = IssueRows(include_project=False)
+issue_project_rows = ProjectRows(include_organization=False, include_issues=False)
+
+def instance_dict(obj, fieldset=all_fields):
+    ''' Return asdict(True) for a model instance, with just the fields in fieldset.
+
+        Relationships are only walked for the fields it includes.
+    '''
+    if isinstance(obj, Organization):
+        model_dict = obj.asdict([key for key in Organization.extras if key in fieldset])
+    elif isinstance(obj, Project):
+        model_dict = obj.asdict('organization' in fieldset, 'issues' in fieldset)
+    elif isinstance(obj, Issue):
+        model_dict = obj.asdict('project' in fieldset, 'labels' in fieldset)
+    else:
+        model_dict = obj.asdict('organization' in fieldset)
+
+    return fieldset.pick(model_dict)
+
+def serialize_instances(objects, fieldset=all_fields):
+    ''' Return asdict(True) for model instances, batch loading what it walks.
+
+        Only what the fields in fieldset need is loaded and serialized.
+    '''
+    eager_load(objects, fieldset)
+    return [instance_dict(o, fieldset) for o in objects]
+
+def load_fields(query, fieldset):
+    ''' Return a query of Organization or Story instances loading only the
+        columns a fieldset includes, plus keys and organization slugs.
+    '''
+    model = query.column_descriptions[0]['type']
+    if fieldset.everything() or model not in (Organization, Story):
+        return query
+
+    columns = model.__table__.columns
+    keys = [c.key for c in columns if c.primary_key or c.foreign_keys or c.key == 'slug' or c.key in fieldset]
+    return query.options(load_only(*keys))
+
+def row_response(serializer, column, key):
+    ''' Return a JSON response for the one row of serializer's model where column is key.
+
+        Only the columns and related rows for the requested fields are selected.
+    '''
+    serializer = serializer.select(requested_fields())
+    rows = select_rows(serializer, column, [key])
+    if not rows:
+        return "%s not found" % serializer.model.__name__, 404
+
+    model_dicts = serializer.serialize(rows)
+    serializer.tag(rows, model_dicts)
+    return jsonify(model_dicts[0])
+
+class StreamedObjects(object):
+    ''' Model instances or rows from a query, serialized a batch at a time.
+
+        Each batch goes to the serialize function together, so a page of any
+        size holds only one batch in memory. The envelope function gives the
+        rest of the paged response once iteration is done.
+    '''
+    def __init__(self, objects, envelope, batch_size, serialize=serialize_instances):
+        self.objects = objects
+        self.envelope = envelope
+        self.batch_size = batch_size
+        self.serialize = serialize
+
+    def __iter__(self):
+        while True:
+            batch = list(islice(self.objects, self.batch_size))
+            if not batch:
+                break
+
+            for model_dict in self.serialize(batch):
+                yield model_dict
+
+def json_response(data):
+    ''' Return a JSON response for a dictionary from paged_results().
+
+        Streamed objects are written out as they are serialized, followed
+        by the envelope. Everything else goes to jsonify().
+    '''
+    objects = data.get('objects')
+    if not isinstance(objects, StreamedObjects):
+        return jsonify(data)
+
+    def generate():
+        yield '{"objects": ['
+
+        for (index, model_dict) in enumerate(objects):
+            yield (', ' if index else '') + json.dumps(model_dict, cls=current_app.json_encoder, sort_keys=True)
+
+        rest = dict(data, **objects.envelope())
+        del rest['objects']
+        yield '], %s}' % json.dumps(rest, cls=current_app.json_encoder, sort_keys=True)[1:-1]
+
+    return current_app.response_class(stream_with_context(generate()), mimetype='application/json')
+
+def paged_results(query, page, per_page, querystring='', keyset=None, serializer=None):
+    ''' Return a page of results from a query, with the related rows
+        loaded in batches ahead of serialization.
+
+        The ?count= argument picks how the total is found: "exact" counts it
+        in the same statement as the page with COUNT(*) OVER (), "estimate"
+        asks the query planner, and "none" skips it.
+
+        A keyset of (column, descending) matching the query's ordering allows
+        ?cursor= paging, which picks up after the last row seen instead of
+        using an offset.
+
+        Pages bigger than STREAM_PAGE_SIZE are streamed: their objects are
+        StreamedObjects read from the database with yield_per(), for
+        json_response() to write out. The first batch is read before
+        streaming starts, so a failing query still gets an error status.
+
+        With a RowSerializer, only the model's columns are selected, and
+        rows go straight from Core to dictionaries without ORM instances.
+        The ?fields= and ?exclude= arguments narrow those columns further;
+        without a serializer they only drop fields after serialization.
+    '''
+    count = request.args.get('count', 'exact')
+    cursor = request.args.get('cursor') if keyset else None
+    offset = (page - 1) * per_page
+    batch_size = current_app.config['STREAM_PAGE_SIZE']
+    total, extra, windowed = None, False, False
+    tablename = query.column_descriptions[0]['type'].__tablename__
+
+    fieldset = requested_fields()
+
+    if serializer:
+        serializer = serializer.select(fieldset)
+        columns = list(serializer.columns)
+        if keyset and keyset[0].key not in [c.key for c in columns]:
+            # Cursors need the keyset column, published or not.
+            columns.append(keyset[0])
+        query = query.with_entities(*columns)
+    else:
+        query = load_fields(query, fieldset)
+
+    if keyset:
+        # Break ties on id so that every row has a unique position.
+        column, descending = keyset
+        id_column = column.class_.id
+        query = query.order_by(id_column)
+
+    if count == 'estimate':
+        total = estimate_count(query)
+
+    if cursor:
+        value, last_id = decode_cursor(cursor, column)
+
+        if count == 'exact':
+            total = query.count()
+
+        rows = query.filter(keyset_filter(column, id_column, value, last_id, descending)).limit(per_page + 1)
+        extra = True
+
+    elif count == 'none':
+        # Ask for one extra row to find out if there is a next page.
+        rows = query.limit(per_page + 1).offset(offset)
+        extra = True
+
+    elif count == 'estimate' and total is not None:
+        rows = query.limit(per_page).offset(offset)
+
+    else:
+        rows = query.add_columns(func.count().over().label('total')).limit(per_page).offset(offset)
+        windowed = True
+
+    streamed = per_page > batch_size
+    seen = dict(rows=0, total=None, last=None)
+
+    def page_rows():
+        if serializer is None:
+            return rows.yield_per(batch_size) if streamed else rows
+
+        statement = rows.statement
+        if streamed:
+            statement = statement.execution_options(stream_results=True)
+        return db.session.execute(statement)
+
+    def page_objects():
+        ''' Generate the page's objects or rows, noting what the envelope needs.
+        '''
+        for row in page_rows():
+            if windowed:
+                seen['total'] = row.total
+                if serializer is None:
+                    row = row[0]
+
+            seen['rows'] += 1
+            if seen['rows'] > per_page:
+                break
+
+            seen['last'] = row
+            yield row
+
+    def envelope():
+        ''' Return the total and page links, once the objects have been read.
+        '''
+        page_total = total
+
+        if windowed:
+            if seen['total'] is not None:
+                page_total = seen['total']
+            elif offset == 0:
+                page_total = 0
+            else:
+                # Past the last page, so there was no row to carry the total.
+                page_total = query.count()
+
+        last, _ = page_info(page_total, page, per_page)
+        has_next = seen['rows'] > per_page if extra else page < last
+
+        next_cursor = None
+        if keyset and seen['last'] is not None and has_next:
+            next_cursor = encode_cursor(getattr(seen['last'], column.key), seen['last'].id)
+
+        if cursor:
+            # Page numbers don't apply to cursor paging.
+            pages = pages_dict(1, None, querystring, False, next_cursor)
+        else:
+            pages = pages_dict(page, last, querystring, has_next, next_cursor)
+
+        return dict(total=page_total, pages=pages)
+
+    def serialize(objects):
+        if serializer:
+            return serializer.serialize(objects)
+        return serialize_instances(objects, fieldset)
+
+    if streamed:
+        # Run the query and read its first batch now, so errors still get
+        # an error status instead of a truncated body.
+        objects = page_objects()
+        first = list(islice(objects, batch_size))
+
+        # Headers go out before the objects are read, so only tag their type.
+        g.surrogate_keys = getattr(g, 'surrogate_keys', set())
+        g.surrogate_keys.add(tablename)
+        return dict(objects=StreamedObjects(chain(first, objects), envelope, batch_size, serialize))
+
+    objects = list(page_objects())
+    model_dicts = serialize(objects)
+
+    if serializer:
+        serializer.tag(objects, model_dicts)
+    else:
+        tag_response(objects)
+
+    return dict(envelope(), objects=model_dicts)
+
+def is_safe_name(name):
+    ''' Return True if the string is a safe name.
+
+        Its slug may only differ by dashes for spaces, so it can be told
+        apart from other names' slugs and from old-style underscores.
+    '''
+    return '_' not in name and safe_name(name) == name.replace(' ', '-')
+
+def safe_name(name):
+    ''' Return URL-safe organization name with spaces replaced by dashes.
+
+        Slashes, question marks and hashes become dashes too.
+    '''
+    return name.replace(' ', '-').replace('/', '-').replace('?','-').replace('#','-')
+
+def slug_owner(session, name):
+    ''' Return the name of another organization whose slug a name would take, if any.
+
+        Names that differ only by dashes and spaces share a slug.
+    '''
+    query = session.query(Organization.name).filter(Organization.slug == safe_name(name), Organization.name != name)
+    return query.scalar()
+
+def organization_slug(name):
+    ''' Return the slug for an organization named in a URL.
+
+        Works with the slug itself, a raw name, or old-style underscores.
+    '''
+    return safe_name(name.replace('_', ' '))
+
+def find_organization(name):
+    ''' Return the organization named in a URL, or None.
+
+        Looked up once per request, so batched requests share it.
+    '''
+    slug = organization_slug(name)
+    if not hasattr(g, 'organizations'):
+        g.organizations = dict()
+    if slug not in g.organizations:
+        g.organizations[slug] = Organization.query.filter_by(slug=slug).first()
+    return g.organizations[slug]
+
+def base_url():
+    ''' Return the scheme and host that API links in this request start with.
+
+        Worked out once per request.
+    '''
+    if not hasattr(g, 'base_url'):
+        g.base_url = '%s://%s' % (request.scheme, request.host)
+    return g.base_url
+
+# Query string arguments that change how results are returned, not which
+QUERY_OPTIONS = ('count', 'seed', 'fields', 'exclude')
+
+def shuffle_issues(query, seed=None):
+    ''' Return an issue query in shuffled order.
+
+        Without a seed, issues are shuffled anew on every request. A seed
+        picks a starting point in the precomputed shuffle keys instead, so
+        the same seed gives the same pages until run_update.py reshuffles.
+        The keys from there up come first, then the ones below it, with ids
+        breaking ties, all in one explicit ordering.
+    '''
+    if seed is None:
+        return query.order_by(func.random())
+
+    start = int(md5(seed.encode('utf8')).hexdigest()[:8], 16) / 2 ** 32
+    return query.order_by(Issue.shuffle_key < start, Issue.shuffle_key, Issue.id)
+
+def filter_by_labels(query, labels, organization_name=None):
+    ''' Narrow an issue query to issues with every one of some labels.
+
+        Like an ilike filter, each label matches any label name containing
+        it. Matches come from a LabelIndex subquery per label instead of
+        joining labels once per name. Issues of projects without an
+        organization aren't indexed, so their labels are searched directly.
+        Returns the narrowed query, and counts of each label on the issues it finds.
+    '''
+    issue_ids = JsonArray(LabelIndex.__table__.c.issue_ids, 'issue_ids')
+    index = select([issue_ids.value])
+    if organization_name:
+        index = index.where(LabelIndex.organization_name == organization_name)
+
+    unindexed = ~Issue.project.has(Project.organization_name != None)
+
+    for label in labels:
+        term = '%%%s%%' % label.lower()
+        indexed = Issue.id.in_(index.where(LabelIndex.name.like(term)))
+        if organization_name:
+            query = query.filter(indexed)
+        else:
+            query = query.filter(or_(indexed, and_(unindexed, Issue.labels.any(Label.name.ilike(term)))))
+
+    # Count labels on the issues found, in the database.
+    found = query.with_entities(Issue.id).order_by(None)
+    counts = db.session.query(LabelIndex.name, func.count()).filter(issue_ids.value.in_(found.statement))
+    if organization_name:
+        counts = counts.filter(LabelIndex.organization_name == organization_name)
+    counts = [counts.group_by(LabelIndex.name)]
+
+    if not organization_name:
+        direct = db.session.query(func.lower(Label.name), func.count(distinct(Label.issue_id)))
+        direct = direct.filter(Label.issue_id.in_(found.filter(unindexed).statement), Label.name != None)
+        counts.append(direct.group_by(func.lower(Label.name)))
+
+    facets = defaultdict(int)
+    for (name, count) in chain(*counts):
+        facets[name] += count
+
+    return query, dict(facets)
+
+def nearby_organizations(lat, lon, radius, limit):
+    ''' Return up to limit (distance, organization) pairs within radius
+        kilometers of a point, nearest first.
+
+        The location index narrows the organizations down to a box around
+        the circle, then exact distances are measured for those.
+    '''
+    connection = db.session.connection()
+    query = db.session.query(Organization)
+
+    if connection.dialect.name == 'postgresql' and has_extension(connection, 'earthdistance'):
+        point = func.ll_to_earth(Organization.latitude, Organization.longitude)
+        query = query.filter(func.earth_box(func.ll_to_earth(lat, lon), radius * 1000).op('@>')(point))
+
+    elif connection.dialect.name == 'sqlite':
+        minlon, minlat, maxlon, maxlat = radius_bbox(lat, lon, radius)
+        locations = table('organization_location', *[column(name) for name in ('name', 'minlon', 'maxlon', 'minlat', 'maxlat')])
+        lons = (and_ if minlon <= maxlon else or_)(locations.c.maxlon >= minlon, locations.c.minlon <= maxlon)
+        located = select([locations.c.name]).where(and_(locations.c.maxlat >= minlat, locations.c.minlat <= maxlat, lons))
+        query = query.filter(Organization.name.in_(located))
+
+    else:
+        minlon, minlat, maxlon, maxlat = radius_bbox(lat, lon, radius)
+        lons = (and_ if minlon <= maxlon else or_)(Organization.longitude >= minlon, Organization.longitude <= maxlon)
+        query = query.filter(Organization.latitude.between(minlat, maxlat), lons)
+
+    nearby = [(distance_km(lat, lon, org.latitude, org.longitude), org) for org in query]
+    nearby = [(distance, org) for (distance, org) in nearby if distance <= radius]
+
+    return sorted(nearby, key=lambda pair: (pair[0], pair[1].name))[:limit]
+
+def get_query_params(args):
+    filters, params = {}, {}
+    for key,value in args.iteritems():
+        if 'page' not in key and key != 'cursor':
+            params[key] = value
+            if key not in QUERY_OPTIONS:
+                filters[key] = value
+    return filters, urlencode(params)
+
+@app.route('/api/organizations')
+@app.route('/api/organizations/<name>')
+@cached_response('name')
+def get_organizations(name=None):
+    ''' Regular response option for organizations.
+    '''
+
+    filters = request.args
+    filters, querystring = get_query_params(request.args)
+
+    if name:
+        # Get one named organization.
+        org = find_organization(name)
+        if not org:
+            return "Organization not found", 404
+
+        fieldset = requested_fields()
+        eager_load([org], fieldset)
+        tag_response([org])
+        return jsonify(instance_dict(org, fieldset))
+
+    # Get a bunch of organizations.
+    query = db.session.query(Organization)
+
+    for attr, value in filters.iteritems():
+        query = query.filter(getattr(Organization, attr).ilike('%%%s%%' % value))
+
+    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 10)), querystring)
+
+    return json_response(response)
+
+@app.route('/api/organizations/nearby')
+@cached_response()
+def get_nearby_organizations():
+    ''' Organizations within radius kilometers of lat and lon, nearest first.
+    '''
+    try:
+        lat, lon = float(request.args['lat']), float(request.args['lon'])
+        radius = float(request.args.get('radius', 50))
+        limit = int(request.args.get('limit', 10))
+    except (KeyError, ValueError):
+        return "Nearby needs numeric lat and lon arguments", 400
+
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180) or radius < 0 or limit < 1:
+        return "Bad lat, lon, radius or limit argument", 400
+
+    nearby = nearby_organizations(lat, lon, radius, limit)
+    organizations = [org for (_, org) in nearby]
+    eager_load(organizations)
+    tag_response(organizations)
+
+    model_dicts = [dict(org.asdict(True), distance=distance) for (distance, org) in nearby]
+
+    return jsonify(dict(total=len(model_dicts), objects=model_dicts))
+
+@app.route('/api/organizations.geojson')
+@cached_response()
+def get_organizations_geojson():
+    ''' GeoJSON response option for organizations.
+
+        Optionally limited to a bbox=minlon,minlat,maxlon,maxlat viewport.
+    '''
+    features = current_snapshot('organization features', OrganizationFeatures.build)
+
+    if 'bbox' not in request.args:
+        return current_app.response_class(features.data, mimetype='application/json')
+
+    try:
+        bbox = parse_bbox(request.args['bbox'])
+    except ValueError:
+        return "Bad bbox argument, expected minlon,minlat,maxlon,maxlat", 400
+
+    return current_app.response_class(features.within(bbox), mimetype='application/json')
+
+@app.route('/api/organizations/clusters/<int:zoom>/<int:x>/<int:y>')
+@cached_response()
+def get_organization_clusters(zoom, x, y):
+    ''' GeoJSON clusters of organizations for one zoom/x/y map tile.
+    '''
+    if zoom > 30 or x >= 2 ** zoom or y >= 2 ** zoom:
+        return "No such tile", 404
+
+    clusters = current_snapshot('organization clusters', OrganizationClusters.build)
+
+    return current_app.response_class(clusters.tile(zoom, x, y), mimetype='application/json')
+
+@app.route("/api/organizations/<organization_name>/events")
+@cached_response('organization_name')
+def get_orgs_events(organization_name):
+    '''
+        A cleaner url for getting an organizations events
+        Better than /api/events?q={"filters":[{"name":"organization_name","op":"eq","val":"Code for San Francisco"}]}
+    '''
+    # Check org name
+    organization = find_organization(organization_name)
+    if not organization:
+        return "Organization not found", 404
+
+    # Get event objects
+    query = Event.query.filter_by(organization_name=organization.name)
+    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 25)),
+                             serializer=event_rows)
+    return json_response(response)
+
+@app.route("/api/organizations/<organization_name>/upcoming_events")
+@cached_response('organization_name')
+def get_upcoming_events(organization_name):
+    '''
+        Get events that occur in the future. Order asc.
+    '''
+    # Check org name
+    organization = find_organization(organization_name)
+    if not organization:
+        return "Organization not found", 404
+    # Get upcoming event objects
+    query = Event.query.filter(Event.organization_name == organization.name, Event.start_time_notz >= datetime.utcnow()).\
+            order_by(Event.start_time_notz)
+    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 25)),
+                             keyset=(Event.start_time_notz, False), serializer=event_rows)
+    return json_response(response)
+
+@app.route("/api/organizations/<organization_name>/past_events")
+@cached_response('organization_name')
+def get_past_events(organization_name):
+    '''
+        Get events that occur in the past. Order desc.
+    '''
+    # Check org name
+    organization = find_organization(organization_name)
+    if not organization:
+        return "Organization not found", 404
+    # Get past event objects
+    query = Event.query.filter(Event.organization_name == organization.name, Event.start_time_notz < datetime.utcnow()).\
+            order_by(desc(Event.start_time_notz))
+    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 25)),
+                             keyset=(Event.start_time_notz, True), serializer=event_rows)
+    return json_response(response)
+
+@app.route("/api/organizations/<organization_name>/stories")
+@cached_response('organization_name')
+def get_orgs_stories(organization_name):
+    '''
+        A cleaner url for getting an organizations stories
+    '''
+    # Check org name
+    organization = find_organization(organization_name)
+    if not organization:
+        return "Organization not found", 404
+
+    # Get story objects
+    query = Story.query.filter_by(organization_name=organization.name)
+    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 25)))
+    return json_response(response)
+
+@app.route("/api/organizations/<organization_name>/projects")
+@cached_response('organization_name')
+def get_orgs_projects(organization_name):
+    '''
+        A cleaner url for getting an organizations projects
+    '''
+    # Check org name
+    organization = find_organization(organization_name)
+    if not organization:
+        return "Organization not found", 404
+
+    # Get project objects
+    query = Project.query.filter_by(organization_name=organization.name).order_by(desc(Project.last_updated))
+    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 10)),
+                             keyset=(Project.last_updated, True), serializer=project_rows)
+    return json_response(response)
+
+@app.route("/api/organizations/<organization_name>/issues")
+@app.route("/api/organizations/<organization_name>/issues/labels/<labels>")
+@cached_response('organization_name')
+def get_orgs_issues(organization_name, labels=None):
+    ''' A clean url to get an organizations issues
+    '''
+
+    # Get one named organization.
+    organization = find_organization(organization_name)
+    if not organization:
+        return "Organization not found", 404
+
+    # Get that organization's projects
+    projects = Project.query.filter_by(organization_name=organization.name).all()
+    project_ids = [project.id for project in projects]
+
+    # Get all issues belonging to these projects
+    query = Issue.query.filter(Issue.project_id.in_(project_ids))
+
+    facets = None
+    if labels:
+        # Find issues with every label in the comma-separated list
+        query, facets = filter_by_labels(query, labels.split(','), organization.name)
+
+    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 10)),
+                             serializer=issue_rows)
+    if facets is not None:
+        response['facets'] = facets
+    return json_response(response)
 
 @app.route('/api/projects')
 @app.route('/api/projects/<int:id>')
+@cached_response()
 def get_projects(id=None):
     ''' Regular response option for projects.
     '''
@@ -734,9 +2626,7 @@ def get_projects(id=None):
 
     if id:
         # Get one named project.
-        filter = Project.id == id
-        proj = db.session.query(Project).filter(filter).first()
-        return jsonify(proj.asdict(True))
+        return row_response(project_rows, Project.id, id)
 
     # Get a bunch of projects.
     query = db.session.query(Project)
@@ -749,11 +2639,27 @@ def get_projects(id=None):
             query = query.filter(getattr(Project, attr).ilike('%%%s%%' % value))
 
     query = query.order_by(desc(Project.last_updated))
-    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 10)), querystring)
-    return jsonify(response)
+    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 10)), querystring,
+                             keyset=(Project.last_updated, True), serializer=project_rows)
+    return json_response(response)
+
+@app.route('/api/projects/<int:project_id>/issues')
+@cached_response()
+def get_project_issues(project_id):
+    ''' All of a project's issues, beyond the few embedded in it.
+    '''
+    if not db.session.query(Project.id).filter(Project.id == project_id).first():
+        return "Project not found", 404
+
+    _, querystring = get_query_params(request.args)
+    query = db.session.query(Issue).filter(Issue.project_id == project_id).order_by(Issue.id)
+    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 10)), querystring,
+                             serializer=issue_rows)
+    return json_response(response)
 
 @app.route('/api/issues')
 @app.route('/api/issues/<int:id>')
+@cached_response(unless=unseeded_shuffle)
 def get_issues(id=None):
     '''Regular response option for issues.
     '''
@@ -763,12 +2669,10 @@ def get_issues(id=None):
 
     if id:
         # Get one issue
-        filter = Issue.id == id
-        issue = db.session.query(Issue).filter(filter).first()
-        return jsonify(issue.asdict(True))
+        return row_response(issue_rows, Issue.id, id)
 
     # Get a bunch of issues
-    query = db.session.query(Issue).order_by(func.random())
+    query = db.session.query(Issue)
 
     for attr, value in filters.iteritems():
         if 'project' in attr:
@@ -780,23 +2684,19 @@ def get_issues(id=None):
         else:
             query = query.filter(getattr(Issue, attr).ilike('%%%s%%' % value))
 
-    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 10)), querystring)
-    return jsonify(response)
+    query = shuffle_issues(query, request.args.get('seed'))
+    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 10)), querystring,
+                             serializer=issue_rows)
+    return json_response(response)
 
 @app.route('/api/issues/labels/<labels>')
+@cached_response(unless=unseeded_shuffle)
 def get_issues_by_labels(labels):
     '''
     A clean url to filter issues by a comma-separated list of labels
     '''
 
-    # Create a labels list by comma separating the argument
-    labels = labels.split(',')
-
-    # Create the filter for each label
-    labels = [Label.name.ilike('%%%s%%' % label) for label in labels]
-
-    # Create the base query object by joining on Issue.labels
-    base_query = db.session.query(Issue).join(Issue.labels)
+    base_query = db.session.query(Issue)
 
     # Check for parameters
     filters = request.args
@@ -811,18 +2711,19 @@ def get_issues_by_labels(labels):
         else:
             base_query = base_query.filter(getattr(Issue, attr).ilike('%%%s%%' % value))
 
-    # Filter for issues with each individual label
-    label_queries = [base_query.filter(L) for L in labels]
-
-    # Intersect filters to find issues with all labels
-    query = base_query.intersect(*label_queries).order_by(func.random())
+    # Find issues with every label in the comma-separated list
+    query, facets = filter_by_labels(base_query, labels.split(','))
+    query = shuffle_issues(query, request.args.get('seed'))
 
     # Return the paginated reponse
-    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 10)))
-    return jsonify(response)
+    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 10)), querystring,
+                             serializer=issue_rows)
+    response['facets'] = facets
+    return json_response(response)
 
 @app.route('/api/events')
 @app.route('/api/events/<int:id>')
+@cached_response()
 def get_events(id=None):
     ''' Regular response option for events.
     '''
@@ -832,9 +2733,7 @@ def get_events(id=None):
 
     if id:
         # Get one named event.
-        filter = Event.id == id
-        event = db.session.query(Event).filter(filter).first()
-        return jsonify(event.asdict(True))
+        return row_response(event_rows, Event.id, id)
 
     # Get a bunch of events.
     query = db.session.query(Event)
@@ -846,10 +2745,12 @@ def get_events(id=None):
         else:
             query = query.filter(getattr(Event, attr).ilike('%%%s%%' % value))
 
-    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 25)), querystring)
-    return jsonify(response)
+    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 25)), querystring,
+                             serializer=event_rows)
+    return json_response(response)
 
 @app.route('/api/events/upcoming_events')
+@cached_response()
 def get_all_upcoming_events():
     ''' Show all upcoming events.
         Return them in chronological order.
@@ -866,11 +2767,13 @@ def get_all_upcoming_events():
         else:
             query = query.filter(getattr(Event, attr).ilike('%%%s%%' % value))
 
-    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 25)))
-    return jsonify(response)
+    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 25)), querystring,
+                             keyset=(Event.start_time_notz, False), serializer=event_rows)
+    return json_response(response)
 
 
 @app.route('/api/events/past_events')
+@cached_response()
 def get_all_past_events():
     ''' Show all past events.
         Return them in reverse chronological order.
@@ -887,11 +2790,13 @@ def get_all_past_events():
         else:
             query = query.filter(getattr(Event, attr).ilike('%%%s%%' % value))
 
-    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 25)))
-    return jsonify(response)
+    response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 25)), querystring,
+                             keyset=(Event.start_time_notz, True), serializer=event_rows)
+    return json_response(response)
 
 @app.route('/api/stories')
 @app.route('/api/stories/<int:id>')
+@cached_response()
 def get_stories(id=None):
     ''' Regular response option for stories.
     '''
@@ -901,9 +2806,15 @@ def get_stories(id=None):
 
     if id:
         # Get one named story.
+        fieldset = requested_fields()
         filter = Story.id == id
-        story = db.session.query(Story).filter(filter).first()
-        return jsonify(story.asdict(True))
+        story = load_fields(db.session.query(Story), fieldset).filter(filter).first()
+        if not story:
+            return "Story not found", 404
+
+        eager_load([story], fieldset)
+        tag_response([story])
+        return jsonify(instance_dict(story, fieldset))
 
     # Get a bunch of stories.
     query = db.session.query(Story)
@@ -916,12 +2827,142 @@ def get_stories(id=None):
             query = query.filter(getattr(Story, attr).ilike('%%%s%%' % value))
 
     response = paged_results(query, int(request.args.get('page', 1)), int(request.args.get('per_page', 25)), querystring)
-    return jsonify(response)
+    return json_response(response)
+
+@app.route('/api/search')
+@cached_response()
+def get_search():
+    ''' Ranked full-text search over projects, issues and stories.
+
+        Narrow it to some types with a comma-separated type argument.
+    '''
+    q = request.args.get('q', '').strip()
+    if not q:
+        return "Search needs a q argument", 400
+
+    names = [name for (name, _, _) in SEARCHABLE]
+    if 'type' in request.args:
+        names = request.args['type'].split(',')
+    if set(names) - set(name for (name, _, _) in SEARCHABLE):
+        return "Unknown search type", 400
+
+    _, querystring = get_query_params(request.args)
+    page, per_page = int(request.args.get('page', 1)), int(request.args.get('per_page', 10))
+
+    selects = [search_select(name, model, columns, q) for (name, model, columns) in SEARCHABLE if name in names]
+    results = union_all(*selects).alias('results')
+
+    # Like paged_results(), count the matches in the same query as the page.
+    _, offset = page_info(0, page, per_page)
+    query = db.session.query(results.c.type, results.c.id, func.count().over().label('total'))
+    rows = query.order_by(desc(results.c.rank), results.c.type, results.c.id).limit(per_page).offset(offset).all()
+
+    if rows:
+        total = rows[0].total
+    else:
+        total = db.session.query(results).count() if page > 1 else 0
+
+    # Load each type's matches with one query.
+    fieldset = requested_fields()
+    found = dict()
+    for (name, model, _) in SEARCHABLE:
+        ids = [row.id for row in rows if row.type == name]
+        if ids:
+            query = load_fields(db.session.query(model), fieldset).filter(model.id.in_(ids))
+            found.update(((name, obj.id), obj) for obj in query)
+
+    objects = [found[(row.type, row.id)] for row in rows if (row.type, row.id) in found]
+    result_types = [row.type for row in rows if (row.type, row.id) in found]
+
+    eager_load(objects, fieldset)
+    tag_response(objects)
+
+    last, _ = page_info(total, page, per_page)
+    pages = pages_dict(page, last, querystring)
+
+    model_dicts = [dict(instance_dict(o, fieldset), result_type=t) for (o, t) in zip(objects, result_types)]
+
+    return jsonify(dict(total=total, pages=pages, objects=model_dicts))
 
 # -------------------
 # Routes
 # -------------------
 
+# Most GET paths one batch request can ask for
+BATCH_LIMIT = 20
+
+def is_batchable(path):
+    ''' Return True if a path goes to one of the cached JSON API views.
+
+        Paths with . or .. segments are never batched.
+    '''
+    local_path = unquote(path.split('?')[0].encode('utf8')).decode('utf8', 'replace')
+    if set(local_path.split('/')) & set(['.', '..']):
+        return False
+
+    try:
+        endpoint, _ = current_app.create_url_adapter(request).match(local_path, method='GET')
+    except HTTPException:
+        return False
+
+    return getattr(current_app.view_functions[endpoint], 'cached_response', False)
+
+@app.route('/api/batch')
+def get_batch():
+    ''' Responses to several GET paths of this API in one round trip.
+
+        Each path runs through its usual view, in this request's database
+        session, so organization and update lookups they share run once.
+        The batch carries all of their surrogate keys, unless one of them
+        can't be cached.
+    '''
+    paths = request.args.getlist('path')
+
+    if not paths or len(paths) > BATCH_LIMIT:
+        return "Between 1 and %d path arguments are required" % BATCH_LIMIT, 400
+
+    for path in paths:
+        if not path.startswith('/api/') or not is_batchable(path):
+            return "Batch paths must be other API paths, not %s" % path, 400
+
+    responses, surrogate_keys, cacheable = [], set(), True
+
+    for path in paths:
+        environ = EnvironBuilder(path.encode('utf8'), base_url=request.host_url).get_environ()
+
+        with current_app.request_context(environ):
+            # g is shared, but each path is tagged with only its own keys.
+            g.surrogate_keys = set()
+
+            try:
+                response = current_app.full_dispatch_request()
+            except Exception, e:
+                response = current_app.make_response(current_app.handle_exception(e))
+
+            body = response.get_data()
+
+        # The batch can be kept by a caching proxy only as long as all of its paths.
+        surrogate_keys.update(response.headers.get('Surrogate-Key', '').split())
+        cacheable = cacheable and response.status_code == 200 and 'Surrogate-Key' in response.headers
+
+        # JSON bodies are included as they are, anything else as a string.
+        if response.mimetype != 'application/json':
+            body = json.dumps(body.decode('utf8'))
+
+        responses.append('{"path": %s, "status": %d, "body": %s}' % (json.dumps(path), response.status_code, body))
+
+    data = '{"responses": [%s]}' % ', '.join(responses)
+    response = current_app.response_class(data, mimetype='application/json')
+
+    if cacheable:
+        max_age = current_app.config['SURROGATE_MAX_AGE']
+        response.headers['Surrogate-Key'] = ' '.join(sorted(surrogate_keys))
+        response.headers['Cache-Control'] = 'public, max-age=0, s-maxage=%d' % max_age
+    else:
+        response.cache_control.no_cache = True
+
+    return response
+
 @app.route('/api/.well-known/status')
 def well_known_status():
     ''' Return status information for Engine Light.
@@ -993,15 +3034,12 @@ def index():
 @app.route("/api")
 @app.route("/api/")
 def api_index():
-    return render_template('index.html', api_base='%s://%s' % (request.scheme, request.host))
+    return render_template('index.html', api_base=base_url())
 
 @app.route("/api/static/<path:path>")
 def api_static_file(path):
-    local_path = join('static', path)
-    mime_type, _ = guess_type(path)
-    response = make_response(open(local_path).read())
-    response.headers['Content-Type'] = mime_type
-    return response
+    return send_from_directory('static', path)
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     manager.run()
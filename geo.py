@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+
+"""
+    Spatial helpers for organization maps: bounding box arguments, a grid
+    index of points so a viewport only looks at nearby cells, great circle
+    distances for nearby searches, and point clusters for map tiles.
+"""
+
+from math import floor, radians, degrees, sin, cos, asin, atan, sinh, sqrt, log, pi
+from collections import defaultdict
+
+
+def parse_bbox(value):
+    """
+        Parse a "minlon,minlat,maxlon,maxlat" argument into four floats.
+
+        A minimum longitude greater than the maximum means the box crosses
+        the antimeridian. Raises ValueError for anything else out of range.
+
+        >>> parse_bbox('-123.5,37,-122,38.25')
+        (-123.5, 37.0, -122.0, 38.25)
+    """
+    parts = tuple(float(part) for part in value.split(','))
+
+    if len(parts) != 4:
+        raise ValueError('Expected four comma-separated numbers, got %r' % value)
+
+    minlon, minlat, maxlon, maxlat = parts
+
+    if not (-180 <= minlon <= 180 and -180 <= maxlon <= 180):
+        raise ValueError('Longitudes must be between -180 and 180')
+
+    if not (-90 <= minlat <= maxlat <= 90):
+        raise ValueError('Latitudes must be between -90 and 90, minimum first')
+
+    return parts
+
+
+# Mean radius of the Earth.
+EARTH_RADIUS_KM = 6371.0088
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """
+        Great circle distance between two points, by the haversine formula.
+
+        >>> round(distance_km(37.8044, -122.2711, 37.7749, -122.4194), 1)
+        13.4
+    """
+    dlat, dlon = radians(lat2 - lat1), radians(lon2 - lon1)
+    a = sin(dlat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * asin(min(1, sqrt(a)))
+
+
+def radius_bbox(lat, lon, radius_km):
+    """
+        Return a bounding box holding every point within radius_km of a point.
+
+        Longitudes are widened at the box's edge nearest a pole, wrap around
+        the antimeridian like parse_bbox() boxes, and span the whole globe
+        when the circle covers a pole.
+
+        >>> [round(edge, 3) for edge in radius_bbox(0, 179.5, 111.195)]
+        [178.5, -1.0, -179.5, 1.0]
+    """
+    dlat = degrees(radius_km / EARTH_RADIUS_KM)
+    minlat, maxlat = max(-90, lat - dlat), min(90, lat + dlat)
+
+    if minlat == -90 or maxlat == 90:
+        return (-180.0, minlat, 180.0, maxlat)
+
+    # The widest span of longitude is at the latitude nearest a pole.
+    dlon = degrees(asin(min(1, sin(radians(dlat)) / cos(radians(lat)))))
+    minlon, maxlon = lon - dlon, lon + dlon
+    if minlon < -180:
+        minlon += 360
+    if maxlon > 180:
+        maxlon -= 360
+
+    return (minlon, minlat, maxlon, maxlat)
+
+
+def in_bbox(lon, lat, bbox):
+    """
+        True if the point lies inside the bounding box, edges included.
+
+        >>> in_bbox(179.5, 0, (170, -10, -170, 10))
+        True
+    """
+    minlon, minlat, maxlon, maxlat = bbox
+
+    if not minlat <= lat <= maxlat:
+        return False
+
+    if minlon <= maxlon:
+        return minlon <= lon <= maxlon
+
+    # Wraps around the antimeridian.
+    return lon >= minlon or lon <= maxlon
+
+
+class GridIndex(object):
+    """
+        Points bucketed into square cells of cell_size degrees, or of any
+        other unit for points that aren't longitude and latitude.
+
+        Searches only visit the cells a bounding box covers, or just the
+        occupied cells when there are fewer of those, and return items
+        in the order they were added.
+
+        >>> grid = GridIndex()
+        >>> grid.add(-122.4, 37.8, 'sf')
+        >>> grid.add(-74.0, 40.7, 'nyc')
+        >>> grid.search((-123, 37, -122, 38))
+        ['sf']
+    """
+
+    def __init__(self, cell_size=1.0):
+        self.cell_size = cell_size
+        self.cells = defaultdict(list)
+        self.count = 0
+
+    def cell(self, lon, lat):
+        return int(floor(lon / self.cell_size)), int(floor(lat / self.cell_size))
+
+    def add(self, lon, lat, item):
+        self.cells[self.cell(lon, lat)].append((self.count, lon, lat, item))
+        self.count += 1
+
+    def covered_cells(self, bbox):
+        """
+            Generate the cell keys a bounding box touches.
+        """
+        minlon, minlat, maxlon, maxlat = bbox
+        lon_ranges = [(minlon, maxlon)] if minlon <= maxlon else [(minlon, 180), (-180, maxlon)]
+        min_row, max_row = self.cell(0, minlat)[1], self.cell(0, maxlat)[1]
+
+        for (west, east) in lon_ranges:
+            min_col, max_col = self.cell(west, 0)[0], self.cell(east, 0)[0]
+            for col in range(min_col, max_col + 1):
+                for row in range(min_row, max_row + 1):
+                    yield col, row
+
+    def search(self, bbox):
+        """
+            Return the items whose points fall inside a bounding box.
+        """
+        minlon, minlat, maxlon, maxlat = bbox
+        rows = floor(maxlat / self.cell_size) - floor(minlat / self.cell_size) + 1
+        cols = 360 / self.cell_size if minlon > maxlon else (maxlon - minlon) / self.cell_size + 1
+
+        if rows * cols > len(self.cells):
+            keys = self.cells.keys()
+        else:
+            keys = set(self.covered_cells(bbox))
+
+        found = [entry for key in keys for entry in self.cells.get(key, ())
+                 if in_bbox(entry[1], entry[2], bbox)]
+
+        return [item for (order, lon, lat, item) in sorted(found)]
+
+
+# Web Mercator's latitude limits, where the map becomes square.
+MERCATOR_MAX_LAT = 85.0511287798
+
+
+def mercator(lon, lat):
+    """
+        Project a point onto the unit square of Web Mercator map tiles,
+        with x growing east and y growing south.
+
+        >>> mercator(0, 0)
+        (0.5, 0.5)
+    """
+    sin_lat = sin(radians(max(-MERCATOR_MAX_LAT, min(MERCATOR_MAX_LAT, lat))))
+    y = 0.5 - 0.25 * log((1 + sin_lat) / (1 - sin_lat)) / pi
+    return lon / 360.0 + 0.5, min(1.0, max(0.0, y))
+
+
+def unmercator(x, y):
+    """
+        Return the longitude and latitude of a point on the unit square.
+
+        >>> [round(n, 6) for n in unmercator(*mercator(-122.4194, 37.7749))]
+        [-122.4194, 37.7749]
+    """
+    return (x - 0.5) * 360, degrees(atan(sinh(pi * (1 - 2 * y))))
+
+
+class Cluster(object):
+    """
+        A point on the unit square standing for count points, carrying item
+        if it stands for just one. Zoom is the level it first appears at.
+    """
+
+    def __init__(self, x, y, count, item, zoom):
+        self.x, self.y = x, y
+        self.count, self.item, self.zoom = count, item, zoom
+
+    def lonlat(self):
+        return unmercator(self.x, self.y)
+
+
+class ClusterIndex(object):
+    """
+        Points grouped into clusters for every map zoom level, in the manner
+        of the supercluster library.
+
+        Working up from max_zoom to zoom 0, points and clusters within radius
+        pixels of each other on a tile extent pixels wide merge into one at
+        their weighted center. Zooms past max_zoom show every point, so the
+        number of clusters in a tile stays about the same however many
+        points there are.
+
+        >>> index = ClusterIndex([(-122.4, 37.8, 'sf'), (-122.35, 37.8, 'oak'), (-74.0, 40.7, 'nyc')])
+        >>> [(c.count, c.item) for c in index.tile(0, 0, 0)]
+        [(2, None), (1, 'nyc')]
+        >>> [(c.count, c.item) for c in index.tile(10, 163, 395)]
+        [(1, 'sf'), (1, 'oak')]
+    """
+
+    def __init__(self, points, radius=40, extent=512, max_zoom=16):
+        self.max_zoom = max_zoom
+        self.levels = dict()
+
+        zoom = max_zoom + 1
+        clusters = [Cluster(x, y, 1, item, zoom) for (x, y, item) in
+                    ((mercator(lon, lat) + (item, )) for (lon, lat, item) in points)]
+        self.levels[zoom] = self.tile_index(clusters, zoom)
+
+        for zoom in range(max_zoom, -1, -1):
+            clusters = self.merge(clusters, radius / float(extent * 2 ** zoom), zoom)
+            self.levels[zoom] = self.tile_index(clusters, zoom)
+
+    @staticmethod
+    def tile_index(clusters, zoom):
+        """
+            Index clusters by the tile they fall in at a zoom level.
+        """
+        grid = GridIndex(1.0 / 2 ** zoom)
+        for cluster in clusters:
+            grid.add(cluster.x, cluster.y, cluster)
+        return grid
+
+    @staticmethod
+    def merge(clusters, radius, zoom):
+        """
+            Merge clusters within radius of each other into new ones at zoom.
+        """
+        grid = GridIndex(radius)
+        for (index, cluster) in enumerate(clusters):
+            grid.add(cluster.x, cluster.y, index)
+
+        merged, done = [], [False] * len(clusters)
+
+        for (index, cluster) in enumerate(clusters):
+            if done[index]:
+                continue
+
+            done[index] = True
+            box = (cluster.x - radius, cluster.y - radius, cluster.x + radius, cluster.y + radius)
+            neighbors = [n for n in grid.search(box) if not done[n] and
+                         (clusters[n].x - cluster.x) ** 2 + (clusters[n].y - cluster.y) ** 2 <= radius ** 2]
+
+            if not neighbors:
+                merged.append(cluster)
+                continue
+
+            count, x, y = cluster.count, cluster.x * cluster.count, cluster.y * cluster.count
+
+            for n in neighbors:
+                done[n] = True
+                count += clusters[n].count
+                x += clusters[n].x * clusters[n].count
+                y += clusters[n].y * clusters[n].count
+
+            merged.append(Cluster(x / count, y / count, count, None, zoom))
+
+        return merged
+
+    def tile(self, zoom, x, y):
+        """
+            Return the clusters in one map tile.
+        """
+        size = 1.0 / 2 ** zoom
+        level = self.levels[min(zoom, self.max_zoom + 1)]
+        return level.search((x * size, y * size, (x + 1) * size, (y + 1) * size))
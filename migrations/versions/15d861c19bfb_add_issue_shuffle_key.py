@@ -0,0 +1,30 @@
+"""Add issue shuffle key
+
+Revision ID: 15d861c19bfb
+Revises: None
+Create Date: 2026-10-18 19:04:18.424500
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '15d861c19bfb'
+down_revision = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('issue', sa.Column('shuffle_key', sa.Float(), nullable=True))
+
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute('UPDATE issue SET shuffle_key = abs(random()) / 9223372036854775807.0')
+    else:
+        op.execute('UPDATE issue SET shuffle_key = random()')
+
+    op.create_index('ix_issue_shuffle_key', 'issue', ['shuffle_key'])
+
+
+def downgrade():
+    op.drop_index('ix_issue_shuffle_key', 'issue')
+    op.drop_column('issue', 'shuffle_key')
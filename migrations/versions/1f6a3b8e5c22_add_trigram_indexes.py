@@ -0,0 +1,43 @@
+"""Add trigram indexes for ilike filters
+
+Revision ID: 1f6a3b8e5c22
+Revises: 52c7e0a1d4f3
+Create Date: 2026-10-18 23:14:37.502164
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1f6a3b8e5c22'
+down_revision = '52c7e0a1d4f3'
+
+from alembic import op
+import sqlalchemy as sa
+
+indexed = (
+    ('organization', ('name', 'type', 'city')),
+    ('project', ('name', 'type', 'categories')),
+    ('issue', ('title', )),
+    ('event', ('name', )),
+    ('story', ('title', ))
+    )
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+    for (table, columns) in indexed:
+        for column in columns:
+            op.execute('CREATE INDEX ix_%s_%s_trgm ON %s USING gin (%s gin_trgm_ops)' % (table, column, table, column))
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    # The pg_trgm extension is left installed.
+    for (table, columns) in indexed:
+        for column in columns:
+            op.drop_index('ix_%s_%s_trgm' % (table, column), table)
@@ -0,0 +1,26 @@
+"""Add update generation counters
+
+Revision ID: 3a4c2f0e7b91
+Revises: 15d861c19bfb
+Create Date: 2026-10-18 20:12:41.218306
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a4c2f0e7b91'
+down_revision = '15d861c19bfb'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('generation',
+        sa.Column('name', sa.Unicode(), nullable=False),
+        sa.Column('counter', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('generation')
@@ -0,0 +1,22 @@
+"""Add update time to generation counters
+
+Revision ID: 4e1b9d2c6a07
+Revises: 3a4c2f0e7b91
+Create Date: 2026-10-18 21:03:12.774520
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4e1b9d2c6a07'
+down_revision = '3a4c2f0e7b91'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('generation', sa.Column('updated', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('generation', 'updated')
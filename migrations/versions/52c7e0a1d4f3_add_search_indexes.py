@@ -0,0 +1,56 @@
+"""Add full-text search indexes
+
+Revision ID: 52c7e0a1d4f3
+Revises: 4e1b9d2c6a07
+Create Date: 2026-10-18 22:26:05.118842
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '52c7e0a1d4f3'
+down_revision = '4e1b9d2c6a07'
+
+from alembic import op
+import sqlalchemy as sa
+
+searchable = (
+    ('project', ('name', 'description', 'categories')),
+    ('issue', ('title', 'body')),
+    ('story', ('title', ))
+    )
+
+
+def upgrade():
+    dialect_name = op.get_bind().dialect.name
+
+    for (name, columns) in searchable:
+        if dialect_name == 'postgresql':
+            document = " || ' ' || ".join("coalesce(%s, '')" % c for c in columns)
+            op.execute("CREATE INDEX ix_%s_search ON %s USING gin (to_tsvector('english', %s))" % (name, name, document))
+
+        elif dialect_name == 'sqlite':
+            fts = '%s_search' % name
+            names = ', '.join(columns)
+            new_values = ', '.join('new.%s' % c for c in columns)
+            old_values = ', '.join('old.%s' % c for c in columns)
+            insert = "INSERT INTO %s (rowid, %s) VALUES (new.id, %s);" % (fts, names, new_values)
+            delete = "INSERT INTO %s (%s, rowid, %s) VALUES ('delete', old.id, %s);" % (fts, fts, names, old_values)
+
+            op.execute("CREATE VIRTUAL TABLE %s USING fts5(%s, content='%s', content_rowid='id', tokenize='porter unicode61')" % (fts, names, name))
+            op.execute('CREATE TRIGGER %s_insert AFTER INSERT ON %s BEGIN %s END' % (fts, name, insert))
+            op.execute('CREATE TRIGGER %s_delete AFTER DELETE ON %s BEGIN %s END' % (fts, name, delete))
+            op.execute('CREATE TRIGGER %s_update AFTER UPDATE OF %s ON %s BEGIN %s %s END' % (fts, names, name, delete, insert))
+            op.execute("INSERT INTO %s (%s) VALUES ('rebuild')" % (fts, fts))
+
+
+def downgrade():
+    dialect_name = op.get_bind().dialect.name
+
+    for (name, columns) in searchable:
+        if dialect_name == 'postgresql':
+            op.drop_index('ix_%s_search' % name, name)
+
+        elif dialect_name == 'sqlite':
+            for action in ('insert', 'delete', 'update'):
+                op.execute('DROP TRIGGER %s_search_%s' % (name, action))
+            op.execute('DROP TABLE %s_search' % name)
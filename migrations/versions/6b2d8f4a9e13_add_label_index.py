@@ -0,0 +1,54 @@
+"""Add label index
+
+Revision ID: 6b2d8f4a9e13
+Revises: 1f6a3b8e5c22
+Create Date: 2026-10-19 00:02:51.640218
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6b2d8f4a9e13'
+down_revision = '1f6a3b8e5c22'
+
+from alembic import op
+import sqlalchemy as sa
+from collections import defaultdict
+import json
+
+
+def upgrade():
+    op.create_table('label_index',
+        sa.Column('organization_name', sa.Unicode(), nullable=False),
+        sa.Column('name', sa.Unicode(), nullable=False),
+        sa.Column('issue_ids', sa.Unicode(), nullable=True),
+        sa.ForeignKeyConstraint(['organization_name'], ['organization.name'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('organization_name', 'name')
+    )
+
+    # Index the labels already in the database, like index_labels() does.
+    labels = op.get_bind().execute('''
+        SELECT project.organization_name, label.name, label.issue_id
+        FROM label JOIN issue ON issue.id = label.issue_id
+        JOIN project ON project.id = issue.project_id
+        WHERE project.organization_name IS NOT NULL AND label.name IS NOT NULL
+        ''')
+
+    issue_ids = defaultdict(set)
+    for (organization_name, name, issue_id) in labels:
+        issue_ids[(organization_name, name.lower())].add(issue_id)
+
+    rows = [dict(organization_name=organization_name, name=name, issue_ids=unicode(json.dumps(sorted(ids))))
+            for ((organization_name, name), ids) in issue_ids.items()]
+
+    label_index = sa.sql.table('label_index',
+        sa.sql.column('organization_name', sa.Unicode()),
+        sa.sql.column('name', sa.Unicode()),
+        sa.sql.column('issue_ids', sa.Unicode())
+    )
+
+    if rows:
+        op.bulk_insert(label_index, rows)
+
+
+def downgrade():
+    op.drop_table('label_index')
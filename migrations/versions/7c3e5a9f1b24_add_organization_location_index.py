@@ -0,0 +1,54 @@
+"""Add organization location index
+
+Revision ID: 7c3e5a9f1b24
+Revises: 6b2d8f4a9e13
+Create Date: 2026-10-19 01:02:41.660318
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c3e5a9f1b24'
+down_revision = '6b2d8f4a9e13'
+
+from alembic import op
+import sqlalchemy as sa
+
+insert = ('INSERT INTO organization_location (minlon, maxlon, minlat, maxlat, name) '
+          'SELECT new.longitude, new.longitude, new.latitude, new.latitude, new.name '
+          'WHERE new.latitude IS NOT NULL AND new.longitude IS NOT NULL;')
+delete = 'DELETE FROM organization_location WHERE name = old.name;'
+
+
+def upgrade():
+    bind = op.get_bind()
+
+    if bind.dialect.name == 'postgresql':
+        # Use earthdistance where the server has it, latitude and longitude otherwise.
+        if bind.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'earthdistance'").scalar():
+            op.execute('CREATE EXTENSION IF NOT EXISTS cube')
+            op.execute('CREATE EXTENSION IF NOT EXISTS earthdistance')
+            op.execute('CREATE INDEX ix_organization_location ON organization USING gist (ll_to_earth(latitude, longitude))')
+        else:
+            op.create_index('ix_organization_location', 'organization', ['latitude', 'longitude'])
+
+    elif bind.dialect.name == 'sqlite':
+        op.execute('CREATE VIRTUAL TABLE organization_location USING rtree(id, minlon, maxlon, minlat, maxlat, +name)')
+        op.execute('CREATE TRIGGER organization_location_insert AFTER INSERT ON organization BEGIN %s END' % insert)
+        op.execute('CREATE TRIGGER organization_location_delete AFTER DELETE ON organization BEGIN %s END' % delete)
+        op.execute('CREATE TRIGGER organization_location_update AFTER UPDATE OF name, latitude, longitude ON organization BEGIN %s %s END' % (delete, insert))
+        op.execute('INSERT INTO organization_location (minlon, maxlon, minlat, maxlat, name) '
+                   'SELECT longitude, longitude, latitude, latitude, name FROM organization '
+                   'WHERE latitude IS NOT NULL AND longitude IS NOT NULL')
+
+
+def downgrade():
+    bind = op.get_bind()
+
+    if bind.dialect.name == 'postgresql':
+        # The cube and earthdistance extensions are left installed.
+        op.drop_index('ix_organization_location', 'organization')
+
+    elif bind.dialect.name == 'sqlite':
+        for action in ('insert', 'delete', 'update'):
+            op.execute('DROP TRIGGER organization_location_%s' % action)
+        op.execute('DROP TABLE organization_location')
@@ -0,0 +1,36 @@
+"""Add filter and sort indexes
+
+Revision ID: 8d4f6b0a2c35
+Revises: 7c3e5a9f1b24
+Create Date: 2026-10-19 02:11:53.207419
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d4f6b0a2c35'
+down_revision = '7c3e5a9f1b24'
+
+from alembic import op
+import sqlalchemy as sa
+
+indexes = (
+    ('ix_event_organization_name_start_time_notz', 'event', ['organization_name', 'start_time_notz']),
+    ('ix_event_start_time_notz', 'event', ['start_time_notz']),
+    ('ix_project_organization_name_last_updated', 'project', ['organization_name', 'last_updated']),
+    ('ix_project_last_updated', 'project', ['last_updated']),
+    ('ix_project_name_organization_name', 'project', ['name', 'organization_name']),
+    ('ix_project_code_url', 'project', ['code_url']),
+    ('ix_story_organization_name_link', 'story', ['organization_name', 'link']),
+    ('ix_issue_project_id_title', 'issue', ['project_id', 'title']),
+    ('ix_label_issue_id_name', 'label', ['issue_id', 'name'])
+    )
+
+
+def upgrade():
+    for (name, table, columns) in indexes:
+        op.create_index(name, table, columns)
+
+
+def downgrade():
+    for (name, table, columns) in reversed(indexes):
+        op.drop_index(name, table)
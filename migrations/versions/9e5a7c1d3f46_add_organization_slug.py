@@ -0,0 +1,53 @@
+"""Add organization slug
+
+Revision ID: 9e5a7c1d3f46
+Revises: 8d4f6b0a2c35
+Create Date: 2026-10-19 03:05:12.884730
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9e5a7c1d3f46'
+down_revision = '8d4f6b0a2c35'
+
+from alembic import op
+import sqlalchemy as sa
+
+organization = sa.sql.table('organization', sa.sql.column('name', sa.Unicode()), sa.sql.column('slug', sa.Unicode()))
+generation = sa.sql.table('generation', sa.sql.column('name', sa.Unicode()))
+
+
+def safe_name(name):
+    return name.replace(' ', '-').replace('/', '-').replace('?','-').replace('#','-')
+
+
+def upgrade():
+    op.add_column('organization', sa.Column('slug', sa.Unicode(), nullable=True))
+
+    bind = op.get_bind()
+    slugs = set()
+
+    # Fill in slugs, and count updates per slug instead of per name.
+    for (name, ) in bind.execute(sa.select([organization.c.name]).order_by(organization.c.name)).fetchall():
+        slug, number = safe_name(name), 1
+
+        # Names that differ only by dashes and spaces get numbered slugs.
+        while slug in slugs:
+            number += 1
+            slug = '%s-%d' % (safe_name(name), number)
+        slugs.add(slug)
+
+        op.execute(organization.update().where(organization.c.name == name).values(slug=slug))
+        op.execute(generation.update().where(generation.c.name == name).values(name=slug))
+
+    op.create_index('ix_organization_slug', 'organization', ['slug'], unique=True)
+
+
+def downgrade():
+    bind = op.get_bind()
+
+    for (name, slug) in bind.execute(sa.select([organization.c.name, organization.c.slug])).fetchall():
+        op.execute(generation.update().where(generation.c.name == slug).values(name=name))
+
+    op.drop_index('ix_organization_slug', 'organization')
+    op.drop_column('organization', 'slug')
@@ -0,0 +1,28 @@
+"""Add project issues count
+
+Revision ID: a0f6b8d2e457
+Revises: 9e5a7c1d3f46
+Create Date: 2026-10-19 05:14:37.502186
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a0f6b8d2e457'
+down_revision = '9e5a7c1d3f46'
+
+from alembic import op
+import sqlalchemy as sa
+
+project = sa.sql.table('project', sa.sql.column('id', sa.Integer()), sa.sql.column('issues_count', sa.Integer()))
+issue = sa.sql.table('issue', sa.sql.column('id', sa.Integer()), sa.sql.column('project_id', sa.Integer()))
+
+
+def upgrade():
+    op.add_column('project', sa.Column('issues_count', sa.Integer(), nullable=True))
+
+    count = sa.select([sa.func.count(issue.c.id)]).where(issue.c.project_id == project.c.id).as_scalar()
+    op.execute(project.update().values(issues_count=count))
+
+
+def downgrade():
+    op.drop_column('project', 'issues_count')
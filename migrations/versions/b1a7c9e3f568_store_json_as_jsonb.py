@@ -0,0 +1,35 @@
+"""Store JSON as JSONB
+
+Revision ID: b1a7c9e3f568
+Revises: a0f6b8d2e457
+Create Date: 2026-10-19 06:02:18.337941
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b1a7c9e3f568'
+down_revision = 'a0f6b8d2e457'
+
+from alembic import op
+import sqlalchemy as sa
+
+columns = (('project', 'github_details'), ('label_index', 'issue_ids'))
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        # Other databases keep JSON as text.
+        return
+
+    for (table, column) in columns:
+        op.execute('ALTER TABLE %(table)s ALTER COLUMN %(column)s TYPE JSONB '
+                   "USING NULLIF(%(column)s, '')::jsonb" % dict(table=table, column=column))
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    for (table, column) in columns:
+        op.execute('ALTER TABLE %(table)s ALTER COLUMN %(column)s TYPE VARCHAR '
+                   'USING %(column)s::text' % dict(table=table, column=column))
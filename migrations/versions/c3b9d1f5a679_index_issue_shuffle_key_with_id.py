@@ -0,0 +1,25 @@
+"""Index issue shuffle key with id
+
+Revision ID: c3b9d1f5a679
+Revises: b1a7c9e3f568
+Create Date: 2026-10-19 09:14:37.502261
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c3b9d1f5a679'
+down_revision = 'b1a7c9e3f568'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Seeded shuffles order by shuffle_key, then id.
+    op.create_index('ix_issue_shuffle_key_id', 'issue', ['shuffle_key', 'id'])
+    op.drop_index('ix_issue_shuffle_key', 'issue')
+
+
+def downgrade():
+    op.create_index('ix_issue_shuffle_key', 'issue', ['shuffle_key'])
+    op.drop_index('ix_issue_shuffle_key_id', 'issue')
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+
+"""
+    Per-request SQL statistics: how many statements ran, how long they
+    took, and which statement shapes repeated, as an N+1 query would.
+
+    Statements are only tallied by their text while a request runs, and
+    reduced to shapes when someone asks, so counting stays cheap.
+"""
+
+import re
+from hashlib import md5
+from collections import defaultdict
+
+literals = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'%\(\w+\)s'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\?(?:\s*,\s*\?)+'), '?'),
+    (re.compile(r'\s+'), ' ')
+    )
+
+
+def normalize(statement):
+    """
+        Reduce a statement to its shape, with literals and parameters as ?.
+
+        Lists of parameters collapse to one, so IN clauses of any length match.
+
+        >>> normalize("SELECT id FROM issue\\nWHERE project_id IN (%(id_1)s, %(id_2)s) AND title = 'It''s'")
+        'SELECT id FROM issue WHERE project_id IN (?) AND title = ?'
+    """
+    for (pattern, replacement) in literals:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+def fingerprint(statement):
+    """
+        Short, stable name for a statement's shape.
+
+        >>> fingerprint('SELECT 1') == fingerprint('SELECT  2')
+        True
+    """
+    return md5(normalize(statement).encode('utf8')).hexdigest()[:12]
+
+
+class QueryStats(object):
+    """
+        Statements run while handling one request, and their time in seconds.
+
+        Shapes run repeat_threshold times or more count as repeated. While
+        counting, only identical statement text is noticed, in has_repeats().
+
+        >>> stats = QueryStats()
+        >>> for n in range(5):
+        ...     stats.add('SELECT * FROM label WHERE issue_id = %d' % n, .002)
+        >>> stats.add('SELECT * FROM issue', .01)
+        >>> stats.count, stats.has_repeats(), [shape['count'] for shape in stats.repeated()]
+        (6, False, [5])
+        >>> stats.server_timing(.05)
+        'db;dur=20.0;desc="6 queries", total;dur=50.0'
+        >>> for n in range(5):
+        ...     stats.add('SELECT * FROM label WHERE issue_id = %(issue_id)s', .001)
+        >>> stats.has_repeats()
+        True
+    """
+    repeat_threshold = 5
+
+    def __init__(self):
+        self.count, self.seconds = 0, 0.
+        self.statements = defaultdict(lambda: [0, 0.])
+        self.most_repeats = 0
+
+    def add(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        tally = self.statements[statement]
+        tally[0] += 1
+        tally[1] += seconds
+        self.most_repeats = max(self.most_repeats, tally[0])
+
+    def has_repeats(self):
+        """
+            Return True if any one statement text ran repeat_threshold times.
+        """
+        return self.most_repeats >= self.repeat_threshold
+
+    def shapes(self):
+        """
+            Return statement shapes with their counts and milliseconds, slowest first.
+        """
+        shapes = dict()
+
+        for (statement, (count, seconds)) in self.statements.items():
+            sql = normalize(statement)
+            shape = shapes.setdefault(sql, dict(fingerprint=fingerprint(sql), sql=sql, count=0, ms=0.))
+            shape['count'] += count
+            shape['ms'] += seconds * 1000
+
+        for shape in shapes.values():
+            shape['ms'] = round(shape['ms'], 1)
+
+        return sorted(shapes.values(), key=lambda shape: (-shape['ms'], shape['sql']))
+
+    def repeated(self, shapes=None):
+        """
+            Return the shapes run at least repeat_threshold times, out of
+            shapes() or a list it already returned.
+        """
+        shapes = self.shapes() if shapes is None else shapes
+        return [shape for shape in shapes if shape['count'] >= self.repeat_threshold]
+
+    def server_timing(self, seconds):
+        """
+            Return a Server-Timing header value for these statements and a request's total time.
+        """
+        return 'db;dur=%.1f;desc="%d queries", total;dur=%.1f' % (self.seconds * 1000, self.count, seconds * 1000)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
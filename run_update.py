@@ -14,7 +14,8 @@ from dateutil.tz import tzoffset
 from unidecode import unidecode
 from feeds import extract_feed_links, get_first_working_feed_link
 import feedparser
-from app import db, app, Project, Organization, Story, Event, Error, Issue, Label, is_safe_name
+from app import db, app, Project, Organization, Story, Event, Error, Issue, Label, is_safe_name, safe_name, slug_owner, bump_generations
+from app import organization_key, purge_surrogate_keys, index_labels, count_issues, LabelIndex
 from urllib2 import HTTPError, URLError
 from urlparse import urlparse
 from random import shuffle
@@ -562,6 +563,8 @@ def save_organization_info(session, org_dict):
     for (field, value) in org_dict.items():
         setattr(existing_org, field, value)
 
+    existing_org.slug = safe_name(existing_org.name)
+
     # Flush existing object, to prevent a sqlalchemy.orm.exc.StaleDataError.
     session.flush()
 
@@ -683,6 +686,29 @@ def save_story_info(session, story_dict):
     # Flush existing object, to prevent a sqlalchemy.orm.exc.StaleDataError.
     session.flush()
 
+def shuffle_issues(session):
+    ''' Give every issue a new random shuffle key, for seeded issue pages.
+    '''
+    if session.bind.dialect.name == 'sqlite':
+        # SQLite's random() is a signed 64-bit integer.
+        shuffle_key = db.func.abs(db.func.random()) / 9223372036854775807.0
+    else:
+        shuffle_key = db.func.random()
+
+    session.execute(db.update(Issue, values={'shuffle_key': shuffle_key}))
+    bump_generations(session)
+    session.commit()
+
+def purge_cached_responses(*organization_names):
+    ''' Purge responses about these organizations, and every list, from the caching proxy.
+    '''
+    keys = [organization_key(name) for name in organization_names] + ['lists']
+
+    try:
+        purge_surrogate_keys(keys)
+    except Exception, e:
+        logging.error('Could not purge cached responses: %s' % e)
+
 def get_event_group_identifier(events_url):
     parse_result = urlparse(events_url)
     url_parts = parse_result.path.split('/')
@@ -720,6 +746,18 @@ def main(org_name=None, org_sources=None):
           db.session.commit()
           continue
 
+      # Organization slugs are unique, so the first name to take one keeps it.
+      other_name = slug_owner(db.session, org_info['name'])
+      if other_name:
+          error_dict = {
+            "error" : 'ValueError: Organization name "%s" has the same slug as "%s"' % (org_info['name'], other_name),
+            "time" : datetime.now()
+          }
+          new_error = Error(**error_dict)
+          db.session.add(new_error)
+          db.session.commit()
+          continue
+
       try:
         filter = Organization.name == org_info['name']
         existing_org = db.session.query(Organization).filter(filter).first()
@@ -782,28 +820,45 @@ def main(org_name=None, org_sources=None):
         db.session.query(Issue).filter(Issue.keep == False).delete()
         db.session.query(Organization).filter(not Organization.keep).delete()
 
+        # Index the remaining issues by label.
+        index_labels(db.session, organization.name)
+
+        # Count the remaining issues of each project.
+        count_issues(db.session, organization.name)
+
       except:
         # Raise the error, get out of main(), and don't commit the transaction.
         raise
 
       else:
         # Commit and move on to the next organization.
+        bump_generations(db.session, organization.name)
+        purge_name = organization.name # expires with the commit
         db.session.commit()
+        purge_cached_responses(purge_name)
 
     # Stop right here if an org name was specified.
     if org_name:
         return
 
+    # Reshuffle the issue finder's seeded ordering, on full runs only.
+    shuffle_issues(db.session)
+    purge_cached_responses()
+
     # Delete any organization not found on this round.
     for bad_org in db.session.query(Organization):
         if bad_org.name in organization_names:
             continue
 
+        db.session.execute(db.delete(LabelIndex).where(LabelIndex.organization_name == bad_org.name))
         db.session.execute(db.delete(Event).where(Event.organization_name == bad_org.name))
         db.session.execute(db.delete(Story).where(Story.organization_name == bad_org.name))
         db.session.execute(db.delete(Project).where(Project.organization_name == bad_org.name))
         db.session.execute(db.delete(Organization).where(Organization.name == bad_org.name))
+        bump_generations(db.session, bad_org.name)
+        purge_name = bad_org.name
         db.session.commit()
+        purge_cached_responses(purge_name)
 
 parser = ArgumentParser(description='''Update database from CSV source URL.''')
 parser.add_argument('--name', dest='name', help='Single organization name to update.')
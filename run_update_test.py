@@ -232,6 +232,87 @@ class RunUpdateTestCase(unittest.TestCase):
         self.assertEqual(third_event.start_time_notz, datetime.datetime(2014, 3, 5, 17, 30, 0))
         self.assertEqual(third_event.name, 'Brigade Ideation (Brainstorm and Prototyping) Session.')
 
+    def test_shuffle_issues(self):
+        ''' Every issue gets a new shuffle key between 0 and 1.
+        '''
+        from factories import IssueFactory
+        from app import Issue, Generation
+        import run_update
+
+        for issue in (IssueFactory(), IssueFactory()):
+            issue.shuffle_key = 5.0
+        self.db.session.commit()
+
+        run_update.shuffle_issues(self.db.session)
+
+        keys = [issue.shuffle_key for issue in self.db.session.query(Issue)]
+        self.assertEqual(len(keys), 2)
+        for key in keys:
+            self.assertTrue(0 <= key < 1)
+
+        # Cached responses are invalidated
+        generation = self.db.session.query(Generation).get(u'')
+        self.assertEqual(generation.counter, 1)
+
+    def test_main_with_org_name_keeps_shuffle(self):
+        ''' Updating one organization leaves the issue shuffle alone.
+        '''
+        from app import Issue
+
+        # Not from the factory, whose organization names other tests count on.
+        issue = Issue(u'Shuffled')
+        issue.shuffle_key = 0.5
+        self.db.session.add(issue)
+        self.db.session.commit()
+
+        def response_content(url, request):
+            if "docs.google.com" in url:
+                return response(200, '''name,website,events_url,rss,projects_list_url\nCode for Oakland,,,,''')
+
+            else:
+                raise Exception('Asked for unknown URL ' + url.geturl())
+
+        with HTTMock(response_content):
+            import run_update
+            run_update.main(org_name=u'Code for Oakland', org_sources="test_org_sources.csv")
+
+        self.assertEqual([issue.shuffle_key for issue in self.db.session.query(Issue)], [0.5])
+
+    def test_main_purges_cached_responses(self):
+        ''' Each updated organization, and every list, is purged from the caching proxy.
+        '''
+        from app import app
+        purges = []
+
+        def response_content(url, request):
+            if "docs.google.com" in url:
+                return response(200, '''name,website,events_url,rss,projects_list_url\nCode for Oakland,,,,''')
+
+            elif url.geturl() == 'http://proxy.example.com/':
+                purges.append((request.method, request.headers['Surrogate-Key']))
+                return response(200 if len(purges) == 1 else 500, '')
+
+            else:
+                raise Exception('Asked for unknown URL ' + url.geturl())
+
+        import logging
+        logging.error = Mock()
+
+        app.config['PURGE_URL'] = 'http://proxy.example.com/'
+
+        try:
+            with HTTMock(response_content):
+                import run_update
+                run_update.main(org_sources="test_org_sources.csv")
+        finally:
+            app.config['PURGE_URL'] = None
+
+        self.assertEqual(purges, [('PURGE', 'lists organization/Code-for-Oakland'), ('PURGE', 'lists')])
+
+        # A failing proxy is logged, not raised
+        self.assertEqual(logging.error.call_count, 1)
+        self.assertTrue('Could not purge' in logging.error.call_args[0][0])
+
     def test_main_with_missing_projects(self):
         ''' When github returns a 404 when trying to retrieve project data,
             an error message should be logged.
@@ -337,6 +418,26 @@ class RunUpdateTestCase(unittest.TestCase):
       orgs_count = self.db.session.query(Organization).count()
       self.assertEqual(orgs_count, 1)
 
+    def test_main_with_colliding_organization_slugs(self):
+      ''' When two org names have the same slug, test that the second is skipped with an error instead of stopping the update
+      '''
+
+      def response_content(url, request):
+          return response(200, '''name,website,events_url,rss,projects_list_url\nCode for Winston-Salem,http://codeforws.org,,,\nCode for Winston Salem,http://codeforws.org,,,\nCode for America,http://codeforamerica.org,,,''')
+
+      with HTTMock(response_content):
+          import run_update
+          run_update.main(org_sources="test_org_sources.csv")
+          from app import Error
+          errors = self.db.session.query(Error).all()
+          self.assertEqual(len(errors), 1)
+          self.assertTrue("same slug" in errors[0].error)
+
+      # Make sure the other organizations were all updated
+      from app import Organization
+      slugs = [slug for (slug, ) in self.db.session.query(Organization.slug).order_by(Organization.slug)]
+      self.assertEqual(slugs, [u'Code-for-America', u'Code-for-Winston-Salem'])
+
     def test_main_with_bad_events_url(self):
         ''' When an organization has a badly formed events url is passed, no events are saved
         '''
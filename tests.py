@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf8 -*-
 
-import unittest, requests, json, os
+import unittest, requests, json, os, logging
 from datetime import datetime, timedelta
 from urlparse import urlparse
+from collections import Mapping
+from urllib import urlencode
+from base64 import urlsafe_b64encode
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import DBAPIError
 
-from app import app, db, Organization, Project, Event, Story, Issue, Label
+from app import app, db, LazyJson, LazyJsonArray, Generation, Organization, Project, Event, Story, Issue, Label, bump_generations, replica_lag, response_cache, accepted_keys, snapshots, asdict_memo, search_select, index_labels, count_issues, shuffle_issues, event_rows, issue_rows, project_rows, is_safe_name
 from factories import OrganizationFactory, ProjectFactory, EventFactory, StoryFactory, IssueFactory, LabelFactory
 
 class ApiTest(unittest.TestCase):
@@ -13,6 +18,16 @@ class ApiTest(unittest.TestCase):
     def setUp(self):
         # Set up the database settings
         app.config['SQLALCHEMY_DATABASE_URI'] = 'postgres://postgres@localhost/civic_json_worker_test'
+        app.config['RESPONSE_CACHE_SIZE'] = 0
+        app.config['STREAM_PAGE_SIZE'] = 100
+        app.config['EMBEDDED_ISSUES'] = 10
+        app.config['SQLALCHEMY_BINDS'] = None
+        app.config['QUERY_STATS'] = False
+        response_cache.clear()
+        accepted_keys.clear()
+        replica_lag.clear()
+        snapshots.clear()
+        asdict_memo.clear()
         db.create_all()
         self.app = app.test_client()
 
@@ -20,6 +35,46 @@ class ApiTest(unittest.TestCase):
         db.session.close()
         db.drop_all()
 
+    def count_queries(self, url, **kwargs):
+        ''' Return the response for a GET request and the number of SQL statements it ran.
+        '''
+        response, statements = self.queries(url, **kwargs)
+        return response, len(statements)
+
+    def queries(self, url, **kwargs):
+        ''' Return the response for a GET request and the SQL statements it ran.
+        '''
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = self.app.get(url, **kwargs)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        return response, statements
+
+    def explain(self, statement):
+        ''' Return the Postgres query plan for a statement, with sequential scans discouraged.
+
+            Test tables are tiny, so the planner would scan them all regardless.
+        '''
+        connection = db.session.connection()
+        connection.execute('SET enable_seqscan = off')
+        statement = statement.compile(dialect=connection.dialect)
+        rows = connection.execute('EXPLAIN ' + unicode(statement), statement.params)
+
+        return '\n'.join(row[0] for row in rows)
+
+    def follow(self, url):
+        ''' GET a link from an API response.
+        '''
+        _, _, path, _, query, _ = urlparse(url)
+        return self.app.get(path + '?' + query)
+
     # Test API -----------------------
     def test_current_projects(self):
         '''
@@ -298,6 +353,177 @@ class ApiTest(unittest.TestCase):
         assert isinstance(response['objects'][0]['last_updated'], float)
         assert isinstance(response['objects'][0]['started_on'], unicode)
 
+    def test_organizations_geojson(self):
+        OrganizationFactory(name=u'Code for San Francisco')
+        OrganizationFactory(name=u'Code for New York', latitude=40.7128, longitude=-74.0059)
+        OrganizationFactory(name=u'Code for Fiji', latitude=-18.1416, longitude=178.4419)
+        OrganizationFactory(name=u'Code for Nowhere', latitude=None, longitude=None)
+        db.session.commit()
+
+        response = self.app.get('/api/organizations.geojson')
+        self.assertEqual(response.mimetype, 'application/json')
+        response = json.loads(response.data)
+        self.assertEqual(response['type'], 'FeatureCollection')
+        self.assertEqual(len(response['features']), 4)
+        feature = [f for f in response['features'] if f['id'] == 'Code-for-San-Francisco'][0]
+        self.assertEqual(feature['type'], 'Feature')
+        self.assertEqual(feature['geometry'], dict(type='Point', coordinates=[-122.4194, 37.7749]))
+        self.assertEqual(feature['properties']['name'], u'Code for San Francisco')
+        self.assertEqual(feature['properties']['api_url'], 'http://localhost/api/organizations/Code-for-San-Francisco')
+
+        # Only located organizations inside the box
+        response = json.loads(self.app.get('/api/organizations.geojson?bbox=-125,30,-100,45').data)
+        self.assertEqual([f['id'] for f in response['features']], ['Code-for-San-Francisco'])
+
+        response = json.loads(self.app.get('/api/organizations.geojson?bbox=-180,-90,180,90').data)
+        self.assertEqual(len(response['features']), 3)
+
+        # Boxes can cross the antimeridian
+        response = json.loads(self.app.get('/api/organizations.geojson?bbox=170,-20,-170,0').data)
+        self.assertEqual([f['id'] for f in response['features']], ['Code-for-Fiji'])
+
+        for bbox in ('1,2,3', '-125,45,-100,30', 'a,b,c,d', '-200,30,-100,45'):
+            response = self.app.get('/api/organizations.geojson?bbox=' + bbox)
+            self.assertEqual(response.status_code, 400)
+
+    def test_organizations_geojson_snapshot(self):
+        ''' Features are serialized once per update, whatever the bounding box.
+        '''
+        app.config['RESPONSE_CACHE_SIZE'] = 8
+        OrganizationFactory(name=u'Code for San Francisco')
+        db.session.commit()
+
+        self.app.get('/api/organizations.geojson')
+        response, queries = self.count_queries('/api/organizations.geojson?bbox=-125,30,-100,45')
+        self.assertEqual(len(json.loads(response.data)['features']), 1)
+        self.assertEqual(queries, 1)
+
+        OrganizationFactory(name=u'Code for Oakland', latitude=37.8044, longitude=-122.2711)
+        bump_generations(db.session)
+        db.session.commit()
+
+        response = json.loads(self.app.get('/api/organizations.geojson?bbox=-125,30,-100,45').data)
+        self.assertEqual(len(response['features']), 2)
+
+    def test_organization_clusters(self):
+        OrganizationFactory(name=u'Code for San Francisco', latitude=37.8, longitude=-122.4)
+        OrganizationFactory(name=u'Code for Oakland', latitude=37.8, longitude=-122.35)
+        OrganizationFactory(name=u'Code for New York', latitude=40.7128, longitude=-74.0059)
+        OrganizationFactory(name=u'Code for Nowhere', latitude=None, longitude=None)
+        db.session.commit()
+
+        # Close organizations are one cluster at low zooms
+        response = self.app.get('/api/organizations/clusters/0/0/0')
+        self.assertEqual(response.mimetype, 'application/json')
+        features = json.loads(response.data)['features']
+        self.assertEqual(len(features), 2)
+        single, cluster = features
+        self.assertEqual(cluster['properties'], dict(cluster=True, point_count=2, expansion_zoom=10))
+        longitude, latitude = cluster['geometry']['coordinates']
+        self.assertAlmostEqual(longitude, -122.375)
+        self.assertAlmostEqual(latitude, 37.8, places=3)
+        self.assertEqual(single['id'], 'Code-for-New-York')
+        self.assertEqual(single['properties']['name'], u'Code for New York')
+
+        features = json.loads(self.app.get('/api/organizations/clusters/9/81/197').data)['features']
+        self.assertEqual([f['properties']['point_count'] for f in features], [2])
+
+        # And single organizations past that
+        features = json.loads(self.app.get('/api/organizations/clusters/10/163/395').data)['features']
+        self.assertEqual([f['id'] for f in features], ['Code-for-Oakland', 'Code-for-San-Francisco'])
+
+        features = json.loads(self.app.get('/api/organizations/clusters/20/167772/405204').data)['features']
+        self.assertEqual([f['id'] for f in features], ['Code-for-San-Francisco'])
+
+        features = json.loads(self.app.get('/api/organizations/clusters/1/1/1').data)['features']
+        self.assertEqual(features, [])
+
+        response = self.app.get('/api/organizations/clusters/1/2/0')
+        self.assertEqual(response.status_code, 404)
+
+    def test_organization_clusters_snapshot(self):
+        ''' Clusters are computed once per update, for every tile.
+        '''
+        app.config['RESPONSE_CACHE_SIZE'] = 8
+        OrganizationFactory(name=u'Code for San Francisco', latitude=37.8, longitude=-122.4)
+        db.session.commit()
+
+        self.app.get('/api/organizations/clusters/0/0/0')
+        response, queries = self.count_queries('/api/organizations/clusters/10/163/395')
+        self.assertEqual(len(json.loads(response.data)['features']), 1)
+        self.assertEqual(queries, 1)
+
+        OrganizationFactory(name=u'Code for Oakland', latitude=37.8, longitude=-122.35)
+        bump_generations(db.session)
+        db.session.commit()
+
+        features = json.loads(self.app.get('/api/organizations/clusters/0/0/0').data)['features']
+        self.assertEqual([f['properties'].get('point_count') for f in features], [2])
+
+    def check_nearby(self):
+        ''' Check nearby organizations, in order, against a few cities.
+        '''
+        OrganizationFactory(name=u'Code for San Francisco')
+        OrganizationFactory(name=u'Code for Oakland', latitude=37.8044, longitude=-122.2711)
+        OrganizationFactory(name=u'Code for New York', latitude=40.7128, longitude=-74.0059)
+        OrganizationFactory(name=u'Code for Fiji', latitude=-16.5, longitude=179.9)
+        OrganizationFactory(name=u'Code for Nowhere', latitude=None, longitude=None)
+        db.session.commit()
+
+        response = json.loads(self.app.get('/api/organizations/nearby?lat=37.8&lon=-122.3&radius=25').data)
+        self.assertEqual([o['name'] for o in response['objects']], [u'Code for Oakland', u'Code for San Francisco'])
+        self.assertEqual(response['total'], 2)
+        self.assertTrue(response['objects'][0]['distance'] < 3 < response['objects'][1]['distance'] < 20)
+        self.assertEqual(response['objects'][0]['api_url'], 'http://localhost/api/organizations/Code-for-Oakland')
+        assert isinstance(response['objects'][0]['current_projects'], list)
+
+        response = json.loads(self.app.get('/api/organizations/nearby?lat=37.8&lon=-122.3&radius=5000&limit=1').data)
+        self.assertEqual([o['name'] for o in response['objects']], [u'Code for Oakland'])
+
+        response = json.loads(self.app.get('/api/organizations/nearby?lat=37.8&lon=-122.3&radius=5000').data)
+        self.assertEqual(len(response['objects']), 3)
+
+        # Circles can cross the antimeridian
+        response = json.loads(self.app.get('/api/organizations/nearby?lat=-16.5&lon=-179.9&radius=50').data)
+        self.assertEqual([o['name'] for o in response['objects']], [u'Code for Fiji'])
+
+        # The index follows moves and deletes
+        db.session.query(Organization).filter_by(name=u'Code for Oakland').update({'latitude': 40.7, 'longitude': -74.0})
+        db.session.query(Organization).filter_by(name=u'Code for San Francisco').delete()
+        db.session.commit()
+        response = json.loads(self.app.get('/api/organizations/nearby?lat=37.8&lon=-122.3&radius=25').data)
+        self.assertEqual(response['objects'], [])
+        response = json.loads(self.app.get('/api/organizations/nearby?lat=40.7&lon=-74&radius=25').data)
+        self.assertEqual([o['name'] for o in response['objects']], [u'Code for Oakland', u'Code for New York'])
+
+        for args in ('lat=37.8', 'lat=north&lon=-122.3', 'lat=100&lon=0', 'lat=0&lon=0&radius=-1', 'lat=0&lon=0&limit=0'):
+            response = self.app.get('/api/organizations/nearby?' + args)
+            self.assertEqual(response.status_code, 400)
+
+    def test_nearby_organizations(self):
+        self.check_nearby()
+
+        query = db.session.query(Organization).filter(Organization.latitude.between(37, 38), Organization.longitude.between(-123, -122))
+        self.assertTrue('ix_organization_location' in self.explain(query.statement))
+
+    def test_nearby_organizations_sqlite(self):
+        ''' Nearby organizations come from an SQLite R*Tree for local databases.
+        '''
+        db.session.remove()
+        db.drop_all()
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///nearby-test.db'
+
+        try:
+            db.create_all()
+            self.check_nearby()
+            db.session.remove()
+            db.drop_all()
+        finally:
+            db.session.remove()
+            app.config['SQLALCHEMY_DATABASE_URI'] = 'postgres://postgres@localhost/civic_json_worker_test'
+            db.create_all()
+            os.remove('nearby-test.db')
+
     def test_projects(self):
         ProjectFactory()
         db.session.flush()
@@ -320,6 +546,82 @@ class ApiTest(unittest.TestCase):
         assert isinstance(response['objects'][0]['organization_name'], unicode)
         assert isinstance(response['objects'][0]['type'], unicode)
 
+    def test_projects_batched_loading(self):
+        ''' A page of projects loads its issues and labels in a fixed number of queries.
+        '''
+        organization = OrganizationFactory(name='Code for San Francisco')
+        db.session.flush()
+
+        project = ProjectFactory(organization_name=organization.name)
+        db.session.flush()
+        issue = IssueFactory(project_id=project.id)
+        issue.labels = [LabelFactory(name='help wanted')]
+        db.session.commit()
+
+        response, one_project_queries = self.count_queries('/api/projects')
+        self.assertEqual(response.status_code, 200)
+
+        for n in range(5):
+            project = ProjectFactory(organization_name=u'Code for San Francisco')
+            db.session.flush()
+            for m in range(3):
+                issue = IssueFactory(project_id=project.id)
+                issue.labels = [LabelFactory(), LabelFactory()]
+        db.session.commit()
+
+        response, six_project_queries = self.count_queries('/api/projects')
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.data)
+
+        self.assertEqual(len(response['objects']), 6)
+        self.assertEqual(one_project_queries, six_project_queries)
+        self.assertEqual(sorted([len(p['issues']) for p in response['objects']]), [1, 3, 3, 3, 3, 3])
+        first_project = [p for p in response['objects'] if len(p['issues']) == 1][0]
+        self.assertEqual(first_project['issues'][0]['labels'][0]['name'], 'help wanted')
+
+        # Issue pages embed their projects without loading them one at a time
+        response, issue_queries = self.count_queries('/api/issues')
+        response = json.loads(response.data)
+        self.assertEqual(response['total'], 16)
+        self.assertTrue(issue_queries <= one_project_queries)
+        self.assertFalse('issues' in response['objects'][0]['project'])
+
+    def test_organizations_batched_extras(self):
+        ''' A page of organizations loads current events, projects and stories in a fixed number of queries.
+        '''
+        def add_organization(name):
+            organization = OrganizationFactory(name=name)
+            db.session.flush()
+            EventFactory(organization_name=name, name='Past', start_time_notz=datetime.now() - timedelta(10))
+            EventFactory(organization_name=name, name='Soon', start_time_notz=datetime.now() + timedelta(1))
+            EventFactory(organization_name=name, name='Later', start_time_notz=datetime.now() + timedelta(2))
+            EventFactory(organization_name=name, name='Much Later', start_time_notz=datetime.now() + timedelta(3))
+            for year in range(2010, 2014):
+                ProjectFactory(organization_name=name, name='Project %d' % year, last_updated='01 Jan %d 00:00:00 GMT' % year)
+            for title in ('First Story', 'Second Story', 'Third Story'):
+                StoryFactory(organization_name=name, title=title)
+            db.session.commit()
+
+        add_organization('Code for Oakland')
+        response, one_org_queries = self.count_queries('/api/organizations')
+        self.assertEqual(response.status_code, 200)
+
+        for name in ('Code for Atlanta', 'Code for Boston', 'Code for Denver'):
+            add_organization(name)
+
+        response, four_org_queries = self.count_queries('/api/organizations')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(one_org_queries, four_org_queries)
+
+        response = json.loads(response.data)
+        self.assertEqual(len(response['objects']), 4)
+
+        for organization in response['objects']:
+            self.assertEqual([e['name'] for e in organization['current_events']], ['Soon', 'Later'])
+            self.assertEqual([p['name'] for p in organization['current_projects']], ['Project 2013', 'Project 2012', 'Project 2011'])
+            self.assertEqual([s['title'] for s in organization['current_stories']], ['First Story', 'Second Story'])
+            self.assertEqual(set([e['organization_name'] for e in organization['current_events']]), set([organization['name']]))
+
     def test_pagination(self):
         ProjectFactory()
         ProjectFactory()
@@ -335,6 +637,149 @@ class ApiTest(unittest.TestCase):
         self.assertNotIn('first', response['pages'])
         self.assertNotIn('prev', response['pages'])
 
+    def test_pagination_counts_once(self):
+        ''' The total comes back with the page, in a single statement.
+        '''
+        for n in range(3):
+            ProjectFactory()
+        db.session.commit()
+
+        response = self.app.get('/api/projects?per_page=2')
+        response = json.loads(response.data)
+        self.assertEqual(response['total'], 3)
+        self.assertEqual(len(response['objects']), 2)
+
+        # Pages past the end still report the total
+        response = self.app.get('/api/projects?per_page=2&page=5')
+        response = json.loads(response.data)
+        self.assertEqual(response['total'], 3)
+        self.assertEqual(len(response['objects']), 0)
+
+    def test_pagination_count_modes(self):
+        ''' ?count=none skips the total, ?count=estimate asks the planner.
+        '''
+        for n in range(3):
+            ProjectFactory()
+        db.session.commit()
+
+        response = self.app.get('/api/projects?per_page=2&count=none')
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.data)
+        self.assertIsNone(response['total'])
+        self.assertEqual(len(response['objects']), 2)
+        self.assertEqual(response['pages']['next'], 'http://localhost/api/projects?per_page=2&page=2&count=none')
+        self.assertNotIn('last', response['pages'])
+
+        response = self.app.get('/api/projects?per_page=2&page=2&count=none')
+        response = json.loads(response.data)
+        self.assertEqual(len(response['objects']), 1)
+        self.assertNotIn('next', response['pages'])
+
+        response = self.app.get('/api/projects?per_page=2&count=estimate')
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.data)
+        assert isinstance(response['total'], int)
+        self.assertEqual(len(response['objects']), 2)
+
+    def test_cursor_pagination(self):
+        ''' Cursors pick up after the last row seen, even as rows are added in front.
+        '''
+        organization = OrganizationFactory(name='USA USA USA')
+        db.session.flush()
+
+        for days in range(1, 6):
+            EventFactory(organization_name=organization.name, name='Event %d' % days, start_time_notz=datetime.now() + timedelta(days))
+        db.session.commit()
+
+        response = self.app.get('/api/events/upcoming_events?per_page=2')
+        response = json.loads(response.data)
+        self.assertEqual([e['name'] for e in response['objects']], ['Event 1', 'Event 2'])
+        self.assertEqual(response['pages']['next'], 'http://localhost/api/events/upcoming_events?per_page=2&page=2')
+
+        next_url = response['pages']['next_cursor']
+        self.assertTrue(next_url.startswith('http://localhost/api/events/upcoming_events?'))
+        self.assertTrue('cursor=' in next_url)
+
+        # An event added ahead of the cursor doesn't shift the following pages
+        EventFactory(organization_name=u'USA USA USA', name='Event 0', start_time_notz=datetime.now() + timedelta(hours=1))
+        db.session.commit()
+
+        response = self.follow(next_url)
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.data)
+        self.assertEqual([e['name'] for e in response['objects']], ['Event 3', 'Event 4'])
+        self.assertEqual(response['total'], 6)
+        self.assertNotIn('next', response['pages'])
+
+        response = self.follow(response['pages']['next_cursor'])
+        response = json.loads(response.data)
+        self.assertEqual([e['name'] for e in response['objects']], ['Event 5'])
+        self.assertNotIn('next_cursor', response['pages'])
+
+        response = self.app.get('/api/events/upcoming_events?cursor=nonsense')
+        self.assertEqual(response.status_code, 400)
+
+        # Cursors need a string or null sort key, a date for dates, and an integer id
+        for key in ([5, 1], [{'a': 1}, 1], ['2014-01-01', 'x'], ['2014-01-01', 1.5], ['99999999999-01-01', 1]):
+            cursor = urlsafe_b64encode(json.dumps(key)).rstrip('=')
+            response = self.app.get('/api/events/upcoming_events?cursor=' + cursor)
+            self.assertEqual(response.status_code, 400, key)
+
+    def test_streamed_pages(self):
+        ''' Pages bigger than STREAM_PAGE_SIZE stream the same results.
+        '''
+        organization = OrganizationFactory(name=u'Code for San Francisco')
+        db.session.flush()
+        for days in range(1, 6):
+            EventFactory(organization_name=organization.name, name=u'Event %d' % days, start_time_notz=datetime.now() + timedelta(days))
+        db.session.commit()
+
+        urls = ['/api/events/upcoming_events?per_page=3', '/api/events/upcoming_events?per_page=3&page=2',
+                '/api/events/upcoming_events?per_page=3&count=none', '/api/events?per_page=3&page=3',
+                '/api/organizations/Code-for-San-Francisco/events?per_page=4']
+        buffered = [json.loads(self.app.get(url).data) for url in urls]
+
+        app.config['STREAM_PAGE_SIZE'] = 2
+        app.config['RESPONSE_CACHE_SIZE'] = 8
+        for (url, expected) in zip(urls, buffered):
+            response = self.app.get(url)
+            self.assertEqual(response.mimetype, 'application/json')
+            self.assertEqual(json.loads(response.data), expected)
+
+        # Streamed pages are never kept in the response cache
+        self.assertEqual(response_cache.entries, {})
+        self.assertEqual(response.headers['Surrogate-Key'], 'event organization/Code-for-San-Francisco')
+
+        # Cursors work across streamed pages
+        response = json.loads(self.app.get('/api/events/upcoming_events?per_page=3').data)
+        self.assertEqual([e['name'] for e in response['objects']], [u'Event 1', u'Event 2', u'Event 3'])
+        response = json.loads(self.follow(response['pages']['next_cursor']).data)
+        self.assertEqual([e['name'] for e in response['objects']], [u'Event 4', u'Event 5'])
+        self.assertNotIn('next_cursor', response['pages'])
+
+        # Queries fail before streaming starts, with an error status
+        response = self.app.get('/api/events?per_page=3&start_time_notz=nonsense')
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(response.data.startswith('{"objects"'))
+
+    def test_cursor_pagination_with_nulls(self):
+        ''' Projects without a last_updated time are paged through by cursor too.
+        '''
+        ProjectFactory(name='Project 1', last_updated='Mon, 01 Jan 2010 00:00:00 GMT')
+        ProjectFactory(name='Project 2', last_updated='Tue, 01 Jan 2011 00:00:00 GMT')
+        ProjectFactory(name='Project 3')
+        ProjectFactory(name='Project 4')
+        db.session.commit()
+
+        names, url = [], 'http://localhost/api/projects?per_page=1'
+        while url:
+            response = json.loads(self.follow(url).data)
+            names.extend([p['name'] for p in response['objects']])
+            url = response['pages'].get('next_cursor')
+
+        self.assertEqual(sorted(names), ['Project 1', 'Project 2', 'Project 3', 'Project 4'])
+        self.assertEqual(names.index('Project 2') + 1, names.index('Project 1'))
+
     def test_good_orgs_projects(self):
         organization = OrganizationFactory(name="Code for America")
         project = ProjectFactory(organization_name="Code for America")
@@ -521,6 +966,37 @@ class ApiTest(unittest.TestCase):
         response = json.loads(response.data)
         self.assertEqual(response["name"], "Code for America")
 
+    def test_organization_slugs(self):
+        ''' Organizations are found by stored slug, even with dashes in their names.
+        '''
+        app.config['RESPONSE_CACHE_SIZE'] = 8
+        OrganizationFactory(name=u'Code for Winston-Salem')
+        EventFactory(organization_name=u'Code for Winston-Salem')
+        db.session.commit()
+
+        self.assertEqual(db.session.query(Organization.slug).scalar(), u'Code-for-Winston-Salem')
+        self.assertTrue(is_safe_name(u'Code for Winston-Salem'))
+        self.assertFalse(is_safe_name(u'Code_for_America'))
+
+        for url in ('/api/organizations/Code-for-Winston-Salem', '/api/organizations/Code for Winston-Salem', '/api/organizations/Code_for_Winston-Salem'):
+            response = self.app.get(url)
+            self.assertEqual(response.status_code, 200)
+            response = json.loads(response.data)
+            self.assertEqual(response['name'], u'Code for Winston-Salem')
+            self.assertEqual(response['slug'], u'Code-for-Winston-Salem')
+            self.assertEqual(response['api_url'], 'http://localhost/api/organizations/Code-for-Winston-Salem')
+            self.assertEqual(response['past_events'], 'http://localhost/api/organizations/Code-for-Winston-Salem/past_events')
+
+        response = json.loads(self.app.get('/api/organizations/Code-for-Winston-Salem/events').data)
+        self.assertEqual(response['objects'][0]['organization']['slug'], u'Code-for-Winston-Salem')
+
+        # Updates by name reach responses looked up by slug
+        db.session.query(Organization).update({'city': u'Winston-Salem, NC'})
+        bump_generations(db.session, u'Code for Winston-Salem')
+        db.session.commit()
+        response = json.loads(self.app.get('/api/organizations/Code-for-Winston-Salem').data)
+        self.assertEqual(response['city'], u'Winston-Salem, NC')
+
     def test_org_upcoming_events(self):
         '''
         Only return events occurring in the future
@@ -569,6 +1045,352 @@ class ApiTest(unittest.TestCase):
         self.assertEqual(response['objects'][0]['name'], 'Christmas Eve')
         self.assertEqual(response['objects'][1]['name'], 'Thanksgiving')
 
+    def test_row_serializers(self):
+        ''' Core row serializers give the same dictionaries as asdict(True).
+        '''
+        organization = OrganizationFactory(name=u'Code for San Francisco')
+        EventFactory(organization_name=organization.name, end_time_notz=None)
+        EventFactory(organization_name=organization.name, utc_offset=-25200)
+        project = ProjectFactory(organization_name=organization.name)
+        db.session.flush()
+        issue = IssueFactory(project_id=project.id)
+        IssueFactory(project_id=project.id)
+        db.session.flush()
+        LabelFactory(issue_id=issue.id, name=u'help wanted')
+        LabelFactory(issue_id=issue.id, name=u'bug')
+        db.session.commit()
+
+        with app.test_request_context('/api/events'):
+            for (model, serializer) in ((Event, event_rows), (Issue, issue_rows), (Project, project_rows)):
+                instances = db.session.query(model).order_by(model.id).all()
+                rows = db.session.execute(db.select(serializer.columns).order_by(model.id)).fetchall()
+                self.assertEqual(serializer.serialize(rows), [o.asdict(True) for o in instances])
+
+            # Labels come in the order they were added, either way.
+            issue_dict = db.session.query(Issue).order_by(Issue.id).first().asdict(True)
+            self.assertEqual([label['name'] for label in issue_dict['labels']], [u'help wanted', u'bug'])
+
+    def test_sparse_fieldsets(self):
+        ''' Sparse fieldsets leave unrequested columns and relationships unselected.
+        '''
+        organization = OrganizationFactory(name=u'Code for San Francisco')
+        EventFactory(organization_name=organization.name)
+        story = StoryFactory(organization_name=organization.name)
+        for n in range(3):
+            project = ProjectFactory(organization_name=organization.name, last_updated=datetime(2014, 1, n + 1))
+            db.session.flush()
+            issue = IssueFactory(project_id=project.id)
+            db.session.flush()
+            LabelFactory(issue_id=issue.id)
+        project_id, story_id = project.id, story.id
+        db.session.commit()
+
+        response, statements = self.queries('/api/projects?fields=name,api_url&per_page=2&count=none')
+        response = json.loads(response.data)
+        self.assertEqual([sorted(p.keys()) for p in response['objects']], [['api_url', 'name']] * 2)
+        self.assertEqual(len([s for s in statements if 'FROM project' in s]), 1)
+        self.assertFalse([s for s in statements if 'github_details' in s or 'FROM issue' in s])
+
+        # Cursors still work without the keyset column in the response.
+        next_page = json.loads(self.follow(response['pages']['next_cursor']).data)
+        self.assertEqual([sorted(p.keys()) for p in next_page['objects']], [['api_url', 'name']])
+
+        response, statements = self.queries('/api/projects?exclude=issues,github_details,organization')
+        project_dict = json.loads(response.data)['objects'][0]
+        self.assertFalse(set(['issues', 'github_details', 'organization']) & set(project_dict.keys()))
+        self.assertTrue('description' in project_dict)
+        self.assertFalse([s for s in statements if 'FROM issue' in s or 'organization.website' in s])
+
+        # Without its project, an issue says which one it belongs to, and is still tagged with the organization.
+        response, statements = self.queries('/api/issues?exclude=labels,project&seed=a')
+        issue_dict = json.loads(response.data)['objects'][0]
+        self.assertEqual(sorted(issue_dict.keys()), ['api_url', 'body', 'html_url', 'id', 'project_id', 'title'])
+        self.assertFalse([s for s in statements if 'FROM label' in s or 'project.github_details' in s])
+        self.assertTrue('organization/Code-for-San-Francisco' in response.headers['Surrogate-Key'].split())
+
+        response = self.app.get('/api/issues/%d?exclude=project' % issue_dict['id'])
+        self.assertEqual(json.loads(response.data)['project_id'], issue_dict['project_id'])
+        self.assertTrue('organization/Code-for-San-Francisco' in response.headers['Surrogate-Key'].split())
+
+        response = json.loads(self.app.get('/api/events?fields=name,start_time').data)
+        self.assertEqual(sorted(response['objects'][0].keys()), ['name', 'start_time'])
+
+        response = json.loads(self.app.get('/api/projects/%d?fields=name' % project_id).data)
+        self.assertEqual(response.keys(), ['name'])
+        self.assertEqual(self.app.get('/api/projects/%d' % (project_id + 1)).status_code, 404)
+
+        # Organizations and stories load only the columns and relationships their fields need.
+        response, statements = self.queries('/api/organizations?fields=name')
+        self.assertEqual(json.loads(response.data)['objects'], [{'name': u'Code for San Francisco'}])
+        self.assertFalse([s for s in statements if 'organization.website' in s or 'FROM event' in s or 'FROM project' in s
+                          or 'FROM story' in s or 'FROM issue' in s or 'FROM label' in s])
+        self.assertEqual((len(statements), self.count_queries('/api/organizations')[1]), (2, 7))
+
+        response, statements = self.queries('/api/stories?fields=title')
+        self.assertEqual(sorted(json.loads(response.data)['objects'][0].keys()), ['title'])
+        self.assertEqual((len(statements), self.count_queries('/api/stories')[1]), (2, 3))
+        self.assertFalse([s for s in statements if 'story.link' in s or 'organization.website' in s])
+
+        response, statements = self.queries('/api/stories/%d?fields=title' % story_id)
+        self.assertEqual(json.loads(response.data).keys(), ['title'])
+        self.assertFalse([s for s in statements if 'story.link' in s or 'organization.website' in s])
+
+        response = json.loads(self.app.get('/api/stories?fields=title,organization').data)
+        self.assertEqual(sorted(response['objects'][0].keys()), ['organization', 'title'])
+        self.assertEqual(response['objects'][0]['organization']['name'], u'Code for San Francisco')
+
+        response, statements = self.queries('/api/organizations/Code-for-San-Francisco?exclude=current_projects')
+        response = json.loads(response.data)
+        self.assertTrue('name' in response and 'current_events' in response)
+        self.assertFalse('current_projects' in response)
+        self.assertFalse([s for s in statements if 'FROM project' in s or 'FROM issue' in s])
+
+    def test_asdict_memo(self):
+        ''' Embedded organizations are built once per response.
+        '''
+        organization = OrganizationFactory(name=u'Code for San Francisco')
+        StoryFactory.create_batch(25, organization_name=organization.name)
+        db.session.commit()
+
+        response = json.loads(self.app.get('/api/stories?per_page=25').data)
+        self.assertEqual(len(response['objects']), 25)
+        self.assertEqual(len(set(json.dumps(s['organization']) for s in response['objects'])), 1)
+        self.assertEqual((asdict_memo.hits, asdict_memo.misses), (24, 1))
+
+        # Nothing carries over to the next response.
+        self.app.get('/api/stories?per_page=25')
+        self.assertEqual((asdict_memo.hits, asdict_memo.misses), (48, 2))
+
+    def test_batch(self):
+        ''' One batch request gets several API responses, sharing their lookups.
+        '''
+        organization = OrganizationFactory(name=u'Code for San Francisco')
+        EventFactory(organization_name=organization.name, start_time_notz=datetime.now() + timedelta(days=1))
+        ProjectFactory(organization_name=organization.name)
+        StoryFactory(organization_name=organization.name)
+        db.session.commit()
+
+        paths = ['/api/organizations/Code-for-San-Francisco',
+                 '/api/organizations/Code-for-San-Francisco/upcoming_events',
+                 '/api/organizations/Code-for-San-Francisco/projects',
+                 '/api/organizations/Code-for-San-Francisco/stories?per_page=5',
+                 '/api/organizations/Nobody']
+
+        separate = [self.count_queries(path) for path in paths]
+        response, queries = self.count_queries('/api/batch?' + urlencode([('path', path) for path in paths]))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(queries < sum(count for (_, count) in separate))
+
+        responses = json.loads(response.data)['responses']
+        self.assertEqual([r['path'] for r in responses], paths)
+        self.assertEqual([r['status'] for r in responses], [r.status_code for (r, _) in separate])
+        self.assertEqual([r['body'] for r in responses[:4]], [json.loads(r.data) for (r, _) in separate[:4]])
+        self.assertEqual(responses[4]['body'], 'Organization not found')
+        self.assertTrue(response.cache_control.no_cache)
+        self.assertFalse('Surrogate-Key' in response.headers)
+
+        # Each path is tagged with its own surrogate keys, and the batch with all of them.
+        app.config['RESPONSE_CACHE_SIZE'] = 8
+        response = self.app.get('/api/batch?path=/api/events&path=/api/stories')
+        self.assertEqual(response.headers['Cache-Control'], 'public, max-age=0, s-maxage=0')
+
+        # These come from the response cache, as the batch left them.
+        events_keys = self.app.get('/api/events').headers['Surrogate-Key'].split()
+        stories_keys = self.app.get('/api/stories').headers['Surrogate-Key'].split()
+        self.assertEqual(response_cache.hits, 2)
+        self.assertFalse('event' in stories_keys)
+        self.assertEqual(response.headers['Surrogate-Key'].split(), sorted(set(events_keys + stories_keys)))
+
+        self.assertEqual(self.app.get('/api/batch').status_code, 400)
+        self.assertEqual(self.app.get('/api/batch?path=/api/batch').status_code, 400)
+        self.assertEqual(self.app.get('/api/batch?path=http://example.com/').status_code, 400)
+
+        # Only cached API views are batched, never files
+        for path in ('/api/static/../app.py', '/api/static/%2e%2e/app.py', '/api/static/grid.css',
+                     '/api/./events', '/api/', '/api/.well-known/status', '/api/nowhere'):
+            response = self.app.get('/api/batch?' + urlencode([('path', path)]))
+            self.assertEqual(response.status_code, 400, path)
+
+        self.assertEqual(self.app.get('/api/static/grid.css').mimetype, 'text/css')
+        self.assertEqual(self.app.get('/api/static/%2e%2e/app.py').status_code, 404)
+
+    def check_lazy_json(self):
+        ''' Check lazily decoded project details and searches in them, on this database.
+        '''
+        organization = OrganizationFactory(name=u'Code for San Francisco')
+        ProjectFactory(organization_name=organization.name, github_details={'owner': {'login': 'sfbrigade'}, 'participation': [3, 4]})
+        db.session.commit()
+        db.session.close()
+
+        project = db.session.query(Project).first()
+        self.assertTrue(isinstance(project.github_details, LazyJson))
+        self.assertFalse(hasattr(project.github_details, '_value'))
+        self.assertEqual(project.github_details, {'owner': {'login': 'sfbrigade'}, 'participation': [3, 4]})
+
+        # Loaded details work like the dictionaries they were saved as.
+        details = db.session.query(Project).first().github_details
+        self.assertEqual(details['owner']['login'], 'sfbrigade')
+        self.assertEqual((details.get('participation'), details.get('nothing')), ([3, 4], None))
+        self.assertEqual((sorted(details), len(details), 'owner' in details), (['owner', 'participation'], 2, True))
+        self.assertEqual(dict(details), {'owner': {'login': 'sfbrigade'}, 'participation': [3, 4]})
+        self.assertTrue(isinstance(details, Mapping))
+
+        participation = LazyJsonArray(u'[3, 4]')
+        self.assertEqual((participation[1], list(participation), 4 in participation), (4, [3, 4], True))
+
+        login = Project.github_details.path('owner', 'login')
+        self.assertEqual(db.session.query(Project.name).filter(login == 'sfbrigade').count(), 1)
+        self.assertEqual(db.session.query(Project.github_details.path('participation', 1)).scalar(), '4')
+        db.session.close()
+
+        response = json.loads(self.app.get('/api/projects').data)
+        self.assertEqual(response['objects'][0]['github_details']['owner'], {'login': 'sfbrigade'})
+
+        # Attribute filters match the JSON text.
+        response = json.loads(self.app.get('/api/projects?github_details=SFBrigade').data)
+        self.assertEqual(response['total'], 1)
+        response = json.loads(self.app.get('/api/projects?github_details=oaklandbrigade').data)
+        self.assertEqual(response['total'], 0)
+
+    def test_lazy_json(self):
+        ''' Project details are decoded only when used, and can be searched in SQL.
+        '''
+        self.check_lazy_json()
+
+    def test_lazy_json_sqlite(self):
+        ''' Project details work the same way on SQLite.
+        '''
+        db.session.remove()
+        db.drop_all()
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///lazy-json-test.db'
+
+        try:
+            db.create_all()
+            self.check_lazy_json()
+            db.session.remove()
+            db.drop_all()
+        finally:
+            db.session.remove()
+            app.config['SQLALCHEMY_DATABASE_URI'] = 'postgres://postgres@localhost/civic_json_worker_test'
+            db.create_all()
+            os.remove('lazy-json-test.db')
+
+    def test_read_replica(self):
+        ''' GET requests read from the replica bind, unless it has fallen behind.
+        '''
+        OrganizationFactory(name=u'Code for San Francisco', city=u'Primary')
+        bump_generations(db.session, u'Code for San Francisco')
+        db.session.commit()
+
+        app.config['SQLALCHEMY_BINDS'] = {'replica': 'sqlite://'}
+        app.config['REPLICA_MAX_LAG'] = 60
+        replica = db.get_engine(app, 'replica')
+        db.Model.metadata.create_all(replica)
+
+        try:
+            for table in (Organization.__table__, Generation.__table__):
+                rows = [dict(row) for row in db.session.execute(table.select())]
+                replica.execute(table.insert(), rows)
+            replica.execute(Organization.__table__.update().values(city=u'Replica'))
+            db.session.close()
+
+            response = json.loads(self.app.get('/api/organizations/Code-for-San-Francisco').data)
+            self.assertEqual(response['city'], u'Replica')
+
+            # A session that has written reads its own writes.
+            db.session.query(Organization).update(dict(city=u'Flushed'))
+            db.session.flush()
+            response = json.loads(self.app.get('/api/organizations/Code-for-San-Francisco').data)
+            self.assertEqual(response['city'], u'Flushed')
+
+            # The updater moves on without the replica.
+            db.session.query(Generation).update(dict(updated=Generation.updated + 120))
+            db.session.commit()
+            replica_lag.clear()
+
+            response = json.loads(self.app.get('/api/organizations/Code-for-San-Francisco').data)
+            self.assertEqual(response['city'], u'Primary')
+            self.assertEqual(replica_lag.lag, 120)
+
+        finally:
+            db.session.close()
+            db.Model.metadata.drop_all(replica)
+            app.config['SQLALCHEMY_BINDS'] = None
+
+    def test_query_stats(self):
+        ''' Responses can count their SQL, and slow ones are logged with statement fingerprints.
+        '''
+        organization = OrganizationFactory(name=u'Code for San Francisco')
+        ProjectFactory(organization_name=organization.name)
+        db.session.commit()
+
+        response = self.app.get('/api/projects')
+        self.assertFalse('X-Query-Count' in response.headers)
+
+        app.config['QUERY_STATS'] = True
+        app.config['SLOW_REQUEST_MS'] = 0
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        logging.getLogger('app').addHandler(handler)
+
+        try:
+            response, statements = self.queries('/api/projects?per_page=5')
+            batch = self.app.get('/api/batch?path=/api/projects&path=/api/organizations')
+        finally:
+            logging.getLogger('app').removeHandler(handler)
+
+        self.assertTrue(statements)
+        self.assertEqual(response.headers['X-Query-Count'], str(len(statements)))
+        self.assertTrue(response.headers['Server-Timing'].startswith('db;dur='))
+        self.assertTrue(int(batch.headers['X-Query-Count']) > len(statements))
+
+        # One line per request, not per batched path.
+        self.assertEqual(len(messages), 2)
+        logged = json.loads(messages[0])
+        self.assertEqual(logged['path'], '/api/projects?per_page=5')
+        self.assertEqual(logged['queries'], len(statements))
+        self.assertEqual(sum(shape['count'] for shape in logged['statements']), len(statements))
+        self.assertEqual(len(logged['statements'][0]['fingerprint']), 12)
+
+    def test_embedded_issues(self):
+        ''' Projects embed their first few issues, with a count and a link to the rest.
+        '''
+        app.config['EMBEDDED_ISSUES'] = 2
+        organization = OrganizationFactory(name=u'Code for San Francisco')
+        project = ProjectFactory(organization_name=organization.name)
+        db.session.flush()
+        # Not from the factory, whose titles other tests count on.
+        db.session.add_all([Issue(u'Issue %d' % n, project_id=project.id) for n in range(3)])
+        count_issues(db.session, organization.name)
+        project_id = project.id
+        db.session.commit()
+
+        response = json.loads(self.app.get('/api/projects').data)
+        project_dict = response['objects'][0]
+        self.assertEqual(len(project_dict['issues']), 2)
+        self.assertEqual(project_dict['issues_count'], 3)
+        self.assertEqual(project_dict['issues_url'], 'http://localhost/api/projects/%d/issues' % project_id)
+
+        issues = json.loads(self.follow(project_dict['issues_url']).data)
+        self.assertEqual(issues['total'], 3)
+        self.assertEqual([i['id'] for i in issues['objects'][:2]], [i['id'] for i in project_dict['issues']])
+
+        response = json.loads(self.app.get('/api/organizations/Code-for-San-Francisco').data)
+        self.assertEqual(len(response['current_projects'][0]['issues']), 2)
+
+        # Without batch loading, only the embedded issues are loaded
+        with app.test_request_context():
+            project = Project.query.get(project_id)
+            self.assertEqual([i['title'] for i in project.asdict()['issues']], [u'Issue 0', u'Issue 1'])
+            self.assertTrue('issues' in inspect(project).unloaded)
+
+            projects = Organization.query.get(u'Code for San Francisco').current_projects()
+            self.assertEqual(len(projects[0]['issues']), 2)
+            db.session.remove()
+
+        self.assertEqual(self.app.get('/api/projects/%d/issues' % (project_id + 1)).status_code, 404)
+
     def test_issues(self):
         '''
         Test that issues have everything we expect.
@@ -606,6 +1428,328 @@ class ApiTest(unittest.TestCase):
         self.assertTrue('project' in response)
         self.assertTrue('issues' not in response['project'])
 
+    def test_issues_seeded_shuffle(self):
+        ''' The same seed gives the same, non-overlapping pages of issues.
+        '''
+        project = ProjectFactory()
+        db.session.flush()
+
+        for n in range(6):
+            IssueFactory(project_id=project.id)
+        db.session.commit()
+
+        def titles(url):
+            response = json.loads(self.app.get(url).data)
+            return [issue['title'] for issue in response['objects']], response['pages']
+
+        first, pages = titles('/api/issues?seed=hack-night&per_page=3')
+        self.assertEqual(pages['next'], 'http://localhost/api/issues?per_page=3&page=2&seed=hack-night')
+
+        second, _ = titles('/api/issues?seed=hack-night&per_page=3&page=2')
+        self.assertEqual(len(set(first + second)), 6)
+        self.assertEqual(titles('/api/issues?seed=hack-night&per_page=3')[0], first)
+
+        # Shuffle keys are kept out of responses
+        response = json.loads(self.app.get('/api/issues?seed=hack-night').data)
+        self.assertFalse('shuffle_key' in response['objects'][0])
+
+        label = LabelFactory(name='help wanted')
+        issue = Issue.query.first()
+        issue.labels = [label]
+        index_labels(db.session, issue.project.organization_name)
+        db.session.commit()
+
+        response = self.app.get('/api/issues/labels/help?seed=hack-night')
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.data)
+        self.assertEqual(response['total'], 1)
+
+    def test_issues_seeded_shuffle_order(self):
+        ''' Seeded shuffles wrap around the shuffle keys once, in an order the database keeps.
+        '''
+        db.session.execute(Issue.__table__.insert(), [dict(title=u'Issue %d' % n, shuffle_key=(n * 7 % 100) / 100.) for n in range(100)])
+
+        query = shuffle_issues(db.session.query(Issue), u'hack-night')
+        self.assertTrue(str(query.statement).endswith('ORDER BY issue.shuffle_key < :shuffle_key_1, issue.shuffle_key, issue.id'))
+
+        keys = [issue.shuffle_key for issue in query]
+        self.assertEqual(len([n for n in range(99) if keys[n] > keys[n + 1]]), 1)
+        self.assertTrue(keys[-1] < keys[0])
+
+        pages = [issue.shuffle_key for n in range(10) for issue in query.limit(10).offset(n * 10)]
+        self.assertEqual(pages, keys)
+
+    def test_response_cache(self):
+        ''' Responses are cached until their organization or the whole API is updated.
+        '''
+        app.config['RESPONSE_CACHE_SIZE'] = 2
+        OrganizationFactory(name=u'Code for San Francisco')
+        OrganizationFactory(name=u'Code for Oakland')
+        db.session.commit()
+
+        first = self.app.get('/api/organizations/Code-for-San-Francisco')
+        response, queries = self.count_queries('/api/organizations/Code-for-San-Francisco')
+        self.assertEqual(response.data, first.data)
+        self.assertEqual(response.headers['Access-Control-Allow-Origin'], '*')
+        self.assertEqual(queries, 1)
+        self.assertEqual((response_cache.hits, response_cache.misses), (1, 1))
+
+        # Query strings are normalized
+        self.app.get('/api/projects?per_page=5&page=1')
+        self.app.get('/api/projects?page=1&per_page=5')
+        self.assertEqual((response_cache.hits, response_cache.misses), (2, 2))
+
+        # Updates elsewhere leave an organization's responses alone
+        bump_generations(db.session, u'Code for Oakland')
+        db.session.commit()
+        self.app.get('/api/organizations/Code-for-San-Francisco')
+        self.assertEqual((response_cache.hits, response_cache.misses), (3, 2))
+
+        # Its own updates, and global ones, invalidate
+        db.session.query(Organization).filter_by(name=u'Code for San Francisco').update({'city': u'San Francisco'})
+        bump_generations(db.session, u'Code for San Francisco')
+        db.session.commit()
+        response = json.loads(self.app.get('/api/organizations/Code-for-San-Francisco').data)
+        self.assertEqual(response['city'], u'San Francisco')
+        self.app.get('/api/projects?per_page=5&page=1')
+        self.assertEqual((response_cache.hits, response_cache.misses), (3, 4))
+
+        # The least recently used entry is evicted
+        self.app.get('/api/events')
+        self.app.get('/api/organizations/Code-for-San-Francisco')
+        self.assertEqual((response_cache.hits, response_cache.misses), (3, 6))
+
+        # Errors and unseeded shuffles are never cached
+        self.app.get('/api/organizations/Code-for-Nowhere/events')
+        self.app.get('/api/organizations/Code-for-Nowhere/events')
+        self.app.get('/api/issues')
+        self.app.get('/api/issues')
+        self.assertEqual((response_cache.hits, response_cache.misses), (3, 8))
+
+    def test_conditional_get(self):
+        ''' Responses carry validators, and matching requests get a 304 without a body.
+        '''
+        app.config['RESPONSE_CACHE_SIZE'] = 8
+        OrganizationFactory(name=u'Code for San Francisco')
+        db.session.commit()
+
+        url = '/api/organizations/Code-for-San-Francisco'
+        response = self.app.get(url)
+        etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+        self.assertFalse(etag.startswith('W/'))
+
+        response, queries = self.count_queries(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, '')
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.headers['Access-Control-Allow-Origin'], '*')
+        self.assertEqual(queries, 1)
+
+        response = self.app.get(url, headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+        response = self.app.get(url, headers={'If-Modified-Since': 'Mon, 01 Jan 2010 00:00:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+
+        # Entity tags win over dates
+        response = self.app.get(url, headers={'If-None-Match': '"stale"', 'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 200)
+
+        # Other pages have their own tags
+        self.assertNotEqual(self.app.get('/api/organizations').headers['ETag'], etag)
+
+        # An update changes the tag
+        bump_generations(db.session, u'Code for San Francisco')
+        db.session.commit()
+        response = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        # Unseeded shuffles have no validators
+        self.assertFalse('ETag' in self.app.get('/api/issues').headers)
+
+        # Requests the view would reject get its error, cached or not
+        self.assertEqual(self.app.get('/api/organizations/Nowhere', headers={'If-None-Match': '*'}).status_code, 404)
+        self.assertEqual(self.app.get('/api/events/upcoming_events?cursor=nonsense', headers={'If-None-Match': '*'}).status_code, 400)
+
+        # Without a cached response, the view still only runs until it accepts the request
+        app.config['RESPONSE_CACHE_SIZE'] = 0
+        accepted_keys.clear()
+        etag = self.app.get(url).headers['ETag']
+        response, queries = self.count_queries(url, headers={'If-None-Match': etag})
+        self.assertEqual((response.status_code, queries), (304, 1))
+
+        accepted_keys.clear()
+        response, queries = self.count_queries(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertTrue(queries > 1)
+        self.assertEqual(self.count_queries(url, headers={'If-None-Match': etag})[1], 1)
+
+        # Streamed pages too
+        app.config['STREAM_PAGE_SIZE'] = 2
+        etag = self.app.get('/api/organizations?per_page=5').headers['ETag']
+        response, queries = self.count_queries('/api/organizations?per_page=5', headers={'If-None-Match': etag})
+        self.assertEqual((response.status_code, queries), (304, 1))
+
+    def test_surrogate_keys(self):
+        ''' Responses say which organizations and entities they show.
+        '''
+        app.config['RESPONSE_CACHE_SIZE'] = 2
+        organization = OrganizationFactory(name=u'Code for San Francisco')
+        project = ProjectFactory(organization_name=organization.name)
+        db.session.flush()
+        issue = IssueFactory(project_id=project.id)
+        db.session.commit()
+        project_id, issue_id = project.id, issue.id
+
+        response = self.app.get('/api/projects/%d' % project_id)
+        self.assertEqual(response.headers['Cache-Control'], 'public, max-age=0, s-maxage=0')
+        keys = response.headers['Surrogate-Key'].split()
+        self.assertEqual(set(keys), set(['organization/Code-for-San-Francisco', 'project', 'project/%d' % project_id]))
+
+        # Lists outside one organization can be purged together
+        keys = self.app.get('/api/issues?seed=1').headers['Surrogate-Key'].split()
+        self.assertEqual(set(keys), set(['organization/Code-for-San-Francisco', 'issue', 'issue/%d' % issue_id, 'lists']))
+
+        # Organization pages keep their key when empty, and when cached
+        for n in range(2):
+            keys = self.app.get('/api/organizations/Code-for-San-Francisco/events').headers['Surrogate-Key']
+            self.assertEqual(keys, 'organization/Code-for-San-Francisco')
+        self.assertEqual(response_cache.hits, 1)
+
+        app.config['SURROGATE_MAX_AGE'] = 3600
+        response = self.app.get('/api/organizations')
+        self.assertEqual(response.headers['Cache-Control'], 'public, max-age=0, s-maxage=3600')
+        app.config['SURROGATE_MAX_AGE'] = 0
+
+        # Random shuffles are not for sharing
+        response = self.app.get('/api/issues')
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        self.assertFalse('Surrogate-Key' in response.headers)
+
+    def search_fixtures(self):
+        ''' Add a few projects, issues and stories about bikes.
+        '''
+        OrganizationFactory(name=u'Code for Oakland')
+        project = ProjectFactory(name=u'Bike Map', description=u'Mapping bike lanes', organization_name=u'Code for Oakland')
+        ProjectFactory(name=u'Transit', description=u'Bus times')
+        db.session.flush()
+        IssueFactory(title=u'Fix the bikes page', body=u'Biking is broken', project_id=project.id)
+        StoryFactory(title=u'Biking in Oakland')
+        db.session.commit()
+
+    def check_search(self):
+        ''' Check ranked, paged search results over the fixtures.
+        '''
+        self.search_fixtures()
+
+        response = json.loads(self.app.get('/api/search?q=bike').data)
+        self.assertEqual(response['total'], 3)
+        results = [(o['result_type'], o.get('name') or o.get('title')) for o in response['objects']]
+        self.assertEqual(set(results), set([(u'project', u'Bike Map'), (u'issue', u'Fix the bikes page'), (u'story', u'Biking in Oakland')]))
+        self.assertEqual(response['objects'][[r[0] for r in results].index('project')]['organization']['name'], u'Code for Oakland')
+
+        # Narrow by type, and page
+        response = json.loads(self.app.get('/api/search?q=bike&type=issue,story&per_page=1').data)
+        self.assertEqual(response['total'], 2)
+        self.assertEqual(len(response['objects']), 1)
+        self.assertEqual(response['pages']['next'], 'http://localhost/api/search?per_page=1&page=2&q=bike&type=issue%2Cstory')
+
+        # Matches that say it more often rank higher
+        ProjectFactory(name=u'Bus Bike', description=u'Bike racks on bike buses')
+        db.session.commit()
+        response = json.loads(self.app.get('/api/search?q=bike&type=project').data)
+        self.assertEqual([o['name'] for o in response['objects']], [u'Bus Bike', u'Bike Map'])
+
+        # The index follows updates and deletes
+        db.session.query(Project).filter_by(name=u'Bike Map').update({'description': u'Mapping trails'})
+        db.session.commit()
+        self.assertEqual(json.loads(self.app.get('/api/search?q=lanes').data)['total'], 0)
+        self.assertEqual(json.loads(self.app.get('/api/search?q=trails').data)['total'], 1)
+
+        db.session.query(Story).delete()
+        db.session.commit()
+        self.assertEqual(json.loads(self.app.get('/api/search?q=bike&type=story').data)['total'], 0)
+
+        self.assertEqual(self.app.get('/api/search').status_code, 400)
+        self.assertEqual(self.app.get('/api/search?q=bike&type=label').status_code, 400)
+
+    def test_search(self):
+        ''' Full-text search uses Postgres text search, and its indexes.
+        '''
+        self.check_search()
+
+        plan = self.explain(search_select('project', Project, ('name', 'description', 'categories'), u'bike'))
+        self.assertTrue('ix_project_search' in plan)
+
+    def test_filter_and_sort_indexes(self):
+        ''' Route and run_update.py queries on foreign keys and sort columns use indexes.
+        '''
+        now = datetime.utcnow()
+        queries = (
+            ('ix_event_organization_name_start_time_notz', db.session.query(Event).filter(Event.organization_name == u'Code for America', Event.start_time_notz >= now).order_by(Event.start_time_notz)),
+            ('ix_event_start_time_notz', db.session.query(Event).filter(Event.start_time_notz >= now).order_by(Event.start_time_notz)),
+            ('ix_project_organization_name_last_updated', db.session.query(Project).filter(Project.organization_name == u'Code for America').order_by(Project.last_updated.desc())),
+            ('ix_project_last_updated', db.session.query(Project).order_by(Project.last_updated.desc()).limit(10)),
+            ('ix_project_name_organization_name', db.session.query(Project).filter(Project.name == u'Bike Map', Project.organization_name == u'Code for America')),
+            ('ix_project_code_url', db.session.query(Project).filter(Project.code_url == u'https://github.com/codeforamerica/cfapi')),
+            ('ix_story_organization_name_link', db.session.query(Story).filter(Story.organization_name == u'Code for America', Story.link == u'http://example.com')),
+            ('ix_issue_project_id_title', db.session.query(Issue).filter(Issue.title == u'Fix it', Issue.project_id == 1)),
+            ('ix_label_issue_id_name', db.session.query(Label).filter(Label.issue_id.in_([1, 2, 3])))
+            )
+
+        for (index_name, query) in queries:
+            self.assertTrue(index_name in self.explain(query.statement), index_name)
+
+    def test_trigram_indexes(self):
+        ''' ilike filters can use trigram indexes, where Postgres has pg_trgm.
+        '''
+        try:
+            db.session.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            db.session.commit()
+        except DBAPIError:
+            db.session.rollback()
+            self.skipTest('pg_trgm is not available')
+
+        # Recreate the tables now that pg_trgm is installed.
+        db.session.close()
+        db.drop_all()
+        db.create_all()
+
+        ProjectFactory(name=u'Bike Map', organization_name=OrganizationFactory(name=u'Code for Oakland', type=u'Brigade').name)
+        db.session.commit()
+
+        # Filters behave as before
+        response = json.loads(self.app.get('/api/projects?name=ike+m&organization_type=brig').data)
+        self.assertEqual([project['name'] for project in response['objects']], [u'Bike Map'])
+
+        plan = self.explain(db.session.query(Project).filter(Project.name.ilike('%ike m%')).statement)
+        self.assertTrue('ix_project_name_trgm' in plan)
+
+        query = db.session.query(Project).join(Project.organization).filter(Organization.type.ilike('%brig%'))
+        self.assertTrue('ix_organization_type_trgm' in self.explain(query.statement))
+
+        for (model, column) in ((Issue, Issue.title), (Event, Event.name), (Story, Story.title)):
+            plan = self.explain(db.session.query(model).filter(column.ilike('%hack%')).statement)
+            self.assertTrue('ix_%s_%s_trgm' % (model.__tablename__, column.name) in plan)
+
+    def test_search_sqlite(self):
+        ''' Full-text search uses SQLite FTS5 tables for local databases.
+        '''
+        db.session.remove()
+        db.drop_all()
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///search-test.db'
+
+        try:
+            db.create_all()
+            self.check_search()
+            db.session.remove()
+            db.drop_all()
+        finally:
+            db.session.remove()
+            app.config['SQLALCHEMY_DATABASE_URI'] = 'postgres://postgres@localhost/civic_json_worker_test'
+            db.create_all()
+            os.remove('search-test.db')
+
     def test_issues_with_labels(self):
         '''
         Test that /api/issues/labels works as expected.
@@ -622,6 +1766,8 @@ class ApiTest(unittest.TestCase):
         issue.labels = [label1]
         issue2.labels = [label2]
 
+        db.session.flush()
+        index_labels(db.session, project.organization_name)
         db.session.flush()
 
         response = self.app.get('/api/issues/labels/enhancement')
@@ -635,6 +1781,74 @@ class ApiTest(unittest.TestCase):
         response = json.loads(response.data)
         self.assertEqual(response['total'], 0)
 
+    def test_label_index(self):
+        ''' Label queries intersect the label index, and count labels on what they find.
+        '''
+        oakland = ProjectFactory(organization_name=OrganizationFactory(name=u'Code for Oakland').name, type=u'web service')
+        boston = ProjectFactory(organization_name=OrganizationFactory(name=u'Code for Boston').name, type=u'api')
+        db.session.flush()
+
+        for (project, names) in ((oakland, ['Help Wanted', 'bug']), (oakland, ['help wanted', 'UI']),
+                                 (oakland, ['bug']), (boston, ['help wanted', 'bug'])):
+            issue = IssueFactory(project_id=project.id)
+            issue.labels = [LabelFactory(name=name) for name in names]
+
+        db.session.flush()
+        index_labels(db.session, u'Code for Oakland')
+        index_labels(db.session, u'Code for Boston')
+        db.session.commit()
+
+        # Names are matched like ilike, anywhere and in any case
+        response = json.loads(self.app.get('/api/issues/labels/HELP,bug').data)
+        self.assertEqual(response['total'], 2)
+        self.assertEqual(response['facets'], {u'help wanted': 2, u'bug': 2})
+
+        response = json.loads(self.app.get('/api/issues/labels/help').data)
+        self.assertEqual(response['total'], 3)
+        self.assertEqual(response['facets'], {u'help wanted': 3, u'bug': 2, u'ui': 1})
+
+        # Other filters narrow the facets too
+        response = json.loads(self.app.get('/api/issues/labels/help?project_type=web').data)
+        self.assertEqual(response['total'], 2)
+        self.assertEqual(response['facets'], {u'help wanted': 2, u'bug': 1, u'ui': 1})
+
+        response = json.loads(self.app.get('/api/organizations/Code-for-Boston/issues/labels/help').data)
+        self.assertEqual(response['total'], 1)
+        self.assertEqual(response['facets'], {u'help wanted': 1, u'bug': 1})
+
+        response = json.loads(self.app.get('/api/issues/labels/help,nope').data)
+        self.assertEqual((response['total'], response['facets']), (0, {}))
+
+        # More labels don't mean more queries
+        _, one_label_queries = self.count_queries('/api/issues/labels/help')
+        _, three_label_queries = self.count_queries('/api/issues/labels/help,bug,wanted')
+        self.assertEqual(one_label_queries, three_label_queries)
+
+        # Rebuilding the index follows label changes
+        db.session.query(Label).filter(Label.name == u'UI').delete()
+        index_labels(db.session, u'Code for Oakland')
+        db.session.commit()
+        self.assertEqual(json.loads(self.app.get('/api/issues/labels/ui').data)['total'], 0)
+
+        # Issues of projects without an organization aren't indexed, but still match
+        orphan = ProjectFactory(organization_name=None, type=u'web service')
+        db.session.flush()
+        issue = IssueFactory(project_id=orphan.id)
+        issue.labels = [LabelFactory(name=u'Help Wanted'), LabelFactory(name=u'docs')]
+        db.session.commit()
+
+        response = json.loads(self.app.get('/api/issues/labels/help').data)
+        self.assertEqual(response['total'], 4)
+        self.assertEqual(response['facets'], {u'help wanted': 4, u'bug': 2, u'docs': 1})
+
+        response = json.loads(self.app.get('/api/issues/labels/help,docs?project_type=web').data)
+        self.assertEqual(response['total'], 1)
+        self.assertEqual(response['facets'], {u'help wanted': 1, u'docs': 1})
+
+        response = json.loads(self.app.get('/api/issues/labels/help?project_type=web').data)
+        self.assertEqual(response['total'], 3)
+        self.assertEqual(response['facets'], {u'help wanted': 3, u'bug': 1, u'docs': 1})
+
     def test_organization_query_filter(self):
         '''
         Test that organization query params work as expected.